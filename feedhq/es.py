@@ -1,12 +1,20 @@
+import hashlib
+import json
+import time
+
 from collections import defaultdict
 from contextlib import contextmanager
-from copy import deepcopy
+from datetime import datetime, timedelta
 
 from django.db import connection
 from django.conf import settings
 from django.http import Http404
+from django.utils import timezone
+from django.utils.encoding import force_bytes
 from elasticsearch import Elasticsearch, NotFoundError
-from elasticsearch.helpers import bulk as es_bulk, BulkIndexError
+from elasticsearch.helpers import bulk as es_bulk, scan, BulkIndexError
+
+from .utils import get_redis_connection
 
 
 client = Elasticsearch(settings.ES_NODES,
@@ -23,50 +31,517 @@ def wait_for_yellow():
     return client.cluster.health(wait_for_status='yellow')
 
 
+# Results of cluster checks are cached per process for ES_CHECK_TTL seconds.
+# create_index bumps the version stored in redis to invalidate them.
+CHECKS_VERSION_KEY = 'es:checks_version'
+_checks = {}
+
+
+def _stale_checks(names):
+    version = get_redis_connection().get(CHECKS_VERSION_KEY)
+    now = time.time()
+    stale = []
+    for name in names:
+        checked = _checks.get(name)
+        if checked is None or checked[0] != version or checked[1] < now:
+            stale.append(name)
+    return stale, version
+
+
+def _checked(names, version):
+    expires = time.time() + settings.ES_CHECK_TTL
+    for name in names:
+        _checks[name] = version, expires
+
+
+def invalidate_checks():
+    _checks.clear()
+    get_redis_connection().incr(CHECKS_VERSION_KEY)
+
+
+def ensure_yellow():
+    """Same as wait_for_yellow() but cached."""
+    stale, version = _stale_checks(['health'])
+    if stale:
+        wait_for_yellow()
+        _checked(stale, version)
+
+
+def check_mappings(indices):
+    """
+    Makes sure guid and raw_title are not analyzed. Otherwise existing
+    entries are never matched when storing entries and things keep being
+    inserted. Checks are cached per index.
+    """
+    stale, version = _stale_checks(
+        [u'mapping:{0}'.format(index) for index in indices])
+    if not stale:
+        return
+    mappings = client.indices.get_field_mapping(
+        index=",".join(name.split(':', 1)[1] for name in stale),
+        doc_type='entries', field='guid,raw_title')
+    for idx, mapping in mappings.items():
+        mapping = mapping['mappings']['entries']
+        for f in ['raw_title', 'guid']:
+            assert mapping[f]['mapping'][f]['index'] == 'not_analyzed'
+    _checked(stale, version)
+
+
+ENTRIES_MAPPING = {
+    "_routing": {
+        "required": True,
+        "path": "user",
+    },
+    "properties": {
+        "timestamp": {
+            "format": "dateOptionalTime",
+            "type": "date"
+        },
+        "guid": {
+            "type": "string",
+            "index": "not_analyzed",
+        },
+        "raw_title": {
+            "type": "string",
+            "index": "not_analyzed",
+        },
+        "body": {
+            "type": "string",
+            "index": "not_analyzed",
+        },
+        "user": {
+            "type": "long",
+        },
+        "id": {
+            "type": "long",
+        },
+        # Rendered as is, never searched
+        "safe_content": {
+            "type": "string",
+            "index": "no",
+        },
+        "safe_nomedia_content": {
+            "type": "string",
+            "index": "no",
+        },
+    },
+}
+
+
+def create_entries_index(name):
+    client.indices.create(name, body={
+        'settings': {
+            'index': {
+                'number_of_shards': settings.ES_SHARDS,
+                'number_of_replicas': settings.ES_REPLICAS,
+            },
+        },
+        'mappings': {'entries': ENTRIES_MAPPING},
+    })
+
+
+# With ES_PARTITIONS, new entries go to a monthly index named after
+# PARTITION_TEMPLATE. Per-user aliases span all partitions, the archive
+# holding starred entries of dropped partitions and the initial ES_INDEX if
+# it exists.
+PARTITION_TEMPLATE = u'{0}-entries-{1:%Y.%m}'
+WRITE_INDEX_KEY = 'es:write_index'
+
+
+def partition_name(date):
+    return PARTITION_TEMPLATE.format(settings.ES_INDEX, date)
+
+
+def archive_name():
+    return u'{0}-entries-archive'.format(settings.ES_INDEX)
+
+
+def partitions():
+    """Names of the existing monthly partitions, oldest first."""
+    names = client.indices.get_settings(
+        index=u'{0}-entries-*'.format(settings.ES_INDEX)).keys()
+    return sorted(name for name in names if name != archive_name())
+
+
+def entry_indices():
+    """Names of all the indices holding entries."""
+    if not settings.ES_PARTITIONS:
+        return [settings.ES_INDEX]
+    names = partitions() + [archive_name()]
+    if client.indices.exists(settings.ES_INDEX):
+        names.append(settings.ES_INDEX)
+    return names
+
+
+def write_index():
+    """The index new entries are stored in."""
+    if not settings.ES_PARTITIONS:
+        return settings.ES_INDEX
+    name = get_redis_connection().get(WRITE_INDEX_KEY)
+    if name is None:
+        return settings.ES_INDEX
+    return name.decode('utf-8')
+
+
+def _create_partition(name, user_ids):
+    create_entries_index(name)
+    actions = []
+    for user_id in user_ids:
+        actions.append({'add': {
+            'index': name,
+            'alias': user_alias(user_id),
+            'routing': user_id,
+            'filter': {'term': {'user': user_id}},
+        }})
+        if len(actions) == 1000:
+            client.indices.update_aliases({'actions': actions})
+            actions = []
+    if actions:
+        client.indices.update_aliases({'actions': actions})
+
+
+def rollover(user_ids=()):
+    """
+    Creates the partition for the current month if needed, with the aliases
+    of ``user_ids``, and stores new entries in it.
+    """
+    user_ids = list(user_ids)
+    if not client.indices.exists(archive_name()):
+        _create_partition(archive_name(), user_ids)
+    name = partition_name(timezone.now())
+    if not client.indices.exists(name):
+        _create_partition(name, user_ids)
+    get_redis_connection().set(WRITE_INDEX_KEY, name)
+    return name
+
+
+def drop_partitions(ttl):
+    """
+    Drops the partitions closed more than ``ttl`` days ago, the longest
+    retention of all users. Starred entries and entries still within ``ttl``
+    days are moved to the archive first. Returns the dropped names.
+    """
+    limit = timezone.now() - timedelta(days=ttl)
+    names = partitions()
+    dropped = []
+    # The partition being written to is never dropped
+    for name, following in zip(names, names[1:]):
+        opened = datetime.strptime(following.rsplit('-', 1)[1], '%Y.%m')
+        if timezone.make_aware(opened, timezone.utc) > limit:
+            break
+        hits = scan(client, index=name, doc_type='entries', query={
+            'query': {'filtered': {'filter': {'or': [
+                {'term': {'starred': True}},
+                {'range': {'timestamp': {'gt': limit}}},
+            ]}}},
+        })
+        ops = []
+        for hit in hits:
+            data = hit['_source']
+            data.update({'_index': archive_name(), '_type': 'entries',
+                         '_id': hit['_id']})
+            ops.append(data)
+        if ops:
+            bulk(ops, raise_on_error=True)
+        client.indices.delete(name)
+        dropped.append(name)
+    return dropped
+
+
+def locate(user_id, pks):
+    """
+    Indices to use for requests on single entries of ``user_id``, per pk.
+    With partitions entries are looked up in the user's alias, unknown pks
+    are left out.
+    """
+    if not settings.ES_PARTITIONS:
+        alias = user_alias(user_id)
+        return {pk: alias for pk in pks}
+    if not pks:
+        return {}
+    results = client.search(
+        index=user_alias(user_id),
+        doc_type='entries',
+        body={
+            'query': {'filtered': {'filter': {'ids': {'values': pks}}}},
+            '_source': False,
+        },
+        params={'size': len(pks)},
+    )
+    return {int(hit['_id']): hit['_index']
+            for hit in results['hits']['hits']}
+
+
+def update_ops(user_id, pks, doc):
+    """Bulk operations applying ``doc`` to the given entries of ``user_id``."""
+    ops = []
+    for pk, index in locate(user_id, pks).items():
+        op = {
+            '_op_type': 'update',
+            '_index': index,
+            '_type': 'entries',
+            '_id': pk,
+            'doc': doc,
+        }
+        if settings.ES_PARTITIONS:
+            op['_routing'] = user_id
+        ops.append(op)
+    return ops
+
+
+def doc_index(user_id, index):
+    """Index for requests on an entry of ``user_id`` found in ``index``."""
+    if settings.ES_PARTITIONS:
+        return index
+    return user_alias(user_id)
+
+
+def doc_params(user_id, **params):
+    """Parameters for requests on single entries of ``user_id``."""
+    if settings.ES_PARTITIONS:
+        params['routing'] = user_id
+    return params
+
+
+def _mget(user_id, pks, **params):
+    if not settings.ES_PARTITIONS:
+        return client.mget({'ids': pks}, index=user_alias(user_id),
+                           doc_type='entries', params=params)['docs']
+    docs = [{'_index': index, '_type': 'entries', '_id': pk,
+             '_routing': user_id}
+            for pk, index in locate(user_id, pks).items()]
+    if not docs:
+        return []
+    return client.mget({'docs': docs}, params=params)['docs']
+
+
+# Writes made by users either force an index refresh or, with
+# ES_WRITE_OVERLAY, are kept in redis for that many seconds and merged into
+# search results until the index refreshes on its own.
+PENDING_KEY = 'user:{0}:pending'
+
+
+def write_params():
+    """Parameters for bulk or update calls made on behalf of users."""
+    return {'refresh': not settings.ES_WRITE_OVERLAY}
+
+
+def add_pending(user_id, pks, doc):
+    """Records ``doc``, a partial update, for the given entry pks."""
+    if not settings.ES_WRITE_OVERLAY or not pks:
+        return
+    key = PENDING_KEY.format(user_id)
+    values = {}
+    for pk in pks:
+        for attr, value in doc.items():
+            values['{0}:{1}'.format(pk, attr)] = json.dumps(value)
+    with get_redis_connection().pipeline() as pipe:
+        pipe.hmset(key, values)
+        pipe.expire(key, settings.ES_WRITE_OVERLAY)
+        pipe.execute()
+
+
+def pending(user_id):
+    """Pending updates per entry pk."""
+    overrides = defaultdict(dict)
+    if not settings.ES_WRITE_OVERLAY:
+        return overrides
+    values = get_redis_connection().hgetall(PENDING_KEY.format(user_id))
+    for field, value in values.items():
+        pk, attr = field.decode('utf-8').split(':', 1)
+        overrides[int(pk)][attr] = json.loads(value.decode('utf-8'))
+    return overrides
+
+
+# With ES_SHARED_BODIES, these fields are stored once per feed entry in
+# ES_BODIES_INDEX and entries only keep a reference to their body.
+BODY_FIELDS = ('content', 'safe_content', 'safe_nomedia_content', 'sanitizer')
+
+
+def body_id(feed_url, guid, content):
+    """
+    Some feeds use the same guid for all their entries, bodies are
+    identified by their content as well.
+    """
+    return hashlib.sha1(force_bytes(u'{0}\n{1}\n{2}'.format(
+        feed_url, guid, content))).hexdigest()
+
+
+def share_bodies(feed_url, ops):
+    """
+    Moves the bodies out of ``ops``, the entries of a feed being indexed.
+    Returns the operations for indexing each distinct body once.
+    """
+    bodies = {}
+    stored = timezone.now()
+    for data in ops:
+        body = {}
+        for field in BODY_FIELDS:
+            if field in data:
+                body[field] = data.pop(field)
+        data['body'] = body_id(feed_url, data['guid'],
+                               body.get('content', u''))
+        if data['body'] not in bodies:
+            body.update({
+                '_index': settings.ES_BODIES_INDEX,
+                '_type': 'bodies',
+                '_id': data['body'],
+                'feed_url': feed_url,
+                'stored': stored,
+            })
+            bodies[data['body']] = body
+    return list(bodies.values())
+
+
+def hydrate(docs):
+    """
+    Merges shared bodies into the source of ``docs``, with a single request
+    for all of them.
+    """
+    ids = set(doc['_source']['body'] for doc in docs
+              if 'body' in doc.get('_source', {}))
+    if not ids:
+        return docs
+    bodies = client.mget({'ids': list(ids)}, index=settings.ES_BODIES_INDEX,
+                         doc_type='bodies')['docs']
+    by_id = {body['_id']: body['_source'] for body in bodies if body['found']}
+    for doc in docs:
+        source = doc.get('_source', {})
+        if 'body' in source:
+            body = by_id.get(source.pop('body'), {})
+            source.update((field, value) for field, value in body.items()
+                          if field in BODY_FIELDS)
+    return docs
+
+
+def delete_orphan_bodies(chunk_size=1000):
+    """
+    Deletes the shared bodies no entry refers to anymore. Returns the number
+    of deleted bodies.
+    """
+    # Entries are indexed along with their body but aren't searchable until
+    # the next refresh. Recent bodies are left alone.
+    limit = timezone.now() - timedelta(days=1)
+    hits = scan(client, index=settings.ES_BODIES_INDEX, doc_type='bodies',
+                query={
+                    'query': {'filtered': {'filter': {
+                        'range': {'stored': {'lt': limit}},
+                    }}},
+                    '_source': False,
+                }, size=chunk_size)
+    count = 0
+    ids = []
+    for hit in hits:
+        ids.append(hit['_id'])
+        if len(ids) == chunk_size:
+            count += _delete_orphans(ids)
+            ids = []
+    if ids:
+        count += _delete_orphans(ids)
+    return count
+
+
+def _delete_orphans(ids):
+    results = client.search(
+        index=",".join(entry_indices()),
+        doc_type='entries',
+        body={
+            'query': {'filtered': {'filter': {'terms': {'body': ids}}}},
+            'aggs': {'bodies': {'terms': {'field': 'body', 'size': 0}}},
+        },
+        params={'size': 0},
+    )
+    used = set(bucket['key'] for bucket in
+               results['aggregations']['bodies']['buckets'])
+    ops = [{
+        '_op_type': 'delete',
+        '_index': settings.ES_BODIES_INDEX,
+        '_type': 'bodies',
+        '_id': pk,
+    } for pk in ids if pk not in used]
+    if ops:
+        bulk(ops)
+    return len(ops)
+
+
 def bulk(ops, **kwargs):
     """
     A wrapper for elasticsearch.helpers.bulk() that waits for a yellow
     cluster and uses our ES client.
     """
-    wait_for_yellow()
+    ensure_yellow()
     return es_bulk(client, ops, **kwargs)
 
 
+def _feed_counts(user_id, filters):
+    results = client.search(
+        index=user_alias(user_id),
+        doc_type='entries',
+        body={
+            'query': {'filtered': {'filter': _and_or_term(filters)}},
+            'aggs': {'feeds': {'terms': {'field': 'feed', 'size': 0}}},
+        },
+        params={'size': 0},
+    )
+    if 'aggregations' not in results:
+        return {}
+    return {bucket['key']: bucket['doc_count']
+            for bucket in results['aggregations']['feeds']['buckets']}
+
+
 def counts(user, feed_ids, unread=True, stars=False):
-    aggs = {}
-    for pk in feed_ids:
-        term = {'term': {'feed': pk}}
-        if stars:
-            term = {'and': [
-                {'term': {'starred': True}},
-                term,
-            ]}
-        elif unread:
-            term = {'and': [
-                {'term': {'read': False}},
-                term,
-            ]}
-        aggs[pk] = {
-            'global': {},
-            'aggs': {
-                pk: {'filter': term},
-            },
-        }
-    query = {
-        'aggs': aggs,
-    }
-    return client.search(index=user_alias(user.pk),
-                         doc_type='entries',
-                         body=query,
-                         params={'size': 0}).get('aggregations', {})
+    """
+    Number of unread -- or starred, or all -- entries per feed pk for the
+    given feeds, in a single terms aggregation.
+    """
+    feed_ids = list(feed_ids)
+    if not feed_ids:
+        return {}
+    filters = [{'terms': {'feed': feed_ids}}]
+    if stars:
+        filters.append({'term': {'starred': True}})
+    elif unread:
+        filters.append({'term': {'read': False}})
+    results = dict.fromkeys(feed_ids, 0)
+    results.update(_feed_counts(user.pk, filters))
+    return results
+
+
+def unread_by_feed(user_id):
+    """
+    Unread entries per feed pk, straight from ES. Used for building and
+    reconciling the unread counters stored in redis.
+    """
+    return _feed_counts(user_id, [{'term': {'read': False}}])
+
+
+def read_deltas(user_id, pks, read):
+    """
+    Changes to the unread counters caused by setting ``read`` on the entries
+    with the given pks, per feed pk. Call before updating the entries.
+    """
+    deltas = defaultdict(int)
+    if not pks:
+        return deltas
+    docs = _mget(user_id, pks, _source_include='feed,read,user')
+    for doc in docs:
+        if not doc['found'] or doc['_source']['user'] != user_id:
+            continue
+        if doc['_source']['read'] != read:
+            deltas[doc['_source']['feed']] += -1 if read else 1
+    return deltas
 
 
 def entry(user, id, annotate_results=True):
     from .feeds.models import EsEntry
+    index = locate(user.pk, [id]).get(id)
+    if index is None:
+        raise Http404
     try:
-        result = client.get(user_alias(user.pk), id)
+        result = client.get(index, id, params=doc_params(user.pk))
     except NotFoundError:
         raise Http404
+    [result] = hydrate([result])
     entry = EsEntry(result)
     if annotate_results:
         entry.user = user
@@ -78,9 +553,8 @@ def entry(user, id, annotate_results=True):
 
 def mget(user, pks, annotate_results=True):
     from .feeds.models import EsEntry
-    docs = client.mget({'ids': pks}, index=user_alias(user.pk),
-                       doc_type='entries')['docs']
-    results = []
+    docs = _mget(user.pk, pks)
+    found = []
     for doc in docs:
         if not doc['found']:
             continue
@@ -91,7 +565,8 @@ def mget(user, pks, annotate_results=True):
             # safer to enforce here.
             continue
         doc['_id'] = int(doc['_id'])
-        results.append(EsEntry(doc))
+        found.append(doc)
+    results = [EsEntry(doc) for doc in hydrate(found)]
     if annotate_results:
         results = _annotate(results, user)
     return results
@@ -120,9 +595,30 @@ def _annotate(results, user):
 
 
 def next_id():
+    [value] = next_ids(1)
+    return value
+
+
+def next_ids(count):
+    """Reserves ``count`` entry IDs in a single query."""
+    if not count:
+        return []
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "select nextval('feeds_entry_id_seq'::regclass) "
+            "from generate_series(1, %s)", [count])
+        values = [value for (value,) in cursor.fetchall()]
+    finally:
+        cursor.close()
+    return values
+
+
+def last_id():
+    """The latest entry ID reserved, without reserving a new one."""
     cursor = connection.cursor()
     try:
-        cursor.execute("select nextval('feeds_entry_id_seq'::regclass)")
+        cursor.execute("select last_value from feeds_entry_id_seq")
         [(value,)] = cursor.fetchall()
     finally:
         cursor.close()
@@ -157,8 +653,14 @@ def _lookup(name, values):
 
 
 class EntryQuery(object):
+    """
+    Queries are immutable: every method returns a new query sharing the
+    structures of the current one, so cloning is cheap. Nested filters and
+    aggregations must never be modified in place.
+    """
     def __init__(self, **kwargs):
         self.indices = ''
+        self.user_id = None
         self.filters = {}
         self.aggs = {}
         self.terms_aggs = {}
@@ -167,19 +669,23 @@ class EntryQuery(object):
         self.query = None
         self.source = {}
         self.ordering = ['timestamp:desc', 'id:desc']
+        self.cursor = None
+        self._body = None
         self.filter(clone=False, **kwargs)
 
     def _clone(self):
         q = self.__class__()
         q.indices = self.indices
-        q.filters = deepcopy(self.filters)
-        q.aggs = deepcopy(self.aggs)
-        q.terms_aggs = deepcopy(self.terms_aggs)
+        q.user_id = self.user_id
+        q.filters = dict(self.filters)
+        q.aggs = dict(self.aggs)
+        q.terms_aggs = dict(self.terms_aggs)
         q.query_agg = self.query_agg
-        q.query_aggs = deepcopy(self.query_aggs)
+        q.query_aggs = dict(self.query_aggs)
         q.query = self.query
-        q.source = deepcopy(self.source)
+        q.source = dict(self.source)
         q.ordering = self.ordering
+        q.cursor = self.cursor
         return q
 
     def filter(self, clone=True, or_=False, **kwargs):
@@ -205,6 +711,7 @@ class EntryQuery(object):
                 if negate:
                     raise ValueError("Can't exclude an index.")
                 self.indices = user_alias(value)
+                self.user_id = value
                 continue
 
             if key == 'query':
@@ -227,9 +734,9 @@ class EntryQuery(object):
 
         if filters:
             if or_:
-                if 'or' not in self.filters:
-                    self.filters['or'] = {'or': []}
-                self.filters['or']['or'].extend(filters.values())
+                alternatives = self.filters.get('or', {'or': []})['or']
+                self.filters['or'] = {
+                    'or': alternatives + list(filters.values())}
             else:
                 self.filters.update(filters)
 
@@ -301,52 +808,164 @@ class EntryQuery(object):
             q.ordering.append('{0}:{1}'.format(crit, order))
         return q
 
-    def fetch(self, page=1, per_page=50, annotate=None):
-        from .feeds.models import EsEntry
+    def after(self, cursor):
+        """
+        Only match entries coming after ``cursor`` in the current ordering.
+        ``cursor`` holds the sort values of an entry, as returned in the
+        'cursor' key of fetch() results for the last hit.
+
+        Unlike fetching deep pages, the cost of a query doesn't grow with
+        the number of entries being skipped.
+        """
+        if len(cursor) != len(self.ordering):
+            raise ValueError("Cursor doesn't match the ordering")
+        q = self._clone()
+        q.cursor = list(cursor)
+        return q
+
+    def neighbors(self, cursor, size=1):
+        """
+        IDs of the ``size`` entries right before and right after ``cursor``
+        in the current ordering, closest first, as a ``(before, after)``
+        tuple of lists. Both are looked up with a single multi-search
+        request.
+        """
+        criteria = [criterion.split(':') for criterion in self.ordering]
+        reverse = self.order_by(*[
+            field if order == 'desc' else '-{0}'.format(field)
+            for field, order in criteria
+        ])
+        body = []
+        for query in [reverse.after(cursor), self.after(cursor)]:
+            body.append({'index': query.indices, 'type': 'entries'})
+            body.append({
+                'query': query.body()['query'],
+                'sort': [{field: order} for field, order in (
+                    criterion.split(':') for criterion in query.ordering)],
+                'size': size,
+                '_source': False,
+            })
+        return tuple([int(hit['_id']) for hit in response['hits']['hits']]
+                     for response in client.msearch(body)['responses'])
+
+    def _cursor_filter(self):
+        # (a, b) after (x, y) means a > x or (a = x and b > y)
+        alternatives = []
+        for index, criterion in enumerate(self.ordering):
+            field, order = criterion.split(':')
+            terms = [
+                {'term': {previous.split(':')[0]: value}}
+                for previous, value in zip(self.ordering[:index], self.cursor)
+            ]
+            lookup = 'lt' if order == 'desc' else 'gt'
+            terms.append({'range': {field: {lookup: self.cursor[index]}}})
+            alternatives.append(_and_or_term(terms))
+        return {'or': alternatives}
+
+    def _apply_pending(self, entries):
+        """
+        Merges pending updates into entries, leaving out those that don't
+        match term filters anymore.
+        """
+        overrides = pending(self.user_id)
+        if not overrides:
+            return entries
+        results = []
+        for entry in entries:
+            matches = True
+            for attr, value in overrides.get(entry.pk, {}).items():
+                setattr(entry, attr, value)
+                filter_ = self.filters.get(attr, {})
+                if 'term' in filter_:
+                    matches &= filter_['term'][attr] == value
+                elif 'term' in filter_.get('not', {}):
+                    matches &= filter_['not']['term'][attr] != value
+            if matches:
+                results.append(entry)
+        return results
+
+    def _filtered(self):
         filters = {}
-        if self.filters:
-            filters['filter'] = _and_or_term(list(self.filters.values()))
+        values = list(self.filters.values())
+        if self.cursor is not None:
+            values.append(self._cursor_filter())
+        if values:
+            filters['filter'] = _and_or_term(values)
         else:
             filters['filter'] = {'match_all': {}}
+        if self.query:
+            filters['query'] = {'match': {'_all': self.query}}
+        return filters
+
+    def iter_ids(self, chunk_size=1000):
+        """
+        Yields the IDs of all matching entries in lists of at most
+        ``chunk_size`` items. IDs are streamed with a scan/scroll search,
+        memory stays bounded on both ends regardless of the number of
+        matching entries.
+        """
+        hits = scan(client, index=self.indices, doc_type='entries',
+                    query={'query': self.body()['query'], '_source': False},
+                    size=chunk_size)
+        ids = []
+        for hit in hits:
+            ids.append(int(hit['_id']))
+            if len(ids) == chunk_size:
+                yield ids
+                ids = []
+        if ids:
+            yield ids
+
+    def body(self):
+        """
+        The search request body. It's compiled once per query and must not
+        be modified.
+        """
+        if self._body is not None:
+            return self._body
 
+        filters = self._filtered()
+        aggs = dict(self.aggs)
         if self.terms_aggs or self.query_agg:
-            self.aggs['query'] = {'filter': filters['filter']}
+            aggs['query'] = {'filter': filters['filter']}
             if self.terms_aggs:
-                self.aggs['query']['aggs'] = self.terms_aggs
+                aggs['query']['aggs'] = self.terms_aggs
 
         if self.query_aggs:
-            self.aggs.update(self.query_aggs)
-
-        if self.query:
-            filters['query'] = query = {'match': {'_all': self.query}}
+            aggs.update(self.query_aggs)
 
-        query = {}
-
-        if filters:
-            query['query'] = {'filtered': filters}
+        query = {'query': {'filtered': filters}}
 
         if self.source:
             query['_source'] = self.source
 
-        if self.aggs:
+        if aggs:
             query['aggs'] = {
                 'entries': {
                     'global': {},
-                    'aggs': self.aggs
+                    'aggs': aggs
                 },
             }
+        self._body = query
+        return query
 
+    def fetch(self, page=1, per_page=50, annotate=None):
+        from .feeds.models import EsEntry
         results = client.search(
             index=self.indices,
             doc_type='entries',
-            body=query,
+            body=self.body(),
             params={
                 'from': (page - 1) * per_page,
                 'sort': ",".join(self.ordering),
                 'size': per_page,
             },
         )
-        results['hits'] = [EsEntry(hit) for hit in results['hits']['hits']]
+        hits = results['hits']['hits']
+        results['cursor'] = hits[-1]['sort'] if hits else None
+        results['hits'] = [EsEntry(hit) for hit in hydrate(hits)]
+        if self.user_id is not None:
+            results['hits'] = self._apply_pending(results['hits'])
         if annotate is not None:
             results['hits'] = _annotate(results['hits'], annotate)
         return results
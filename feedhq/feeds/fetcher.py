@@ -0,0 +1,241 @@
+"""
+Process-wide HTTP session used for fetching feeds and favicons.
+
+Connections are pooled per host and kept alive between requests, so
+repeated fetches to the same host skip the TCP and TLS handshakes. Use
+``rqworker --no-fork`` to keep the pools alive across jobs.
+"""
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+from ..utils import get_redis_connection
+
+STATS_KEY = 'fetcher:pool'
+BUCKET_KEY = 'fetcher:bucket:{0}'
+
+# Token bucket stored in a redis hash. Refills the bucket according to the
+# time elapsed since the last call and takes a token if there is one.
+# Returns the number of seconds to wait for a token, 0 if one was taken.
+TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+_lock = threading.Lock()
+_session = None
+_pid = None
+_flushed = {'hits': 0, 'misses': 0}
+
+
+class PoolStatsAdapter(HTTPAdapter):
+    """
+    An adapter that counts connection pool hits (request made on a
+    kept-alive connection) and misses (new connection opened).
+    """
+    def __init__(self, *args, **kwargs):
+        super(PoolStatsAdapter, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def send(self, request, **kwargs):
+        pool = self.get_connection(request.url, kwargs.get('proxies'))
+        connections = pool.num_connections
+        try:
+            return super(PoolStatsAdapter, self).send(request, **kwargs)
+        finally:
+            with self._stats_lock:
+                if pool.num_connections > connections:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+
+def _create_session():
+    session = requests.Session()
+    adapter = PoolStatsAdapter(pool_connections=settings.FETCH_POOL_HOSTS,
+                               pool_maxsize=settings.FETCH_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def session():
+    """
+    Returns the shared session. Sockets can't be shared with a parent
+    process so a new session is created after a fork.
+    """
+    global _session, _pid
+    if _session is None or _pid != os.getpid():
+        with _lock:
+            if _session is None or _pid != os.getpid():
+                _session = _create_session()
+                _pid = os.getpid()
+    return _session
+
+
+class ResponseTooLarge(requests.RequestException):
+    pass
+
+
+def _abort(response):
+    """
+    Drops the connection of a response whose body won't be read. Unblocks
+    a read in progress in another thread.
+    """
+    raw = response.raw
+    sock = getattr(getattr(raw, '_connection', None), 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:  # already closed
+            pass
+    raw.close()
+
+
+def read(response, max_size=None, deadline=None):
+    """
+    Reads the body of a streamed response, giving up if it's larger than
+    ``max_size`` bytes or if it takes more than ``deadline`` seconds.
+
+    A chunk read blocks as long as the server keeps sending data, a
+    watchdog thread drops the connection when the deadline is reached.
+    """
+    if max_size is None:
+        max_size = settings.FETCH_MAX_SIZE
+    if deadline is None:
+        deadline = settings.FETCH_READ_DEADLINE
+    try:
+        length = int(response.headers.get('content-length', 0))
+    except ValueError:
+        length = 0
+    if length > max_size:
+        _abort(response)
+        raise ResponseTooLarge(
+            "Content-Length {0} > {1}".format(length, max_size))
+
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        _abort(response)
+
+    timeout = requests.Timeout("Body not read after {0}s".format(deadline))
+    watchdog = threading.Timer(max(0, deadline), expire)
+    watchdog.daemon = True
+    watchdog.start()
+    start = time.time()
+    size = 0
+    chunks = []
+    try:
+        for chunk in response.iter_content(16 * 1024):
+            size += len(chunk)
+            chunks.append(chunk)
+            if size > max_size:
+                _abort(response)
+                raise ResponseTooLarge(
+                    "Body larger than {0}".format(max_size))
+            if time.time() - start > deadline:
+                _abort(response)
+                raise timeout
+    except Exception:
+        if expired.is_set():  # whatever the dropped connection raised
+            raise timeout
+        raise
+    finally:
+        watchdog.cancel()
+    if expired.is_set():  # cut short
+        raise timeout
+    response._content = b''.join(chunks)
+    response._content_consumed = True
+    return response
+
+
+def get(url, max_size=None, deadline=None, **kwargs):
+    """
+    Same as requests.get() but using the shared session. The body is read
+    with read().
+
+    Cookies are kept for the redirects of a fetch only: feeds are fetched on
+    behalf of many users, cookies set by a host must not leak into the next
+    fetch.
+    """
+    kwargs['stream'] = True
+    s = session()
+    # Swapped rather than cleared, other threads may be iterating over it.
+    s.cookies = RequestsCookieJar()
+    return read(s.get(url, **kwargs), max_size=max_size, deadline=deadline)
+
+
+def take_token(host):
+    """
+    Takes a token from the bucket of ``host``, shared by all workers.
+
+    Returns 0 if the request can be made right away or the number of
+    seconds after which a token will be available.
+    """
+    rate = settings.FETCH_HOST_RATE
+    if not rate:
+        return 0
+    redis = get_redis_connection()
+    wait = redis.eval(TAKE_TOKEN, 1, BUCKET_KEY.format(host), rate,
+                      settings.FETCH_HOST_BURST, time.time())
+    return float(wait)
+
+
+def pool_stats():
+    """Connection pool hits and misses for the current process."""
+    hits = misses = 0
+    if _session is not None and _pid == os.getpid():
+        for adapter in set(_session.adapters.values()):
+            hits += getattr(adapter, 'hits', 0)
+            misses += getattr(adapter, 'misses', 0)
+    return {'hits': hits, 'misses': misses}
+
+
+def flush_pool_stats():
+    """
+    Adds the counters of the current process to the global counters stored
+    in redis. Called by the fetch tasks once they're done.
+    """
+    global _flushed
+    stats = pool_stats()
+    if any(stats[key] < _flushed[key] for key in stats):  # new session
+        _flushed = {'hits': 0, 'misses': 0}
+    with get_redis_connection().pipeline() as pipe:
+        for key, value in stats.items():
+            if value > _flushed[key]:
+                pipe.hincrby(STATS_KEY, key, value - _flushed[key])
+        pipe.execute()
+    _flushed = stats
+
+
+def global_pool_stats():
+    """Connection pool hits and misses across all fetch workers."""
+    stats = get_redis_connection().hgetall(STATS_KEY)
+    return {
+        key: int(stats.get(key.encode('utf-8'), 0))
+        for key in ['hits', 'misses']
+    }
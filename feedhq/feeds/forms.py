@@ -2,6 +2,7 @@ import contextlib
 import json
 import os
 import six
+import uuid
 
 from django.core.cache import cache
 from django.core.validators import validate_ipv46_address, URLValidator
@@ -15,11 +16,13 @@ from urlobject import URLObject
 import feedparser
 import floppyforms.__future__ as forms
 import opml
-import requests
 
+from . import fetcher
 from .models import Category, Feed
+from .tasks import mark_as_read, undo_pks
 from .utils import USER_AGENT, is_feed
 from .. import es
+from ..tasks import enqueue
 from ..utils import get_redis_connection
 
 
@@ -133,9 +136,9 @@ class FeedForm(UserFormMixin, forms.ModelForm):
                 'Accept': feedparser.ACCEPT_HEADER,
             }
             try:
-                response = requests.get(six.text_type(url.without_auth()),
-                                        headers=headers, timeout=10,
-                                        auth=auth)
+                response = fetcher.get(six.text_type(url.without_auth()),
+                                       headers=headers, timeout=10,
+                                       auth=auth)
             except Exception:
                 if 'SENTRY_DSN' in os.environ:
                     client = Client()
@@ -169,19 +172,10 @@ class FeedForm(UserFormMixin, forms.ModelForm):
             feed.tracker.previous('id')
         ):
             new_cat = feed.category_id
-            entries = es.manager.user(self.user).filter(
-                feed=feed.pk).aggregate('id').fetch(per_page=0)
-            pks = [bucket['key'] for bucket in entries[
-                'aggregations']['entries']['query']['id']['buckets']]
-            if pks:
-                ops = [{
-                    '_op_type': 'update',
-                    '_type': 'entries',
-                    '_id': pk,
-                    'doc': {'category': new_cat},
-                } for pk in pks]
-                index = es.user_alias(self.user.pk)
-                es.bulk(ops, index=index, raise_on_error=True)
+            entries = es.manager.user(self.user).filter(feed=feed.pk)
+            for pks in entries.iter_ids():
+                ops = es.update_ops(self.user.pk, pks, {'category': new_cat})
+                es.bulk(ops, raise_on_error=True)
         feed.save()
         return feed
 
@@ -249,27 +243,35 @@ class ReadForm(forms.Form):
         return json.loads(self.cleaned_data['entries'])
 
     def save(self):
-        index = es.user_alias(self.user.pk)
-        if self.pages_only:
-            pks = self.cleaned_data['entries']
-        else:
-            # Fetch all IDs for current query.
-            entries = self.es_entries.filter(
-                read=False).aggregate('id').fetch(per_page=0)
-            pks = [bucket['key'] for bucket in entries[
-                'aggregations']['entries']['query']['id']['buckets']]
-
-        ops = [{
-            '_op_type': 'update',
-            '_index': index,
-            '_type': 'entries',
-            '_id': pk,
-            'doc': {'read': True},
-        } for pk in pks]
+        """
+        Returns the number of entries marked as read. All entries are marked
+        by a job, their unread counts are updated right away. Entries stored
+        after the form was submitted are left alone. The job records the
+        entries it marks under ``self.undo`` for UndoReadForm.
+        """
+        if not self.pages_only:
+            es_entries = self.es_entries.filter(read=False,
+                                                id__lte=es.last_id())
+            feeds = es_entries.aggregate('feed').fetch(per_page=0)[
+                'aggregations']['entries']['query']['feed']['buckets']
+            deltas = {bucket['key']: -bucket['doc_count']
+                      for bucket in feeds}
+            self.undo = uuid.uuid4().hex
+            if deltas:
+                enqueue(mark_as_read, args=[self.user.pk, es_entries, deltas],
+                        kwargs={'undo': self.undo}, queue='high')
+                self.user.incr_unread(deltas)
+            return -sum(deltas.values())
+
+        pks = self.cleaned_data['entries']
         if pks:
+            deltas = es.read_deltas(self.user.pk, pks, True)
+            ops = es.update_ops(self.user.pk, pks, {'read': True})
             with es.ignore_bulk_error(404, 409):
-                es.bulk(ops, raise_on_error=True, params={'refresh': True})
-        return pks
+                es.bulk(ops, raise_on_error=True, params=es.write_params())
+            es.add_pending(self.user.pk, pks, {'read': True})
+            self.user.incr_unread(deltas)
+        return len(pks)
 
 
 class UndoReadForm(forms.Form):
@@ -280,27 +282,33 @@ class UndoReadForm(forms.Form):
         widget=forms.HiddenInput,
         initial='undo-read',
     )
-    pks = forms.CharField(widget=forms.HiddenInput)
+    pks = forms.CharField(widget=forms.HiddenInput, required=False)
+    # Entries marked as read by a job
+    undo = forms.CharField(widget=forms.HiddenInput, required=False)
 
     def __init__(self, user=None, *args, **kwargs):
         self.user = user
         super(UndoReadForm, self).__init__(*args, **kwargs)
 
     def clean_pks(self):
+        if not self.cleaned_data['pks']:
+            return []
         return json.loads(self.cleaned_data['pks'])
 
+    def clean(self):
+        data = super(UndoReadForm, self).clean()
+        if data.get('undo'):
+            data['pks'] = undo_pks(self.user.pk, data['undo'])
+        return data
+
     def save(self):
         pks = self.cleaned_data['pks']
-        index = es.user_alias(self.user.pk)
-        ops = [{
-            '_op_type': 'update',
-            '_index': index,
-            '_type': 'entries',
-            '_id': pk,
-            'doc': {'read': False},
-        } for pk in pks]
+        deltas = es.read_deltas(self.user.pk, pks, False)
+        ops = es.update_ops(self.user.pk, pks, {'read': False})
         with es.ignore_bulk_error(404, 409):
-            es.bulk(ops, raise_on_error=True, params={'refresh': True})
+            es.bulk(ops, raise_on_error=True, params=es.write_params())
+        es.add_pending(self.user.pk, pks, {'read': False})
+        self.user.incr_unread(deltas)
         return len(pks)
 
 
@@ -2,11 +2,16 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from .... import es
+from ....profiles.models import User
 
 
 class Command(BaseCommand):
     def handle(self, *args, **kwargs):
-        es.client.indices.create(settings.ES_INDEX, body={
+        if settings.ES_PARTITIONS:
+            es.rollover(User.objects.values_list('pk', flat=True))
+        else:
+            es.create_entries_index(settings.ES_INDEX)
+        es.client.indices.create(settings.ES_BODIES_INDEX, body={
             'settings': {
                 'index': {
                     'number_of_shards': settings.ES_SHARDS,
@@ -14,31 +19,19 @@ class Command(BaseCommand):
                 },
             },
             'mappings': {
-                "entries": {
-                    "_routing": {
-                        "required": True,
-                        "path": "user",
-                    },
+                "bodies": {
+                    "_all": {"enabled": False},
+                    "dynamic": False,
                     "properties": {
-                        "timestamp": {
+                        "stored": {
                             "format": "dateOptionalTime",
                             "type": "date"
                         },
-                        "guid": {
-                            "type": "string",
-                            "index": "not_analyzed",
-                        },
-                        "raw_title": {
-                            "type": "string",
-                            "index": "not_analyzed",
-                        },
-                        "user": {
-                            "type": "long",
-                        },
-                        "id": {
-                            "type": "long",
+                        "sanitizer": {
+                            "type": "integer",
                         },
                     },
                 },
             },
         })
+        es.invalidate_checks()
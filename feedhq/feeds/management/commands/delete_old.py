@@ -1,9 +1,87 @@
+import json
+import logging
+import time
+
+from optparse import make_option
+
+from django.conf import settings
+from django.db.models import Max
+from more_itertools import chunked
+from rq.job import Job, Status
+
 from . import SentryCommand
+from .... import es
 from ....profiles.models import User
+from ....tasks import enqueue
+from ....utils import get_redis_connection
+from ...tasks import (delete_old, finish_sweep, SWEEP_KEY, SWEEP_JOBS_KEY,
+                      SWEEP_SHARDS_KEY, SWEEP_TTL)
+
+logger = logging.getLogger(__name__)
 
 
 class Command(SentryCommand):
+    """Deletes expired entries, sweeping users in parallel RQ jobs."""
+    option_list = SentryCommand.option_list + (
+        make_option(
+            '--shard-size',
+            action='store',
+            type='int',
+            dest='shard_size',
+            default=100,
+            help='Number of users per job.',
+        ),
+    )
+
     def handle_sentry(self, **options):
-        users = User.objects.all()
-        for user in users:
-            user.delete_old()
+        redis = get_redis_connection()
+        shards = redis.hkeys(SWEEP_SHARDS_KEY)
+        if redis.exists(SWEEP_KEY) and shards:
+            jobs = redis.hgetall(SWEEP_JOBS_KEY)
+            # Jobs that failed, expired or were lost with a killed worker
+            # are enqueued again.
+            queued = set(
+                shard for shard, job_id in jobs.items()
+                if Job(job_id.decode('utf-8'), connection=redis).get_status()
+                in (Status.QUEUED, Status.STARTED))
+            logger.info("Resuming delete_old, {0} shards left, {1} queued or "
+                        "running".format(len(shards), len(queued)))
+            shards = sorted((shard.decode('utf-8') for shard in shards
+                             if shard not in queued), key=int)
+        else:
+            if settings.ES_PARTITIONS:
+                # Whole partitions expire for everyone, per-user deletes then
+                # only deal with shorter retentions.
+                ttl = User.objects.aggregate(ttl=Max('ttl'))['ttl']
+                if ttl is not None:
+                    es.drop_partitions(ttl)
+            shards = self.start(options['shard_size'])
+            if not shards:
+                finish_sweep()
+
+        for shard in shards:
+            job = enqueue(delete_old, args=[shard], timeout=60 * 60)
+            with redis.pipeline() as pipe:
+                pipe.hset(SWEEP_JOBS_KEY, shard, job.id)
+                pipe.expire(SWEEP_JOBS_KEY, SWEEP_TTL)
+                pipe.execute()
+
+    def start(self, shard_size):
+        users = User.objects.filter(
+            is_active=True, is_suspended=False,
+        ).order_by('pk').values_list('pk', flat=True)
+        shards = {}
+        for index, user_ids in enumerate(chunked(users.iterator(),
+                                                 shard_size)):
+            shards[str(index)] = json.dumps(user_ids)
+
+        redis = get_redis_connection()
+        with redis.pipeline() as pipe:
+            pipe.delete(SWEEP_KEY, SWEEP_SHARDS_KEY, SWEEP_JOBS_KEY)
+            pipe.hset(SWEEP_KEY, 'started', time.time())
+            if shards:
+                pipe.hmset(SWEEP_SHARDS_KEY, shards)
+            pipe.expire(SWEEP_KEY, SWEEP_TTL)
+            pipe.expire(SWEEP_SHARDS_KEY, SWEEP_TTL)
+            pipe.execute()
+        return sorted(shards, key=int)
@@ -0,0 +1,77 @@
+import logging
+
+from django.conf import settings
+from elasticsearch.helpers import scan
+
+from . import SentryCommand
+from ...models import BaseEntry, Entry, Feed
+from .... import es
+
+logger = logging.getLogger(__name__)
+
+
+class Command(SentryCommand):
+    """Sanitizes entries stored with an outdated sanitizer version."""
+    chunk_size = 500
+
+    def handle_sentry(self, **options):
+        outdated = {'not': {
+            'term': {'sanitizer': BaseEntry.SANITIZER_VERSION},
+        }}
+        # Entries referring to a shared body are updated with their body
+        count = self.resanitize_all(
+            ",".join(es.entry_indices()), 'entries',
+            {'and': [outdated, {'missing': {'field': 'body'}}]},
+            ['content', 'feed', 'user'])
+        count += self.resanitize_all(
+            settings.ES_BODIES_INDEX, 'bodies', outdated,
+            ['content', 'feed_url'])
+        logger.info("Sanitized {0} entries".format(count))
+
+    def resanitize_all(self, index, doc_type, filters, fields):
+        hits = scan(es.client, index=index, doc_type=doc_type, query={
+            'query': {'filtered': {'filter': filters}},
+            '_source': fields,
+        }, size=self.chunk_size)
+        count = 0
+        chunk = []
+        for hit in hits:
+            chunk.append(hit)
+            if len(chunk) == self.chunk_size:
+                count += self.resanitize(index, doc_type, chunk)
+                chunk = []
+        if chunk:
+            count += self.resanitize(index, doc_type, chunk)
+        return count
+
+    def resanitize(self, index, doc_type, hits):
+        urls = dict(Feed.objects.filter(pk__in=set(
+            hit['_source']['feed'] for hit in hits
+            if 'feed' in hit['_source']
+        )).values_list('pk', 'url'))
+        ops = []
+        for hit in hits:
+            source = hit['_source']
+            if 'feed_url' in source:
+                url = source['feed_url']
+            else:
+                url = urls.get(source['feed'])
+            if url is None:  # unsubscribed, about to be deleted
+                continue
+            entry = Entry(subtitle=source.get('content'))
+            op = {
+                '_op_type': 'update',
+                '_index': index,
+                '_type': doc_type,
+                '_id': hit['_id'],
+                'doc': entry.sanitized_fields(url),
+            }
+            if 'user' in source:
+                op['_index'] = es.doc_index(source['user'], hit['_index'])
+                if settings.ES_PARTITIONS:
+                    op['_routing'] = source['user']
+            ops.append(op)
+        if ops:
+            with es.ignore_bulk_error(404, 409):
+                es.bulk(ops, raise_on_error=True)
+        return len(ops)
@@ -0,0 +1,14 @@
+import logging
+
+from . import SentryCommand
+from .... import es
+from ....profiles.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class Command(SentryCommand):
+    """Creates the partition for the current month, with ES_PARTITIONS."""
+    def handle_sentry(self, **options):
+        name = es.rollover(User.objects.values_list('pk', flat=True))
+        logger.info("Storing new entries in {0}".format(name))
@@ -1,10 +1,13 @@
 from optparse import make_option
 import os
 
+from django.conf import settings
 from raven import Client
 from rq import Queue, Connection, Worker
+from rq.job import Status
 
 from . import SentryCommand
+from ...tasks import store_entries, store_entries_batch
 from ....utils import get_redis_connection
 
 
@@ -26,11 +29,108 @@ def sentry_handler(job, *exc_info):
     return False
 
 
+class NonForkingWorker(Worker):
+    """
+    Performs jobs in the worker process instead of a forked work horse.
+    Process-wide state such as the fetcher's connection pools is kept
+    between jobs.
+    """
+    def execute_job(self, job):
+        self.perform_job(job)
+
+
+class StoreBatchMixin(object):
+    """
+    Drains up to STORE_BATCH_SIZE store_entries jobs at once from a queue
+    and performs them with a single store_entries_batch() call.
+
+    If the batch fails, jobs are performed one by one so that failures are
+    attributed to the right job.
+
+    The worker only enqueues the dependents of the job it dequeued, the
+    dependents of the other jobs of a batch are enqueued here.
+    """
+    store_func_name = '{0}.{1}'.format(store_entries.__module__,
+                                       store_entries.__name__)
+
+    def execute_job(self, job):
+        self._batch = [job]
+        if job.func_name == self.store_func_name:
+            queue = self.queue_class(job.origin, connection=self.connection)
+            while len(self._batch) < settings.STORE_BATCH_SIZE:
+                other = queue.dequeue()
+                if other is None:
+                    break
+                if other.func_name != self.store_func_name:
+                    # Put it back where it was
+                    self.connection.lpush(queue.key, other.id)
+                    break
+                self._batch.append(other)
+        return super(StoreBatchMixin, self).execute_job(job)
+
+    def perform_job(self, job):
+        batch, self._batch = getattr(self, '_batch', [job]), [job]
+        if len(batch) == 1:
+            return super(StoreBatchMixin, self).perform_job(job)
+
+        self.set_state('busy')
+        self.set_current_job_id(job.id)
+        timeout = sum(j.timeout or self.queue_class.DEFAULT_TIMEOUT
+                      for j in batch)
+        self.heartbeat(timeout + 60)
+        self.procline('Processing a batch of {0} jobs from {1}'.format(
+            len(batch), job.origin))
+        try:
+            with self.death_penalty_class(timeout):
+                store_entries_batch([j.args for j in batch])
+        except Exception:
+            self.log.exception("Batch of {0} jobs failed, retrying them "
+                               "one by one".format(len(batch)))
+            results = [super(StoreBatchMixin, self).perform_job(j)
+                       for j in batch]
+            self.enqueue_dependents(
+                [j for j, ok in zip(batch[1:], results[1:]) if ok])
+            return all(results)
+
+        with self.connection._pipeline() as pipeline:
+            self.set_current_job_id(None, pipeline=pipeline)
+            for j in batch:
+                j._result = None
+                j._status = Status.FINISHED
+                result_ttl = j.get_ttl(self.default_result_ttl)
+                if result_ttl != 0:
+                    j.save(pipeline=pipeline)
+                j.cleanup(result_ttl, pipeline=pipeline)
+            pipeline.execute()
+        self.enqueue_dependents(batch[1:])
+        self.log.info('Batch of {0} jobs OK'.format(len(batch)))
+        return True
+
+    def enqueue_dependents(self, jobs):
+        for j in jobs:
+            queue = self.queue_class(j.origin, connection=self.connection)
+            queue.enqueue_dependents(j)
+
+
+class StoreBatchWorker(StoreBatchMixin, Worker):
+    pass
+
+
+class NonForkingStoreBatchWorker(StoreBatchMixin, NonForkingWorker):
+    pass
+
+
 class Command(SentryCommand):
     args = '<queue1 queue2 ...>'
     option_list = SentryCommand.option_list + (
         make_option('--burst', action='store_true', dest='burst',
                     default=False, help='Run the worker in burst mode'),
+        make_option('--no-fork', action='store_true', dest='no_fork',
+                    default=False,
+                    help="Don't fork a work horse for each job"),
+        make_option('--batch-store', action='store_true', dest='batch_store',
+                    default=False,
+                    help='Perform store_entries jobs in batches'),
     )
     help = "Run a RQ worker on selected queues."
 
@@ -38,5 +138,11 @@ class Command(SentryCommand):
         conn = get_redis_connection()
         with Connection(conn):
             queues = map(Queue, args)
-            worker = Worker(queues, exc_handler=sentry_handler)
+            worker_class = {
+                (False, False): Worker,
+                (True, False): NonForkingWorker,
+                (False, True): StoreBatchWorker,
+                (True, True): NonForkingStoreBatchWorker,
+            }[options['no_fork'], options['batch_store']]
+            worker = worker_class(queues, exc_handler=sentry_handler)
             worker.work(burst=options['burst'])
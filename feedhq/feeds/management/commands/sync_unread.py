@@ -0,0 +1,21 @@
+import logging
+
+from . import SentryCommand
+from ....profiles.models import User
+from ....utils import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+
+class Command(SentryCommand):
+    """Fixes drift between unread counters and ES."""
+    def handle_sentry(self, **options):
+        redis = get_redis_connection()
+        count = 0
+        for user in User.objects.only('pk').iterator():
+            # Missing counters are built on demand, only fix existing ones.
+            if not redis.exists(user.unread_key):
+                continue
+            user.refresh_unread_counts()
+            count += 1
+        logger.info("Reconciled unread counts of {0} users".format(count))
@@ -1,12 +1,16 @@
 import logging
 
+from optparse import make_option
+
+from django.conf import settings
+from more_itertools import chunked
 from rache import pending_jobs
 from rq import Queue
 
 from ....tasks import enqueue
 from ....utils import get_redis_connection
 from ...models import UniqueFeed
-from ...tasks import update_feed
+from ...tasks import update_feed, update_feeds
 from . import SentryCommand
 
 logger = logging.getLogger(__name__)
@@ -14,6 +18,17 @@ logger = logging.getLogger(__name__)
 
 class Command(SentryCommand):
     """Updates the users' feeds"""
+    option_list = SentryCommand.option_list + (
+        make_option(
+            '--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=0,
+            help='Enqueue feeds in batches of this size. Batches are '
+                 'fetched concurrently by the workers.',
+        ),
+    )
 
     def handle_sentry(self, *args, **kwargs):
         if args:
@@ -25,7 +40,9 @@ class Command(SentryCommand):
                 subscribers=data.get('subscribers', 1),
                 backoff_factor=data['backoff_factor'], error=data.get('error'),
                 link=data.get('link'), title=data.get('title'),
-                hub=data.get('hub'),
+                hub=data.get('hub'), digest=data.get('digest'),
+                cadence=data.get('cadence'),
+                last_entry=data.get('last_entry'),
             )
 
         ratio = UniqueFeed.UPDATE_PERIOD // 5
@@ -45,6 +62,20 @@ class Command(SentryCommand):
         jobs = pending_jobs(limit=limit,
                             reschedule_in=UniqueFeed.UPDATE_PERIOD * 60,
                             connection=get_redis_connection())
+
+        batch_size = kwargs['batch_size']
+        if batch_size:
+            for batch in chunked(jobs, batch_size):
+                for job in batch:
+                    job.pop('last_update', None)
+                # Requests are made in parallel, the slowest feeds of each
+                # round of requests set the pace.
+                rounds = len(batch) // settings.FETCH_CONCURRENCY + 1
+                timeout = UniqueFeed.TIMEOUT_BASE * rounds * max(
+                    job.get('backoff_factor', 1) for job in batch)
+                enqueue(update_feeds, args=[batch], timeout=timeout)
+            return
+
         for job in jobs:
             url = job.pop('id')
             job.pop('last_update', None)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import base64
 import bleach
+import calendar
 import datetime
 import feedparser
 import hashlib
@@ -8,6 +9,7 @@ import json
 import logging
 import lxml.html
 import magic
+import math
 import random
 import requests
 import six
@@ -15,6 +17,8 @@ import socket
 import struct
 import time
 
+from multiprocessing.pool import ThreadPool
+
 from django.db import models
 from django.conf import settings
 from django.core.cache import cache
@@ -35,17 +39,19 @@ from requests.exceptions import ConnectionError
 from requests.packages.urllib3.exceptions import (LocationParseError,
                                                   DecodeError)
 from requests_oauthlib import OAuth1
+from rq.timeouts import JobTimeoutException
 from six.moves.http_client import IncompleteRead
 from six.moves.urllib import parse as urlparse
 from urlobject import URLObject
 
 import pytz
 
+from . import fetcher, parsing
 from .fields import URLField
 from .tasks import (update_feed, update_favicon, store_entries,
                     ensure_subscribed)
-from .utils import (FAVICON_FETCHER, USER_AGENT, is_feed, epoch_to_utc,
-                    get_job, JobNotFound)
+from .utils import (FAVICON_FETCHER, USER_AGENT, epoch_to_utc, get_job,
+                    JobNotFound)
 from .. import es
 from ..storage import OverwritingStorage
 from ..tasks import enqueue
@@ -140,18 +146,143 @@ class Category(models.Model):
 class UniqueFeedManager(models.Manager):
     def update_feed(self, url, etag=None, last_modified=None, subscribers=1,
                     backoff_factor=1, previous_error=None, link=None,
-                    title=None, hub=None):
+                    title=None, hub=None, digest=None, cadence=None,
+                    last_entry=None):
         url = URLObject(url)
-        # Check if this domain has rate-limiting rules
-        ratelimit_key = 'ratelimit:{0}'.format(
-            url.netloc.without_auth().without_port())
-        retry_at = cache.get(ratelimit_key)
+        if self.is_ratelimited(url) or self.is_throttled(url):
+            return
+        result = self.fetch(url, etag=etag, last_modified=last_modified,
+                            subscribers=subscribers,
+                            backoff_factor=backoff_factor)
+        self.process_response(url, result, backoff_factor=backoff_factor,
+                              previous_error=previous_error, link=link,
+                              title=title, hub=hub, digest=digest,
+                              cadence=cadence, last_entry=last_entry)
+
+    def update_feeds(self, jobs, concurrency=None, parse_processes=None):
+        """
+        Batched version of update_feed(). ``jobs`` is a list of scheduler
+        jobs as returned by rache's pending_jobs().
+
+        HTTP requests are made concurrently in a thread pool, responses are
+        processed sequentially as they come in. With ``parse_processes``,
+        feeds are parsed in a pool of processes as soon as they're fetched.
+        The pool is started before the fetch threads and never forks again
+        during the batch: if a stuck document kills it, the remaining feeds
+        are parsed inline.
+        """
+        if concurrency is None:
+            concurrency = settings.FETCH_CONCURRENCY
+        if parse_processes is None:
+            parse_processes = settings.PARSE_PROCESSES
+        jobs = [job for job in jobs
+                if not self.is_ratelimited(URLObject(job['id'])) and
+                not self.is_throttled(URLObject(job['id']))]
+        if not jobs:
+            return
+
+        parser = None
+        if parse_processes:
+            parser = parsing.ParserPool(
+                parse_processes, timeout=settings.PARSE_TIMEOUT,
+                memory_limit=settings.PARSE_MEMORY_LIMIT)
+            parser.start()
+
+        def fetch(job):
+            result = self.fetch(
+                URLObject(job['id']), etag=job.get('etag'),
+                last_modified=job.get('modified'),
+                subscribers=job.get('subscribers', 1),
+                backoff_factor=job.get('backoff_factor', 1))
+            parsed = None
+            if parser is not None:
+                parsed = self.preparse(result, job.get('digest'), parser)
+            return job, result, parsed
+
+        pool = ThreadPool(max(1, min(concurrency, len(jobs))))
+        try:
+            for job, result, parsed in pool.imap_unordered(fetch, jobs):
+                try:
+                    self.process_response(
+                        URLObject(job['id']), result,
+                        backoff_factor=job.get('backoff_factor', 1),
+                        previous_error=job.get('error'),
+                        link=job.get('link'), title=job.get('title'),
+                        hub=job.get('hub'), digest=job.get('digest'),
+                        cadence=job.get('cadence'),
+                        last_entry=job.get('last_entry'), parsed=parsed)
+                except JobTimeoutException:
+                    raise
+                except Exception:
+                    # Don't let a single feed abort the rest of the batch
+                    logger.exception(u"Error updating {0}".format(job['id']))
+        finally:
+            pool.terminate()
+            pool.join()
+            if parser is not None:
+                parser.close()
+
+    def preparse(self, result, digest, parser):
+        """
+        Parses a fetched feed with ``parser`` if process_response() is going
+        to need it. Returns the parsed feed, the parsing error or None.
+        """
+        response, elapsed, exception = result
+        if exception is not None or response.status_code not in [200, 204]:
+            return
+        try:
+            content = response.content or ' '
+        except socket.timeout:
+            return
+        if parsing.digest(content) == digest:
+            return
+        try:
+            return parser.parse(content)
+        except (parsing.NotAFeed, parsing.ParseError) as e:
+            return e
+
+    def ratelimit_key(self, url):
+        return 'ratelimit:{0}'.format(url.netloc.without_auth().without_port())
+
+    def is_ratelimited(self, url):
+        """
+        Checks if this domain has rate-limiting rules and reschedules the
+        feed if it does.
+        """
+        retry_at = cache.get(self.ratelimit_key(url))
         if retry_at:
             retry_in = (epoch_to_utc(retry_at) - timezone.now()).seconds
             schedule_job(url, schedule_in=retry_in,
                          connection=get_redis_connection())
-            return
+            return True
+        return False
 
+    def is_throttled(self, url):
+        """
+        Checks if too many requests are being made to this domain and defers
+        the feed if there are.
+        """
+        host = url.netloc.without_auth().without_port()
+        wait = fetcher.take_token(host)
+        if wait:
+            # Spread deferred jobs instead of retrying them all at once
+            retry_in = int(math.ceil(wait)) + random.randint(0, 30)
+            logger.debug(u"Deferring {0} by {1}s".format(url, retry_in))
+            schedule_job(url, schedule_in=retry_in,
+                         connection=get_redis_connection())
+            return True
+        return False
+
+    def fetch(self, url, etag=None, last_modified=None, subscribers=1,
+              backoff_factor=1):
+        """
+        Makes the HTTP request for a feed. This does no database or redis
+        access so it can safely run in a thread pool.
+
+        Returns a (response, elapsed, exception) tuple. Network errors are
+        returned instead of being raised and are dealt with by
+        process_response().
+        """
         if subscribers == 1:
             subscribers_text = '1 subscriber'
         else:
@@ -168,8 +299,8 @@ class UniqueFeedManager(models.Manager):
             headers['If-None-Match'] = force_bytes(etag)
 
         if settings.TESTS:
-            # Make sure requests.get is properly mocked during tests
-            if str(type(requests.get)) != "<class 'mock.MagicMock'>":
+            # Make sure fetcher.get is properly mocked during tests
+            if str(type(fetcher.get)) != "<class 'mock.MagicMock'>":
                 raise ValueError("Not Mocked")
 
         auth = None
@@ -177,28 +308,42 @@ class UniqueFeedManager(models.Manager):
             auth = url.auth
 
         start = datetime.datetime.now()
-        error = None
         try:
-            response = requests.get(
+            response = fetcher.get(
                 six.text_type(url.without_auth()), headers=headers, auth=auth,
                 timeout=UniqueFeed.request_timeout(backoff_factor))
         except (requests.RequestException, socket.timeout, socket.error,
-                IncompleteRead, DecodeError) as e:
-            logger.debug("Error fetching %s, %s" % (url, str(e)))
-            if isinstance(e, IncompleteRead):
+                IncompleteRead, DecodeError, LocationParseError) as e:
+            return None, None, e
+        elapsed = (datetime.datetime.now() - start).seconds
+        return response, elapsed, None
+
+    def process_response(self, url, result, backoff_factor=1,
+                         previous_error=None, link=None, title=None,
+                         hub=None, digest=None, cadence=None,
+                         last_entry=None, parsed=None):
+        """
+        Handles the result of fetch(). ``parsed`` is the result of parsing
+        the feed, as returned by preparse(), if it's been done already.
+        """
+        response, elapsed, exception = result
+        error = None
+        if isinstance(exception, LocationParseError):
+            logger.debug(u"Failed to parse URL for {0}".format(url))
+            self.mute_feed(url, UniqueFeed.PARSE_ERROR)
+            return
+        elif exception is not None:
+            logger.debug("Error fetching %s, %s" % (url, str(exception)))
+            if isinstance(exception, IncompleteRead):
                 error = UniqueFeed.CONNECTION_ERROR
-            elif isinstance(e, DecodeError):
+            elif isinstance(exception, fetcher.ResponseTooLarge):
+                error = UniqueFeed.TOO_LARGE
+            elif isinstance(exception, DecodeError):
                 error = UniqueFeed.DECODE_ERROR
             else:
                 error = UniqueFeed.TIMEOUT
             self.backoff_feed(url, error, backoff_factor)
             return
-        except LocationParseError:
-            logger.debug(u"Failed to parse URL for {0}".format(url))
-            self.mute_feed(url, UniqueFeed.PARSE_ERROR)
-            return
-
-        elapsed = (datetime.datetime.now() - start).seconds
 
         ctype = response.headers.get('Content-Type', None)
         if (response.history and
@@ -239,7 +384,7 @@ class UniqueFeedManager(models.Manager):
                 retry_in = int(response.headers.get('Retry-After', 60))
                 retry_at = timezone.now() + datetime.timedelta(
                     seconds=retry_in)
-                cache.set(ratelimit_key,
+                cache.set(self.ratelimit_key(url),
                           int(retry_at.strftime('%s')),
                           retry_in)
                 schedule_job(url, schedule_in=retry_in)
@@ -253,9 +398,16 @@ class UniqueFeedManager(models.Manager):
             backoff_factor = min(backoff_factor, self.safe_backoff(elapsed))
             update['backoff_factor'] = backoff_factor
 
+        # Unchanged feeds keep their cadence, aged by the time since their
+        # last entry.
+        cadence = self.aged_cadence(cadence, last_entry)
+        if cadence is not None:
+            update['cadence'] = cadence
+
         if response.status_code == 304:
             schedule_job(url,
-                         schedule_in=UniqueFeed.delay(backoff_factor, hub),
+                         schedule_in=UniqueFeed.delay(backoff_factor, hub,
+                                                      cadence),
                          connection=get_redis_connection(), **update)
             return
 
@@ -279,26 +431,38 @@ class UniqueFeedManager(models.Manager):
             self.backoff_feed(url, UniqueFeed.TIMEOUT, backoff_factor)
             return
 
-        parsed = feedparser.parse(content)
+        # Lots of feeds don't support conditional requests. Skip parsing
+        # and storing entries if the content hasn't changed.
+        update['digest'] = parsing.digest(content)
+        if update['digest'] == digest:
+            schedule_job(url,
+                         schedule_in=UniqueFeed.delay(backoff_factor, hub,
+                                                      cadence),
+                         connection=get_redis_connection(), **update)
+            return
 
-        if not is_feed(parsed):
+        try:
+            if parsed is None:
+                parsed = parsing.parse(content)
+            elif isinstance(parsed, Exception):
+                raise parsed
+        except parsing.NotAFeed:
             self.backoff_feed(url, UniqueFeed.NOT_A_FEED,
                               UniqueFeed.MAX_BACKOFF)
             return
+        except parsing.ParseError as e:
+            logger.debug(u"Error parsing {0}, {1}".format(url, e))
+            self.backoff_feed(url, UniqueFeed.UNPARSEABLE, backoff_factor)
+            return
 
-        if 'link' in parsed.feed and parsed.feed.link != link:
-            update['link'] = parsed.feed.link
+        if parsed['link'] is not None and parsed['link'] != link:
+            update['link'] = parsed['link']
 
-        if 'title' in parsed.feed and parsed.feed.title != title:
-            update['title'] = parsed.feed.title
+        if parsed['title'] is not None and parsed['title'] != title:
+            update['title'] = parsed['title']
 
-        if 'links' in parsed.feed:
-            for link in parsed.feed.links:
-                if link.rel == 'hub':
-                    update['hub'] = link.href
-        if 'hub' not in update:
-            update['hub'] = None
-        else:
+        update['hub'] = parsed['hub']
+        if update['hub'] is not None:
             subs_key = u'pshb:{0}'.format(url)
             enqueued = cache.get(subs_key)
             if not enqueued and not settings.DEBUG:
@@ -306,18 +470,20 @@ class UniqueFeedManager(models.Manager):
                 enqueue(ensure_subscribed, args=[url, update['hub']],
                         queue='low')
 
+        update['cadence'] = self.publish_cadence(parsed['entries'])
+        dates = [entry['date'] for entry in parsed['entries']
+                 if not entry['date_generated']]
+        if dates:
+            update['last_entry'] = calendar.timegm(max(dates).utctimetuple())
         schedule_job(url,
                      schedule_in=UniqueFeed.delay(
                          update.get('backoff_factor', backoff_factor),
-                         update['hub']),
+                         update['hub'], update['cadence']),
                      connection=get_redis_connection(), **update)
 
-        entries = list(filter(
-            None,
-            [self.entry_data(entry, parsed) for entry in parsed.entries]
-        ))
-        if len(entries):
-            enqueue(store_entries, args=[url, entries], queue='store')
+        if parsed['entries']:
+            enqueue(store_entries, args=[url, parsed['entries']],
+                    queue='store')
 
     @classmethod
     def entry_data(cls, entry, parsed):
@@ -385,6 +551,35 @@ class UniqueFeedManager(models.Manager):
                 entry_date = timezone.now()
         return entry_date, date_generated
 
+    @classmethod
+    def publish_cadence(cls, entries):
+        """
+        Estimates the number of seconds between two entries of a feed from
+        the dates of its last entries. Returns None if there aren't enough
+        dated entries.
+        """
+        dates = sorted([entry['date'] for entry in entries
+                        if not entry['date_generated']], reverse=True)
+        dates = dates[:UniqueFeed.CADENCE_ENTRIES]
+        if len(dates) < 2:
+            return
+        interval = timedelta_to_seconds(dates[0] - dates[-1]) // (
+            len(dates) - 1)
+        # Feeds that stopped publishing are checked less often
+        return int(max(interval,
+                       timedelta_to_seconds(timezone.now() - dates[0])))
+
+    @classmethod
+    def aged_cadence(cls, cadence, last_entry):
+        """
+        Cadence of a feed that hasn't changed since its entries were last
+        parsed. ``last_entry`` is the timestamp of its latest entry: feeds
+        that stopped publishing drift towards MAX_UPDATE_PERIOD.
+        """
+        if last_entry is None:
+            return cadence
+        return int(max(cadence or 0, time.time() - last_entry))
+
     def handle_redirection(self, old_url, new_url):
         logger.debug(u"{0} moved to {1}".format(old_url, new_url))
         Feed.objects.filter(url=old_url).update(url=new_url)
@@ -473,6 +668,8 @@ class UniqueFeed(JobDataMixin, models.Model):
     CONNECTION_ERROR = 'connerror'
     DECODE_ERROR = 'decodeerror'
     NOT_A_FEED = 'notafeed'
+    UNPARSEABLE = 'unparseable'
+    TOO_LARGE = 'toolarge'
     HTTP_400 = '400'
     HTTP_401 = '401'
     HTTP_403 = '403'
@@ -487,6 +684,8 @@ class UniqueFeed(JobDataMixin, models.Model):
         (CONNECTION_ERROR, 'Connection error'),
         (DECODE_ERROR, 'Decoding error'),
         (NOT_A_FEED, 'Not a valid RSS/Atom feed'),
+        (UNPARSEABLE, 'Parsing timed out or ran out of memory'),
+        (TOO_LARGE, 'Feed too large'),
         (HTTP_400, 'HTTP 400'),
         (HTTP_401, 'HTTP 401'),
         (HTTP_403, 'HTTP 403'),
@@ -506,10 +705,13 @@ class UniqueFeed(JobDataMixin, models.Model):
 
     MAX_BACKOFF = 10  # Approx. 24 hours
     UPDATE_PERIOD = 60  # in minutes
+    MAX_UPDATE_PERIOD = 12 * 60  # for feeds that rarely publish
+    CADENCE_ENTRIES = 10
     BACKOFF_EXPONENT = 1.5
     TIMEOUT_BASE = 20
     JOB_ATTRS = ['modified', 'etag', 'backoff_factor', 'error', 'link',
-                 'title', 'hub', 'subscribers', 'last_update']
+                 'title', 'hub', 'subscribers', 'last_update', 'digest',
+                 'cadence', 'last_entry']
 
     def __str__(self):
         return u'%s' % self.url
@@ -526,18 +728,28 @@ class UniqueFeed(JobDataMixin, models.Model):
         return 10 * backoff_factor
 
     @classmethod
-    def delay(cls, backoff_factor, hub=None):
+    def delay(cls, backoff_factor, hub=None, cadence=None):
+        """
+        Time until the next update. ``cadence`` is the average number of
+        seconds between two entries: feeds that publish less than twice per
+        UPDATE_PERIOD are checked twice per cadence, up to
+        MAX_UPDATE_PERIOD.
+        """
         if hub is not None:
             backoff_factor = max(backoff_factor, 3)
-        return datetime.timedelta(
-            seconds=60 * cls.UPDATE_PERIOD *
-            backoff_factor ** cls.BACKOFF_EXPONENT)
+        seconds = (60 * cls.UPDATE_PERIOD *
+                   backoff_factor ** cls.BACKOFF_EXPONENT)
+        if cadence:
+            seconds = max(seconds,
+                          min(cadence // 2, 60 * cls.MAX_UPDATE_PERIOD))
+        return datetime.timedelta(seconds=seconds)
 
     @property
     def schedule_in(self):
         return (
             self.last_update + self.delay(self.job_details['backoff_factor'],
-                                          self.job_details.get('hub'))
+                                          self.job_details.get('hub'),
+                                          self.job_details.get('cadence'))
         ) - timezone.now()
 
     def schedule(self, schedule_in=None, **job):
@@ -644,6 +856,19 @@ class EntryManager(models.Manager):
         return self.filter(read=False).count()
 
 
+def absolute_links(html, base_url):
+    """Makes the links in an HTML fragment absolute."""
+    if not html:
+        return html
+    xml = lxml.html.fromstring(html)
+    try:
+        xml.make_links_absolute(base_url)
+    except ValueError as e:
+        if e.args[0] != 'Invalid IPv6 URL':
+            raise
+    return lxml.html.tostring(xml).decode('utf-8')
+
+
 class BaseEntry(object):
     ELEMENTS = (
         feedparser._HTMLSanitizer.acceptable_elements |
@@ -657,6 +882,12 @@ class BaseEntry(object):
         feedparser._HTMLSanitizer.svg_attributes
     ) - set(['id', 'class'])
     CSS_PROPERTIES = feedparser._HTMLSanitizer.acceptable_css_properties
+    MEDIA_ELEMENTS = set(['img', 'audio', 'video', 'iframe', 'object',
+                          'embed', 'script', 'source'])
+    # Content is sanitized when entries are stored. Bump this when the
+    # whitelists above change, entries sanitized with another version are
+    # sanitized at render time until resanitize is run.
+    SANITIZER_VERSION = 1
 
     @property
     def hex_pk(self):
@@ -672,16 +903,7 @@ class BaseEntry(object):
     @property
     def content(self):
         if not hasattr(self, '_content'):
-            if self.subtitle:
-                xml = lxml.html.fromstring(self.subtitle)
-                try:
-                    xml.make_links_absolute(self.feed.url)
-                except ValueError as e:
-                    if e.args[0] != 'Invalid IPv6 URL':
-                        raise
-                self._content = lxml.html.tostring(xml).decode('utf-8')
-            else:
-                self._content = self.subtitle
+            self._content = absolute_links(self.subtitle, self.feed.url)
         return self._content
 
     def sanitized_title(self):
@@ -690,24 +912,45 @@ class BaseEntry(object):
                                                   strip=True))
         return _('(No title)')
 
-    def sanitized_content(self):
+    def sanitize(self, content, media=True):
+        tags = self.ELEMENTS
+        if not media:
+            tags = tags - self.MEDIA_ELEMENTS
         return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS,
+            content,
+            tags=tags,
             attributes=self.ATTRIBUTES,
             styles=self.CSS_PROPERTIES,
             strip=True,
         )
 
+    def sanitized_fields(self, base_url):
+        """
+        Document fields holding the sanitized variants of the content, links
+        being made absolute against ``base_url``.
+        """
+        content = absolute_links(self.subtitle, base_url) or ''
+        return {
+            'safe_content': self.sanitize(content),
+            'safe_nomedia_content': self.sanitize(content, media=False),
+            'sanitizer': self.SANITIZER_VERSION,
+        }
+
+    def _presanitized(self, field):
+        if getattr(self, 'sanitizer', None) == self.SANITIZER_VERSION:
+            return getattr(self, field, None)
+
+    def sanitized_content(self):
+        content = self._presanitized('safe_content')
+        if content is None:
+            content = self.sanitize(self.content)
+        return content
+
     def sanitized_nomedia_content(self):
-        return bleach.clean(
-            self.content,
-            tags=self.ELEMENTS - set(['img', 'audio', 'video', 'iframe',
-                                      'object', 'embed', 'script', 'source']),
-            attributes=self.ATTRIBUTES,
-            styles=self.CSS_PROPERTIES,
-            strip=True,
-        )
+        content = self._presanitized('safe_nomedia_content')
+        if content is None:
+            content = self.sanitize(self.content, media=False)
+        return content
 
     def get_absolute_url(self):
         return reverse('feeds:item', args=[self.pk])
@@ -827,7 +1070,7 @@ class Entry(BaseEntry, models.Model):
     def __str__(self):
         return u'%s' % self.title
 
-    def serialize(self):
+    def serialize(self, base_url=None):
         data = {
             '_type': 'entries',
             '_id': self.pk,
@@ -851,13 +1094,24 @@ class Entry(BaseEntry, models.Model):
             data['feed'] = self.feed_id
         if self.feed and self.feed.category_id:
             data['category'] = self.feed.category_id
+        if base_url is None and self.feed:
+            base_url = self.feed.url
+        if base_url is not None:
+            data.update(self.sanitized_fields(base_url))
         return data
 
     def index(self):
-        name = es.user_alias(self.user_id)
-        data = es.client.index(name, doc_type='entries', body=self.serialize(),
-                               id=self.pk, params={'refresh': True})
-        data['_source'] = self.serialize()
+        if settings.ES_PARTITIONS:
+            name = es.write_index()
+        else:
+            name = es.user_alias(self.user_id)
+        source = self.serialize()
+        data = es.client.index(name, doc_type='entries', body=source,
+                               id=self.pk, params=es.doc_params(
+                                   self.user_id, refresh=True))
+        if not self.read:
+            self.user.incr_unread({self.feed_id: 1})
+        data['_source'] = source
         data['_id'] = int(data['_id'])
         return EsEntry(data)
 
@@ -868,6 +1122,7 @@ class EsEntry(BaseEntry):
         'feed', 'category', 'guid', 'tags', 'read', 'timestamp', 'author',
         'broadcast', 'date', 'link', 'title', 'starred',
         'read_later_url', 'pk', 'subtitle', '_content', 'user',
+        'safe_content', 'safe_nomedia_content', 'sanitizer', '_index',
     )
 
     def __repr__(self):
@@ -879,6 +1134,7 @@ class EsEntry(BaseEntry):
             entry['_id'] = int(entry['_id'])
 
         self.pk = entry['_id']
+        self._index = entry.get('_index')
         self.subtitle = entry['_source'].pop('content', None)
         for key, value in entry['_source'].items():
             setattr(self, key, value)
@@ -892,16 +1148,35 @@ class EsEntry(BaseEntry):
     def __str__(self):
         return u'%s' % self.title
 
+    @property
+    def cursor(self):
+        """Sort values of the entry in the default ordering."""
+        millis = (calendar.timegm(self.date.utctimetuple()) * 1000 +
+                  self.date.microsecond // 1000)
+        return [millis, self.pk]
+
     def update(self, refresh=False, **attrs):
+        deltas = {}
+        if 'read' in attrs and attrs['read'] != self.read:
+            feed = getattr(self.feed, 'pk', self.feed)
+            deltas[feed] = -1 if attrs['read'] else 1
         for key, value in attrs.items():
             setattr(self, key, value)
-        es.client.update(es.user_alias(self.user.pk), doc_type='entries',
-                         id=self.pk, body={'doc': attrs},
-                         params={'refresh': refresh})
+        # Forced refreshes are replaced with the pending writes overlay
+        overlay = refresh and settings.ES_WRITE_OVERLAY
+        es.client.update(es.doc_index(self.user.pk, self._index),
+                         doc_type='entries', id=self.pk,
+                         body={'doc': attrs}, params=es.doc_params(
+                             self.user.pk, refresh=refresh and not overlay))
+        if overlay:
+            es.add_pending(self.user.pk, [self.pk], attrs)
+        if deltas:
+            self.user.incr_unread(deltas)
 
     def delete(self):
-        es.client.delete(es.user_alias(self.user.pk), doc_type='entries',
-                         id=self.pk)
+        es.client.delete(es.doc_index(self.user.pk, self._index),
+                         doc_type='entries', id=self.pk,
+                         params=es.doc_params(self.user.pk))
 
 
 def pubsubhubbub_update(notification, request, links, **kwargs):
@@ -969,7 +1244,7 @@ class FaviconManager(models.Manager):
             return favicon
 
         try:
-            page = requests.get(link, headers=ua, timeout=10).content
+            page = fetcher.get(link, headers=ua, timeout=10).content
         except (requests.RequestException, LocationParseError, socket.timeout,
                 DecodeError, ConnectionError):
             return favicon
@@ -993,8 +1268,8 @@ class FaviconManager(models.Manager):
             parsed[3] = parsed[4] = parsed[5] = ''
             icon_path = [urlparse.urlunparse(parsed)]
         try:
-            response = requests.get(icon_path[0], headers=ua, timeout=10)
-        except requests.RequestException:
+            response = fetcher.get(icon_path[0], headers=ua, timeout=10)
+        except (requests.RequestException, socket.timeout, DecodeError):
             return favicon
         if response.status_code != 200:
             return favicon
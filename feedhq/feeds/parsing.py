@@ -0,0 +1,146 @@
+"""
+Feed parsing, optionally offloaded to a pool of processes.
+
+Parsing is CPU-bound and can't benefit from the threads used for fetching
+feeds concurrently. A ParserPool spreads it across processes so a single
+fetch worker can use all cores, and kills pathological documents that take
+too long or too much memory to parse.
+"""
+import hashlib
+import multiprocessing
+import resource
+import threading
+
+import feedparser
+
+from django.utils.encoding import force_bytes
+
+from .utils import is_feed
+
+
+class NotAFeed(Exception):
+    pass
+
+
+class ParseError(Exception):
+    """Parsing timed out or ran out of memory."""
+    pass
+
+
+def digest(content):
+    return hashlib.sha1(force_bytes(content)).hexdigest()
+
+
+def parse(content):
+    """
+    Parses a feed document. The result only contains plain python objects
+    so it can be sent back from a parser process.
+    """
+    from .models import UniqueFeedManager
+    parsed = feedparser.parse(content)
+    if not is_feed(parsed):
+        raise NotAFeed
+
+    hub = None
+    for link in parsed.feed.get('links', []):
+        if link.rel == 'hub':
+            hub = link.href
+
+    return {
+        'link': parsed.feed.get('link'),
+        'title': parsed.feed.get('title'),
+        'hub': hub,
+        'entries': list(filter(None, [
+            UniqueFeedManager.entry_data(entry, parsed)
+            for entry in parsed.entries
+        ])),
+    }
+
+
+def _address_space():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+
+def _init_parser(memory_limit):
+    if memory_limit:
+        # Parser processes are forked from the worker and start with its
+        # address space, the limit is on top of it.
+        try:
+            limit = _address_space() + memory_limit * 1024 * 1024
+        except (IOError, OSError):  # no procfs
+            return
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class ParserPool(object):
+    """
+    A pool of parser processes. ``parse()`` is thread-safe and blocks until
+    the document is parsed.
+
+    Processes are forked by ``start()``, which must be called from the main
+    thread before other threads are started: a process forked while another
+    thread holds a lock inherits it locked. For the same reason processes
+    aren't recycled and a pool killed because of a stuck document isn't
+    replaced, ``parse()`` leaves documents to the caller from then on.
+
+    :param processes: number of parser processes.
+    :param timeout: seconds after which a parse is aborted.
+    :param memory_limit: megabytes of memory available to each process.
+    :param maxtasksperchild: number of documents parsed by a process before
+                             it's replaced with a fresh one. Only safe when
+                             no other threads are running.
+    """
+    def __init__(self, processes, timeout, memory_limit=None,
+                 maxtasksperchild=None):
+        self.processes = processes
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.maxtasksperchild = maxtasksperchild
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.processes, initializer=_init_parser,
+                    initargs=(self.memory_limit,),
+                    maxtasksperchild=self.maxtasksperchild)
+
+    def _kill(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.terminate()
+
+    def parse(self, content, retry=True):
+        """
+        Returns the parsed document or None if the pool isn't running, in
+        which case it's up to the caller to parse it.
+        """
+        pool = self._pool
+        if pool is None:
+            return
+        result = pool.apply_async(parse, (content,))
+        try:
+            return result.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            if pool is not self._pool:
+                # Killed because of another document, give this one
+                # another chance.
+                if retry:
+                    return self.parse(content, retry=False)
+                raise ParseError("Parser pool was restarted")
+            # A stuck process can't be stopped without replacing the pool.
+            self._kill(pool)
+            raise ParseError("Parsing timed out")
+        except MemoryError:
+            raise ParseError("Parsing ran out of memory")
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
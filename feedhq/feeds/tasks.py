@@ -1,5 +1,7 @@
+import json
 import logging
 import requests
+import time
 
 from collections import defaultdict
 from datetime import timedelta
@@ -7,9 +9,12 @@ from datetime import timedelta
 from django.conf import settings
 from django.utils import timezone
 from django_push.subscriber.models import Subscription
+from elasticsearch import TransportError
 from rache import schedule_job
 from rq.timeouts import JobTimeoutException
 
+from . import fetcher
+from .utils import epoch_to_utc
 from .. import es
 from ..profiles.models import User
 from ..utils import get_redis_connection
@@ -20,13 +25,16 @@ logger = logging.getLogger(__name__)
 # TODO remove unused request_timeout
 def update_feed(url, etag=None, modified=None, subscribers=1,
                 request_timeout=10, backoff_factor=1, error=None, link=None,
-                title=None, hub=None):
+                title=None, hub=None, digest=None, cadence=None,
+                last_entry=None):
     from .models import UniqueFeed
     try:
         UniqueFeed.objects.update_feed(
             url, etag=etag, last_modified=modified, subscribers=subscribers,
             backoff_factor=backoff_factor, previous_error=error, link=link,
-            title=title, hub=hub)
+            title=title, hub=hub, digest=digest, cadence=cadence,
+            last_entry=last_entry)
+        fetcher.flush_pool_stats()
     except JobTimeoutException:
         backoff_factor = min(UniqueFeed.MAX_BACKOFF,
                              backoff_factor + 1)
@@ -38,6 +46,21 @@ def update_feed(url, etag=None, modified=None, subscribers=1,
                      connection=get_redis_connection())
 
 
+def update_feeds(jobs):
+    """
+    Updates a batch of feeds at once. ``jobs`` is a list of scheduler jobs
+    as returned by rache's pending_jobs().
+    """
+    from .models import UniqueFeed
+    try:
+        UniqueFeed.objects.update_feeds(jobs)
+        fetcher.flush_pool_stats()
+    except JobTimeoutException:
+        # Feeds that weren't processed have already been rescheduled by
+        # pending_jobs(), they'll be picked up on the next run.
+        logger.debug("Batch of {0} feeds timed out".format(len(jobs)))
+
+
 def read_later(user_id, entry_pk):
     user = User.objects.get(pk=user_id)
     entry = es.entry(user, entry_pk, annotate_results=False)
@@ -45,9 +68,139 @@ def read_later(user_id, entry_pk):
     entry.read_later()
 
 
+# Entries marked as read by a mark_as_read job, kept for a while so that
+# it can be undone.
+UNDO_KEY = 'user:{0}:undo:{1}'
+UNDO_TTL = 60 * 60
+
+
+def mark_as_read(user_id, es_entries, deltas=None, undo=None):
+    """
+    Marks the entries matching ``es_entries``, an EntryQuery, as read. IDs
+    are streamed and updated in chunks, regardless of how many entries
+    match. The query is evaluated when the job runs, callers bound it to the
+    entries that existed when it was enqueued.
+
+    ``deltas`` are the changes to unread counters already applied when the
+    job was enqueued. Counters are corrected with the changes actually made.
+
+    With ``undo``, the IDs of updated entries are recorded for undo_pks().
+    """
+    actual = defaultdict(int)
+    for pks in es_entries.iter_ids():
+        for feed, delta in es.read_deltas(user_id, pks, True).items():
+            actual[feed] += delta
+        ops = es.update_ops(user_id, pks, {'read': True})
+        with es.ignore_bulk_error(404, 409):
+            es.bulk(ops, raise_on_error=True, params=es.write_params())
+        es.add_pending(user_id, pks, {'read': True})
+        if undo is not None:
+            key = UNDO_KEY.format(user_id, undo)
+            with get_redis_connection().pipeline() as pipe:
+                pipe.rpush(key, *pks)
+                pipe.expire(key, UNDO_TTL)
+                pipe.execute()
+
+    deltas = deltas or {}
+    User(pk=user_id).incr_unread({
+        feed: actual.get(feed, 0) - deltas.get(feed, 0)
+        for feed in set(actual) | set(deltas)
+    })
+
+
+def undo_pks(user_id, undo):
+    """
+    The IDs of the entries marked as read so far by the mark_as_read job
+    enqueued with ``undo``. They can only be retrieved once.
+    """
+    key = UNDO_KEY.format(user_id, undo)
+    with get_redis_connection().pipeline() as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.delete(key)
+        pks, _ = pipe.execute()
+    return [int(pk) for pk in pks]
+
+
+# A delete_old run is split in shards of users processed in parallel. The
+# users left in each shard are kept in redis so that an interrupted run can
+# be resumed by running delete_old again. The RQ job of each shard is kept
+# as well: shards whose job is still queued or running are skipped when
+# resuming. Runs interrupted for longer than SWEEP_TTL are started over.
+SWEEP_KEY = 'delete_old:run'
+SWEEP_SHARDS_KEY = 'delete_old:shards'
+SWEEP_JOBS_KEY = 'delete_old:jobs'
+SWEEP_STATS_KEY = 'delete_old:last'
+SWEEP_TTL = 12 * 60 * 60
+
+
+def delete_old(shard):
+    """Deletes the expired entries of the users of a delete_old shard."""
+    if _sweep_shard(get_redis_connection(), shard):
+        finish_sweep()
+
+
+def _sweep_shard(redis, shard):
+    """Returns whether this was the last shard of the run."""
+    user_ids = redis.hget(SWEEP_SHARDS_KEY, shard)
+    if user_ids is None:  # already done
+        return False
+    user_ids = json.loads(user_ids.decode('utf-8'))
+    users = {user.pk: user for user in User.objects.filter(
+        pk__in=user_ids).only('pk', 'ttl')}
+    while user_ids:
+        user = users.get(user_ids[0])
+        deleted = user.delete_old() if user is not None else 0
+        user_ids = user_ids[1:]
+        with redis.pipeline() as pipe:
+            pipe.hincrby(SWEEP_KEY, 'users', 1)
+            pipe.hincrby(SWEEP_KEY, 'deleted', deleted)
+            if not deleted:
+                pipe.hincrby(SWEEP_KEY, 'skipped', 1)
+            if user_ids:
+                pipe.hset(SWEEP_SHARDS_KEY, shard, json.dumps(user_ids))
+            pipe.expire(SWEEP_KEY, SWEEP_TTL)
+            pipe.expire(SWEEP_SHARDS_KEY, SWEEP_TTL)
+            pipe.execute()
+
+    with redis.pipeline() as pipe:
+        pipe.hdel(SWEEP_SHARDS_KEY, shard)
+        pipe.hlen(SWEEP_SHARDS_KEY)
+        removed, remaining = pipe.execute()
+    return bool(removed and not remaining)
+
+
+def finish_sweep():
+    if settings.ES_SHARED_BODIES:
+        # Bodies of the entries deleted during this run
+        es.delete_orphan_bodies()
+    redis = get_redis_connection()
+    run = redis.hgetall(SWEEP_KEY)
+    stats = {
+        key: int(run.get(key.encode('utf-8'), 0))
+        for key in ['users', 'skipped', 'deleted']
+    }
+    stats['duration'] = int(
+        time.time() - float(run.get(b'started', time.time())))
+    with redis.pipeline() as pipe:
+        pipe.delete(SWEEP_KEY, SWEEP_JOBS_KEY)
+        pipe.delete(SWEEP_STATS_KEY)
+        pipe.hmset(SWEEP_STATS_KEY, stats)
+        pipe.execute()
+    logger.info(
+        "delete_old: deleted {deleted} entries of {users} users "
+        "({skipped} without expired entries) in {duration}s".format(**stats))
+
+
+def sweep_stats():
+    """Metrics of the last complete delete_old run."""
+    stats = get_redis_connection().hgetall(SWEEP_STATS_KEY)
+    return {key.decode('utf-8'): int(value) for key, value in stats.items()}
+
+
 def update_favicon(feed_url, force_update=False):
     from .models import Favicon
     Favicon.objects.update_favicon(feed_url, force_update=force_update)
+    fetcher.flush_pool_stats()
 
 
 def ensure_subscribed(topic_url, hub_url):
@@ -82,109 +235,114 @@ def should_skip(date, ttl):
     return date + delta < timezone.now()
 
 
-def store_entries(feed_url, entries):
-    from .models import Entry, Feed
+SEEN_KEY = u'feed_guids:{0}'
+SEEN_FEEDS_KEY = u'feed_guids:{0}:feeds'
 
-    feeds = Feed.objects.select_related('user').filter(
-        url=feed_url, user__is_suspended=False).values('pk', 'user_id',
-                                                       'category_id',
-                                                       'user__ttl')
 
-    guids = set([entry['guid'] for entry in entries])
+def seen_members(entry):
+    return [u'g:{0}'.format(entry['guid']), u't:{0}'.format(entry['title'])]
 
-    es_query = [{'or': [{'term': {'feed': feed['pk']}} for feed in feeds]}]
 
-    # When we have dates, filter the query to avoid returning the whole dataset
-    date_generated = any([e.pop('date_generated') for e in entries])
-    if not date_generated:
-        earliest = min([entry['date'] for entry in entries])
-        limit = earliest - timedelta(days=1)
-        es_query.append({'range': {'timestamp': {'gt': limit}}})
-
-    filter_by_title = len(guids) == 1 and len(entries) > 1
-    if filter_by_title:
-        # All items have the same guid. Query by title instead.
-        titles = set([entry['title'] for entry in entries])
-        es_query.append({'or': [{'term': {'raw_title': t}} for t in titles]})
-    else:
-        es_query.append({'or': [{'term': {'guid': g}} for g in guids]})
-
-    existing = None
-
-    indices = []
-    for feed in feeds:
-        indices.append(es.user_alias(feed['user_id']))
-
-    if indices:
-        es.wait_for_yellow()
-        # Make sure guid and raw_title are not analyzed before querying
-        # anything. Otherwise existing entries are never matched and things
-        # keep being inserted.
-        mappings = es.client.indices.get_field_mapping(index=",".join(indices),
-                                                       doc_type='entries',
-                                                       field='guid,raw_title')
-        for idx, mapping in mappings.items():
-            mapping = mapping['mappings']['entries']
-            for f in ['raw_title', 'guid']:
-                assert mapping[f]['mapping'][f]['index'] == 'not_analyzed'
-        existing_es = es.client.search(
-            index=",".join(indices),
-            doc_type='entries',
-            body={
-                'aggs': {
-                    'existing': {
-                        'filter': {'and': es_query},
-                        'aggs': {
-                            'feeds': {
-                                'terms': {'field': 'feed', 'size': 0},
-                                'aggs': {
-                                    'guids': {'terms': {'field': 'guid',
-                                                        'size': 0}},
-                                    'titles': {'terms': {'field': 'raw_title',
-                                                         'size': 0}},
-                                },
-                            },
-                        },
-                    },
-                },
-            },
-        )
-        existing_es = existing_es[
-            'aggregations']['existing']['feeds']['buckets']
-    else:
-        existing_es = []
-
-    existing_guids = defaultdict(set)
-    existing_titles = defaultdict(set)
-    if existing is not None:
-        for entry in existing:
-            existing_guids[entry['feed_id']].add(entry['guid'])
-            if filter_by_title:
-                existing_titles[entry['feed_id']].add(entry['title'])
-
-    existing_es_guids = defaultdict(set)
-    existing_es_titles = defaultdict(set)
-    for bucket in existing_es:
-        for sub in bucket['guids']['buckets']:
-            existing_es_guids[bucket['key']].add(sub['key'])
-        if filter_by_title:
-            for sub in bucket['titles']['buckets']:
-                existing_es_titles[bucket['key']].add(sub['key'])
+def seen_entries(feed_url, feeds, entries):
+    """
+    Looks up entries in the guids and titles seen for a feed. Returns the
+    known (guids, titles) or None if this can't be trusted for all the
+    subscribed feeds, in which case elasticsearch needs to be queried.
+    """
+    if not feeds:
+        return
+    key = SEEN_KEY.format(feed_url)
+    redis = get_redis_connection()
+    with redis.pipeline() as pipe:
+        pipe.smembers(SEEN_FEEDS_KEY.format(feed_url))
+        pipe.zcard(key)
+        pipe.zrange(key, 0, 0, withscores=True)
+        for entry in entries:
+            for member in seen_members(entry):
+                pipe.zscore(key, member)
+        results = pipe.execute()
+    synced, size, oldest = results[:3]
+    scores = results[3:]
+    if not size:
+        return
+    if not set(feed['pk'] for feed in feeds) <= set(map(int, synced)):
+        return
 
+    horizon = timezone.now() - timedelta(days=settings.SEEN_GUIDS_TTL)
+    if size >= 2 * settings.SEEN_GUIDS_MAX:
+        # Trimmed, entries seen before the oldest one left are forgotten
+        horizon = max(horizon, epoch_to_utc(oldest[0][1]))
+    guids, titles = set(), set()
+    for index, entry in enumerate(entries):
+        guid_score, title_score = scores[2 * index:2 * index + 2]
+        if guid_score is None and entry['date'] < horizon:
+            # Might have been seen before the set was trimmed
+            return
+        if guid_score is not None:
+            guids.add(entry['guid'])
+        if title_score is not None:
+            titles.add(entry['title'])
+    return guids, titles
+
+
+def remember_entries(feed_url, feeds, entries, reset=False):
+    """
+    Adds entries to the guids and titles seen for a feed and marks the
+    subscribed feeds as up to date with them. Entries seen in the last
+    SEEN_GUIDS_TTL days are kept, SEEN_GUIDS_MAX at most.
+
+    ``reset`` replaces the subscribed feeds, for when elasticsearch was
+    queried.
+    """
+    key = SEEN_KEY.format(feed_url)
+    feeds_key = SEEN_FEEDS_KEY.format(feed_url)
+    now = time.time()
+    ttl = settings.SEEN_GUIDS_TTL * 3600 * 24
+    members = []
+    for entry in entries:
+        for member in seen_members(entry):
+            members.extend([member, now])
+    with get_redis_connection().pipeline() as pipe:
+        if reset:
+            pipe.delete(feeds_key)
+        if members:
+            pipe.zadd(key, *members)
+        pipe.zremrangebyscore(key, 0, now - ttl)
+        pipe.zremrangebyrank(key, 0, -2 * settings.SEEN_GUIDS_MAX - 1)
+        pipe.sadd(feeds_key, *[feed['pk'] for feed in feeds])
+        pipe.expire(key, ttl)
+        pipe.expire(feeds_key, ttl)
+        pipe.execute()
+
+
+def entry_ops(feeds, entries, existing_guids, existing_titles,
+              filter_by_title=False, feed_url=None):
+    """
+    Builds the bulk operations for indexing new entries for all subscribed
+    feeds. Returns the operations and the dates of new entries per user.
+
+    Each entry is serialized once, documents only differ by the
+    subscriber's feed, category and user. Content is sanitized against
+    ``feed_url`` at that point so that pages don't need to.
+    """
+    from .models import Entry
+
+    serialized = {}
     ops = []
     refresh_updates = defaultdict(list)
+    write_index = es.write_index()
     for feed in feeds:
         seen_guids = set()
         seen_titles = set()
-        for entry in entries:
+        for index, entry in enumerate(entries):
             if (
                 not filter_by_title and
-                entry['guid'] in existing_es_guids[feed['pk']]
+                entry['guid'] in existing_guids[feed['pk']]
             ):
                 continue
             if (
                 filter_by_title and
-                entry['title'] in existing_es_titles[feed['pk']]
+                entry['title'] in existing_titles[feed['pk']]
             ):
                 continue
             if (
@@ -201,30 +359,208 @@ def store_entries(feed_url, entries):
                 continue
             seen_guids.add(entry['guid'])
 
-            data = Entry(**entry).serialize()
+            if index not in serialized:
+                fields = dict((key, value) for key, value in entry.items()
+                              if key != 'date_generated')
+                serialized[index] = Entry(**fields).serialize(
+                    base_url=feed_url)
+            data = dict(serialized[index])
             data['category'] = feed['category_id']
             data['feed'] = feed['pk']
-            data['_id'] = es.next_id()
-            data['id'] = data['_id']
-            data['_type'] = 'entries'
             data['user'] = feed['user_id']
-            data['_index'] = settings.ES_INDEX
+            data['_index'] = write_index
             ops.append(data)
             refresh_updates[feed['user_id']].append(entry['date'])
+    return ops, refresh_updates
+
+
+def existing_query(feeds, entries, filter_by_title):
+    """
+    Search body aggregating the stored guids and titles of ``entries`` per
+    subscribed feed.
+    """
+    es_query = [{'or': [{'term': {'feed': feed['pk']}} for feed in feeds]}]
+
+    # When we have dates, filter the query to avoid returning the whole dataset
+    date_generated = any([e.get('date_generated') for e in entries])
+    if not date_generated:
+        earliest = min([entry['date'] for entry in entries])
+        limit = earliest - timedelta(days=1)
+        es_query.append({'range': {'timestamp': {'gt': limit}}})
+
+    if filter_by_title:
+        # All items have the same guid. Query by title instead.
+        titles = set([entry['title'] for entry in entries])
+        es_query.append({'or': [{'term': {'raw_title': t}} for t in titles]})
+    else:
+        guids = set([entry['guid'] for entry in entries])
+        es_query.append({'or': [{'term': {'guid': g}} for g in guids]})
+
+    return {
+        'size': 0,
+        'aggs': {
+            'existing': {
+                'filter': {'and': es_query},
+                'aggs': {
+                    'feeds': {
+                        'terms': {'field': 'feed', 'size': 0},
+                        'aggs': {
+                            'guids': {'terms': {'field': 'guid',
+                                                'size': 0}},
+                            'titles': {'terms': {'field': 'raw_title',
+                                                 'size': 0}},
+                        },
+                    },
+                },
+            },
+        },
+    }
+
+
+def existing_entries(batch):
+    """
+    Finds which entries are already stored for each of the subscribed
+    feeds. ``batch`` is a list of ``(feed_url, feeds, entries)`` tuples.
+
+    Returns, for each tuple, the existing guids and titles per feed, whether
+    entries are matched by title and whether the lookup was done with the
+    seen entries stored in redis. Feeds needing elasticsearch are looked up
+    with a single multi-search request.
+    """
+    results = []
+    searches = []
+    for feed_url, feeds, entries in batch:
+        guids = set([entry['guid'] for entry in entries])
+        filter_by_title = len(guids) == 1 and len(entries) > 1
+        existing_es_guids = defaultdict(set)
+        existing_es_titles = defaultdict(set)
+
+        seen = seen_entries(feed_url, feeds, entries)
+        if seen is not None:
+            known_guids, known_titles = seen
+            for feed in feeds:
+                existing_es_guids[feed['pk']] = known_guids
+                existing_es_titles[feed['pk']] = known_titles
+        elif feeds and entries:
+            searches.append((
+                [es.user_alias(feed['user_id']) for feed in feeds],
+                existing_query(feeds, entries, filter_by_title),
+                existing_es_guids, existing_es_titles, filter_by_title,
+            ))
+        results.append((existing_es_guids, existing_es_titles,
+                        filter_by_title, seen is not None))
+
+    if not searches:
+        return results
+
+    es.ensure_yellow()
+    es.check_mappings(sorted(set(
+        index for indices, _, _, _, _ in searches for index in indices)))
+    body = []
+    for indices, query, _, _, _ in searches:
+        body.append({'index': ",".join(indices), 'type': 'entries'})
+        body.append(query)
+    responses = es.client.msearch(body)['responses']
+    for search, response in zip(searches, responses):
+        _, _, existing_es_guids, existing_es_titles, filter_by_title = search
+        if 'error' in response:
+            # Entries would be stored again
+            raise TransportError(500, response['error'])
+        for bucket in response[
+                'aggregations']['existing']['feeds']['buckets']:
+            for sub in bucket['guids']['buckets']:
+                existing_es_guids[bucket['key']].add(sub['key'])
+            if filter_by_title:
+                for sub in bucket['titles']['buckets']:
+                    existing_es_titles[bucket['key']].add(sub['key'])
+    return results
+
+
+# Updates the score of a member of a sorted set, unless it's already higher.
+ZADD_IF_GREATER = """
+local current = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not current or tonumber(current) < tonumber(ARGV[2]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+end
+"""
+
+
+def store_entries(feed_url, entries):
+    store_entries_batch([(feed_url, entries)])
+
+
+def store_entries_batch(batch):
+    """
+    Stores the entries of several feeds at once. ``batch`` is a list of
+    ``(feed_url, entries)`` tuples, as passed to store_entries().
+
+    Subscribed feeds are fetched in a single query, existing entries are
+    looked up with a single search, IDs are allocated in a single block and
+    new entries are indexed with a single bulk call.
+    """
+    from .models import Feed
+
+    # Entries of a feed appearing several times are deduplicated together
+    urls = []
+    feed_entries = defaultdict(list)
+    for feed_url, entries in batch:
+        if feed_url not in feed_entries:
+            urls.append(feed_url)
+        feed_entries[feed_url].extend(entries)
+
+    subscribers = defaultdict(list)
+    for feed in Feed.objects.select_related('user').filter(
+            url__in=urls, user__is_suspended=False).values(
+                'pk', 'url', 'user_id', 'category_id', 'user__ttl'):
+        subscribers[feed.pop('url')].append(feed)
+
+    ops = []
+    bodies = []
+    stored = []
+    existing = existing_entries([
+        (feed_url, subscribers[feed_url], feed_entries[feed_url])
+        for feed_url in urls
+    ])
+    for feed_url, lookup in zip(urls, existing):
+        feeds, entries = subscribers[feed_url], feed_entries[feed_url]
+        existing_guids, existing_titles, filter_by_title, seen = lookup
+        feed_ops, refresh_updates = entry_ops(
+            feeds, entries, existing_guids, existing_titles, filter_by_title,
+            feed_url=feed_url)
+        if settings.ES_SHARED_BODIES:
+            bodies.extend(es.share_bodies(feed_url, feed_ops))
+        ops.extend(feed_ops)
+        stored.append((feed_url, feeds, entries, refresh_updates, seen))
 
     if ops:
-        es.bulk(ops, raise_on_error=True)
+        for data, pk in zip(ops, es.next_ids(len(ops))):
+            data['_id'] = data['id'] = pk
+        es.bulk(bodies + ops, raise_on_error=True,
+                chunk_size=settings.STORE_BULK_SIZE)
 
         if settings.TESTS:
             # Indices are refreshed asynchronously. Refresh immediately
             # during tests.
-            indices = ",".join(set([doc['_index'] for doc in ops]))
+            indices = ",".join(set([doc['_index'] for doc in bodies + ops]))
             es.client.indices.refresh(indices)
 
+    unread = defaultdict(lambda: defaultdict(int))
+    for data in ops:
+        unread[data['user']][data['feed']] += 1
+
     redis = get_redis_connection()
-    for user_id, dates in refresh_updates.items():
-        user = User(pk=user_id)
-        new_score = float(max(dates).strftime('%s'))
-        current_score = redis.zscore(user.last_update_key, feed_url) or 0
-        if new_score > current_score:
-            redis.zadd(user.last_update_key, feed_url, new_score)
+    zadd_if_greater = redis.register_script(ZADD_IF_GREATER)
+    with redis.pipeline() as pipe:
+        for user_id, deltas in unread.items():
+            User(pk=user_id).incr_unread(deltas, pipe=pipe)
+
+        for feed_url, feeds, entries, refresh_updates, seen in stored:
+            if feeds:
+                remember_entries(feed_url, feeds, entries, reset=not seen)
+
+            for user_id, dates in refresh_updates.items():
+                user = User(pk=user_id)
+                zadd_if_greater(keys=[user.last_update_key],
+                                args=[feed_url, max(dates).strftime('%s')],
+                                client=pipe)
+        pipe.execute()
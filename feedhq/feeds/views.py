@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import opml
@@ -6,6 +7,7 @@ import re
 from collections import defaultdict
 
 from django.contrib import messages
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.core.urlresolvers import reverse, reverse_lazy
@@ -38,6 +40,11 @@ Entries are paginated.
 
 logger = logging.getLogger(__name__)
 
+# Seconds during which the neighbors of an entry are cached
+NEIGHBORS_TTL = 5 * 60
+# Number of entries cached on each side of the entry being read
+NEIGHBORS_WINDOW = 10
+
 MEDIA_RE = re.compile(
     r'.*<(img|audio|video|iframe|object|embed|script|source)\s+.*',
     re.UNICODE | re.DOTALL)
@@ -81,8 +88,8 @@ def entries_list(request, page=1, mode=None, category=None, feed=None,
     page = int(page)
     user = request.user
     es_entries = es.manager.user(request.user).defer(
-        'content', 'guid', 'tags', 'read_later_url',
-        'author', 'broadcast', 'link', 'starred',
+        'content', 'safe_content', 'safe_nomedia_content', 'body', 'guid',
+        'tags', 'read_later_url', 'author', 'broadcast', 'link', 'starred',
     ).query_aggregate('all_unread', read=False)
     if mode == 'unread':
         es_entries = es_entries.filter(read=False)
@@ -139,16 +146,21 @@ def entries_list(request, page=1, mode=None, category=None, feed=None,
             form = ReadForm(es_entries, feed, category, user,
                             pages_only=pages_only, data=request.POST)
             if form.is_valid():
-                pks = form.save()
-                undo_form = loader.render_to_string('feeds/undo_read.html', {
-                    'form': UndoReadForm(initial={
-                        'pks': json.dumps(pks, separators=(',', ':'))}),
-                    'action': request.get_full_path(),
-                }, context_instance=RequestContext(request))
+                count = form.save()
                 message = ungettext(
                     '1 entry has been marked as read.',
                     '%(value)s entries have been marked as read.',
-                    'value') % {'value': len(pks)}
+                    'value') % {'value': count}
+                if pages_only:
+                    initial = {'pks': json.dumps(form.cleaned_data['entries'],
+                                                 separators=(',', ':'))}
+                else:
+                    # Entries are marked by a job which records them
+                    initial = {'undo': form.undo}
+                undo_form = loader.render_to_string('feeds/undo_read.html', {
+                    'form': UndoReadForm(initial=initial),
+                    'action': request.get_full_path(),
+                }, context_instance=RequestContext(request))
                 messages.success(request,
                                  format_html(u"{0} {1}", message, undo_form))
 
@@ -404,28 +416,16 @@ class DeleteFeed(FeedMixin, generic.DeleteView):
 delete_feed = login_required(DeleteFeed.as_view())
 
 
-@login_required
-def item(request, entry_id):
-    entry = es.entry(request.user, entry_id)
-    if not entry.read:
-        try:
-            entry.update(read=True)
-        except ConflictError:
-            # Double click // two operations at a time. Entry has already
-            # been marked as read.
-            pass
-    back_url = request.session.get('back_url',
-                                   default=entry.feed.get_absolute_url())
-
-    # Depending on the list used to access to this page, we try to find in an
-    # intelligent way which is the previous and the next item in the list.
-
-    # This way the user has nice 'previous' and 'next' buttons that are
-    # dynamically changed
+def item_neighbors(user, entry, back_url):
+    """
+    Returns the list mode and a window of the list found at ``back_url``
+    around ``entry``: the IDs of up to NEIGHBORS_WINDOW entries on each side,
+    in list order, and whether the window reaches each end of the list.
+    """
     mode = None
     bits = back_url.split('/')
     # FIXME: The kw thing currently doesn't work with paginated content.
-    kw = {'user': request.user}
+    kw = {'user': user}
 
     if bits[1] == 'unread':
         # only unread
@@ -443,7 +443,7 @@ def item(request, entry_id):
     elif bits[1] == 'category':
         # Entries in self.feed.category
         category_slug = bits[2]
-        category = Category.objects.get(slug=category_slug, user=request.user)
+        category = Category.objects.get(slug=category_slug, user=user)
         kw = {'feed__category': category}
 
     if len(bits) > 3:
@@ -453,8 +453,7 @@ def item(request, entry_id):
         elif bits[3] == 'stars':
             kw['starred'] = True
 
-    # The previous is actually the next by date, and vice versa
-    es_entries = es.manager.user(request.user).exclude(id=entry.pk)
+    es_entries = es.manager.user(user)
     if 'feed' in kw:
         es_entries = es_entries.filter(feed=kw['feed'].pk)
     if 'read' in kw:
@@ -463,30 +462,68 @@ def item(request, entry_id):
         es_entries = es_entries.filter(category=kw['feed__category'].pk)
     if 'starred' in kw:
         es_entries = es_entries.filter(starred=kw['starred'])
-    previous = es_entries.filter(timestamp__gte=entry.date).order_by(
-        'timestamp', 'id').fetch(per_page=1)
-    previous = previous['hits'][0] if previous['hits'] else None
+    # The previous is actually the next by date, and vice versa
+    previous, next = es_entries.neighbors(entry.cursor,
+                                          size=NEIGHBORS_WINDOW)
+    return {
+        'mode': mode,
+        'ids': previous[::-1] + [entry.pk] + next,
+        'first': len(previous) < NEIGHBORS_WINDOW,
+        'last': len(next) < NEIGHBORS_WINDOW,
+    }
+
+
+def window_neighbors(window, pk):
+    """
+    IDs of the previous and next entries of ``pk`` in a window returned by
+    item_neighbors(), or None if the window doesn't cover them.
+    """
+    ids = window['ids']
+    if pk not in ids:
+        return
+    index = ids.index(pk)
+    if index == 0 and not window['first']:
+        return
+    if index == len(ids) - 1 and not window['last']:
+        return
+    previous = ids[index - 1] if index > 0 else None
+    next = ids[index + 1] if index < len(ids) - 1 else None
+    return previous, next
+
+
+@login_required
+def item(request, entry_id):
+    entry = es.entry(request.user, entry_id)
+    if not entry.read:
+        try:
+            entry.update(read=True)
+        except ConflictError:
+            # Double click // two operations at a time. Entry has already
+            # been marked as read.
+            pass
+    back_url = request.session.get('back_url',
+                                   default=entry.feed.get_absolute_url())
+
+    # Depending on the list used to access to this page, we try to find in an
+    # intelligent way which is the previous and the next item in the list.
+
+    # This way the user has nice 'previous' and 'next' buttons that are
+    # dynamically changed. A window of the list is cached so that reading
+    # the next entries doesn't hit Elasticsearch.
+    key = 'neighbors:{0}:{1}'.format(
+        request.user.pk, hashlib.sha1(back_url.encode('utf-8')).hexdigest())
+    window = cache.get(key)
+    neighbors = None if window is None else window_neighbors(window, entry.pk)
+    if neighbors is None:
+        window = item_neighbors(request.user, entry, back_url)
+        cache.set(key, window, NEIGHBORS_TTL)
+        neighbors = window_neighbors(window, entry.pk)
+    mode = window['mode']
+    previous, next = neighbors
     if previous is not None:
-        if previous.date == entry.date:
-            previous = es_entries.filter(
-                timestamp__gte=entry.date).filter(
-                id__gt=entry.pk
-            ).order_by('timestamp', 'id').fetch(per_page=1)
-            previous = previous['hits'][0] if previous['hits'] else None
-        if previous is not None:
-            previous = previous.get_absolute_url()
-    next = es_entries.filter(timestamp__lte=entry.date).order_by(
-        '-timestamp', '-id').fetch(per_page=1)
-    next = next['hits'][0] if next['hits'] else None
+        previous = reverse('feeds:item', args=[previous])
     if next is not None:
-        if next.date == entry.date:
-            next = es_entries.filter(
-                timestamp__lte=entry.date).filter(
-                id__lt=entry.pk
-            ).order_by('-timestamp', '-id').fetch(per_page=1)
-            next = next['hits'][0] if next['hits'] else None
-        if next is not None:
-            next = next.get_absolute_url()
+        next = reverse('feeds:item', args=[next])
 
     if request.user.oldest_first:
         previous, next = next, previous
@@ -632,17 +669,16 @@ def dashboard(request, mode=None):
     for cat in categories:
         cat['unread_count'] = 0
 
-    feed_to_cat = {feed.pk: feed.category_id for feed in feeds}
-
     category_feeds = defaultdict(list)
     category_counts = defaultdict(int)
 
-    counts = es.counts(request.user, feed_to_cat.keys(), stars=mode == 'stars')
-    _all = 0
+    counts = es.counts(request.user, [feed.pk for feed in feeds],
+                       stars=mode == 'stars')
+    uncategorized = []
     for feed in feeds:
-        feed.unread_count = counts[str(feed.pk)][str(feed.pk)]['doc_count']
-        _all += feed.unread_count
+        feed.unread_count = counts[feed.pk]
         if feed.category_id is None:
+            uncategorized.append(feed)
             continue
         category_feeds[feed.category_id].append(feed)
         category_counts[feed.category_id] += feed.unread_count
@@ -651,10 +687,6 @@ def dashboard(request, mode=None):
         c['unread_count'] = category_counts[c['id']]
         c['feeds'] = {'all': category_feeds[c['id']]}
 
-    uncategorized = [feed for feed in feeds if feed.category_id is None]
-    for feed in uncategorized:
-        feed.unread_count = counts[str(feed.pk)][str(feed.pk)]['doc_count']
-
     if mode == 'unread':
         categories = [c for c in categories if c['unread_count']]
 
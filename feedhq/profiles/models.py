@@ -1,9 +1,9 @@
 import json
 import pytz
+import time
 
 from datetime import timedelta
 
-from django.conf import settings
 from django.contrib.auth.models import (AbstractBaseUser, UserManager,
                                         PermissionsMixin)
 from django.db import models
@@ -18,6 +18,9 @@ TIMEZONES = [
     (tz, _(tz)) for tz in pytz.common_timezones
 ]
 
+# Marks unread counters as complete, see User.unread_counts()
+UNREAD_BUILT = b'built'
+
 ENTRIES_PER_PAGE = (
     (25, 25),
     (50, 50),
@@ -139,6 +142,10 @@ class User(PermissionsMixin, AbstractBaseUser):
     def last_update_key(self):
         return 'user:{0}:updates'.format(self.pk)
 
+    @property
+    def unread_key(self):
+        return 'user:{0}:unread'.format(self.pk)
+
     @property
     def wallabag_url(self):
         return json.loads(self.read_later_credentials)['wallabag_url']
@@ -175,10 +182,51 @@ class User(PermissionsMixin, AbstractBaseUser):
             redis.zadd(self.last_update_key, url, value)
         return self.last_updates()
 
+    def unread_counts(self):
+        """
+        Unread entries per feed pk. Counters are maintained in redis as
+        entries are stored and marked as read, and built from ES when
+        missing.
+        """
+        redis = get_redis_connection()
+        values = redis.hgetall(self.unread_key)
+        if values.pop(UNREAD_BUILT, None) is None:
+            return self.refresh_unread_counts()
+        counts = {}
+        for pk, count in values.items():
+            if int(count) > 0:
+                counts[int(pk)] = int(count)
+        return counts
+
+    def refresh_unread_counts(self):
+        counts = es.unread_by_feed(self.pk)
+        redis = get_redis_connection()
+        with redis.pipeline() as pipe:
+            pipe.delete(self.unread_key)
+            pipe.hmset(self.unread_key, dict(counts, built=int(time.time())))
+            pipe.execute()
+        return counts
+
+    def incr_unread(self, deltas, pipe=None):
+        """
+        Adjusts unread counters. ``deltas`` maps feed pks to the change in
+        their unread count.
+        """
+        if not deltas:
+            return
+        if pipe is None:
+            with get_redis_connection().pipeline() as pipe:
+                self.incr_unread(deltas, pipe=pipe)
+                pipe.execute()
+            return
+        for pk, delta in deltas.items():
+            if delta:
+                pipe.hincrby(self.unread_key, pk, delta)
+
     def ensure_alias(self):
         name = es.user_alias(self.pk)
         es.client.indices.put_alias(
-            index=settings.ES_INDEX,
+            index=",".join(es.entry_indices()),
             name=name,
             body={
                 'routing': self.pk,
@@ -193,30 +241,46 @@ class User(PermissionsMixin, AbstractBaseUser):
         return ret
 
     def delete_feed_entries(self, *pks):
-        return es.client.delete_by_query(
+        result = es.client.delete_by_query(
             index=es.user_alias(self.pk),
             doc_type='entries',
             body={'query': {'filtered': {'filter': {'or': [
                 {'term': {'feed': pk}} for pk in pks
             ]}}}},
         )
+        get_redis_connection().hdel(self.unread_key, *pks)
+        return result
 
     def delete_category_entries(self, pk):
-        return es.client.delete_by_query(
+        result = es.client.delete_by_query(
             index=es.user_alias(self.pk),
             doc_type='entries',
             body={'query': {'term': {'category': pk}}},
         )
+        get_redis_connection().delete(self.unread_key)
+        return result
 
     def delete_old(self):
+        """
+        Deletes the entries older than the user's TTL. Returns the number of
+        deleted entries.
+        """
         limit = timezone.now() - timedelta(days=self.ttl)
+        query = {'query': {'filtered': {
+            'filter': {'and': [
+                {'range': {'timestamp': {'lte': limit}}},
+                {'term': {'starred': False}},
+            ]},
+        }}}
+        # Counting is much cheaper than a delete_by_query matching nothing
+        count = es.client.count(es.user_alias(self.pk), doc_type='entries',
+                                body=query)['count']
+        if not count:
+            return 0
         es.client.delete_by_query(
             index=es.user_alias(self.pk),
             doc_type='entries',
-            body={'query': {'filtered': {
-                'filter': {'and': [
-                    {'range': {'timestamp': {'lte': limit}}},
-                    {'term': {'starred': False}},
-                ]},
-            }}},
+            body=query,
         )
+        get_redis_connection().delete(self.unread_key)
+        return count
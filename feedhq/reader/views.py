@@ -1,3 +1,4 @@
+import base64
 import json
 import logging
 import re
@@ -6,6 +7,7 @@ import struct
 from datetime import timedelta
 
 import opml
+import six
 
 from django.core.cache import cache
 from django.core.exceptions import ValidationError
@@ -27,9 +29,11 @@ from six.moves.urllib import parse as urlparse
 from .. import es
 from ..feeds.forms import FeedForm, user_lock
 from ..feeds.models import UniqueFeed, Category
+from ..feeds.tasks import mark_as_read
 from ..feeds.utils import epoch_to_utc
 from ..feeds.views import save_outline
 from ..profiles.models import User
+from ..tasks import enqueue
 from ..utils import is_email
 from .authentication import GoogleLoginAuthentication
 from .exceptions import PermissionDenied, BadToken
@@ -263,96 +267,64 @@ class UnreadCount(ReaderView):
     def get(self, request, *args, **kwargs):
         unread_counts = []
         last_updates = request.user.last_updates()
-        results = es.client.search(
-            index=es.user_alias(request.user.pk),
-            doc_type='entries',
-            body={
-                'query': {
-                    'filtered': {
-                        'filter': {'term': {'read': False}},
-                    },
-                },
-                'aggs': {
-                    'all': {
-                        'global': {},
-                        'aggs': {
-                            'unread': {
-                                'filter': {'term': {'read': False}},
-                                'aggs': {
-                                    'feeds': {
-                                        'terms': {'field': 'feed',
-                                                  'size': 0},
-                                    },
-                                },
-                            },
-                        },
-                    },
-                },
-            },
-            params={'size': 0},
-        )
-        if 'aggregations' in results:
-            feeds = {}
-            for bucket in results['aggregations']['all']['unread'][
-                    'feeds']['buckets']:
-                feeds[bucket['key']] = {
-                    'count': bucket['doc_count'],
-                }
-            if feeds:
-                _feeds = request.user.feeds.filter(
-                    pk__in=feeds.keys()
-                ).select_related('category').values_list(
-                    'pk', 'url', 'category_id', 'category__name'
-                )
-
-                categories = {}
-                total = 0
-                latest = 0
-                for pk, url, category, name in _feeds:
-                    data = feeds[pk]
-                    ts = last_updates.get(url, 0)
-                    if ts:
-                        data['newestItemTimestampUsec'] = (
-                            '{0}000000'.format(ts))
-                    data['id'] = u'feed/{0}'.format(url)
-                    unread_counts.append(data)
-                    total += data['count']
-                    latest = max(latest, ts)
-
-                    if category is None:
-                        continue
-
-                    if category not in categories:
-                        categories[category] = {
-                            'name': name,
-                            'count': 0,
-                            'ts': 0
-                        }
-                    categories[category]['count'] += data['count']
-                    categories[category]['ts'] = max(
-                        categories[category]['ts'], ts)
-
-                for pk, data in categories.items():
-                    info = {
-                        "id": label_key(request, data['name']),
-                        "count": data['count'],
-                        "newestItemTimestampUsec": '{0}000000'.format(
-                            int(data['ts']),
-                        ),
+        feeds = {}
+        for pk, count in request.user.unread_counts().items():
+            feeds[pk] = {'count': count}
+        if feeds:
+            _feeds = request.user.feeds.filter(
+                pk__in=feeds.keys()
+            ).select_related('category').values_list(
+                'pk', 'url', 'category_id', 'category__name'
+            )
+
+            categories = {}
+            total = 0
+            latest = 0
+            for pk, url, category, name in _feeds:
+                data = feeds[pk]
+                ts = last_updates.get(url, 0)
+                if ts:
+                    data['newestItemTimestampUsec'] = (
+                        '{0}000000'.format(ts))
+                data['id'] = u'feed/{0}'.format(url)
+                unread_counts.append(data)
+                total += data['count']
+                latest = max(latest, ts)
+
+                if category is None:
+                    continue
+
+                if category not in categories:
+                    categories[category] = {
+                        'name': name,
+                        'count': 0,
+                        'ts': 0
                     }
-                    unread_counts.append(info)
-
-                if total:
-                    unread_counts.append({
-                        "id": (
-                            "user/{0}/state/com.google/"
-                            "reading-list").format(
-                            request.user.pk),
-                        "count": total,
-                        "newestItemTimestampUsec": '{0}000000'.format(
-                            int(latest)
-                        ),
-                    })
+                categories[category]['count'] += data['count']
+                categories[category]['ts'] = max(
+                    categories[category]['ts'], ts)
+
+            for pk, data in categories.items():
+                info = {
+                    "id": label_key(request, data['name']),
+                    "count": data['count'],
+                    "newestItemTimestampUsec": '{0}000000'.format(
+                        int(data['ts']),
+                    ),
+                }
+                unread_counts.append(info)
+
+            if total:
+                unread_counts.append({
+                    "id": (
+                        "user/{0}/state/com.google/"
+                        "reading-list").format(
+                        request.user.pk),
+                    "count": total,
+                    "newestItemTimestampUsec": '{0}000000'.format(
+                        int(latest)
+                    ),
+                })
         return Response({
             "max": 1000,
             "unreadcounts": unread_counts,
@@ -384,23 +356,12 @@ class DisableTag(ReaderView):
         cat_pk = category.pk
         category.delete()
 
-        entries = es.manager.user(request.user).filter(
-            category=cat_pk,
-        ).aggregate('id').fetch(per_page=0)
-        ids = [bucket['key'] for bucket in entries[
-            'aggregations']['entries']['query']['id']['buckets']]
-
-        if ids:
-            index = es.user_alias(request.user.pk),
-            ops = [{
-                '_op_type': 'update',
-                '_index': index,
-                '_type': 'entries',
-                '_id': pk,
-                'doc': {'category': None},
-            } for pk in ids]
+        entries = es.manager.user(request.user).filter(category=cat_pk)
+        for ids in entries.iter_ids():
+            ops = es.update_ops(request.user.pk, ids, {'category': None})
             with es.ignore_bulk_error(404):
-                es.bulk(ops, raise_on_error=True, params={'refresh': True})
+                es.bulk(ops, raise_on_error=True, params=es.write_params())
+            es.add_pending(request.user.pk, ids, {'category': None})
         return Response("OK")
 disable_tag = DisableTag.as_view()
 
@@ -785,7 +746,8 @@ def get_stream_q(streams, user, exclude=None, include=None, limit=None,
 
 
 def bounds(n=None, c=None):
-    # ?n=20 (default), ?c=<continuation> for offset
+    # ?n=20 (default), ?c=<continuation> for offset. Continuations are
+    # either 'page<N>' or cursors generated by continuation_().
     if n is None:
         n = 20
     if c is None:
@@ -794,22 +756,49 @@ def bounds(n=None, c=None):
         per_page = int(n)
     except ValueError:
         raise exceptions.ParseError("'n' must be an integer")
+    if not c.startswith('page'):
+        return per_page, 1, parse_cursor(c)
     try:
         page = int(c[4:])
     except ValueError:
         raise exceptions.ParseError("Invalid 'c' continuation string")
-    return per_page, page
+    return per_page, page, None
+
+
+def parse_cursor(value):
+    try:
+        value = base64.urlsafe_b64decode(
+            str(value + '=' * (-len(value) % 4)))
+        cursor = json.loads(value.decode('ascii'))
+    except (TypeError, ValueError, UnicodeError):
+        raise exceptions.ParseError("Invalid 'c' continuation string")
+    if (
+        not isinstance(cursor, list) or len(cursor) != 2 or
+        not all(isinstance(v, six.integer_types) for v in cursor)
+    ):
+        raise exceptions.ParseError("Invalid 'c' continuation string")
+    return cursor
 
 
-def continuation_(count, per_page, page):
+def continuation_(count, per_page, page, last=None):
+    """
+    ``count`` is the number of entries matching from the start of the
+    page. With ``last``, the sort values of the last entry of the page,
+    the continuation is a cursor.
+    """
     continuation = None
     if per_page * page < count:
-        continuation = 'page{0}'.format(page + 1)
+        if last is None:
+            continuation = 'page{0}'.format(page + 1)
+        else:
+            continuation = base64.urlsafe_b64encode(json.dumps(
+                last, separators=(',', ':')).encode('ascii')).decode(
+                    'ascii').rstrip('=')
     return continuation
 
 
 def pagination(count, n=None, c=None):
-    per_page, page = bounds(n, c)
+    per_page, page, cursor = bounds(n, c)
     continuation = continuation_(count, per_page, page)
     start = max(0, (page - 1) * per_page)
     end = page * per_page
@@ -967,31 +956,35 @@ class StreamContents(ReaderView):
 
         # Ordering
         # ?r=d|n last entry first (default), ?r=o oldest entry first
-        ordering = 'date' if request.GET.get('r', 'd') == 'o' else '-date'
+        if request.GET.get('r', 'd') == 'o':
+            ordering = ('timestamp', 'id')
+        else:
+            ordering = ('-timestamp', '-id')
 
-        per_page, page = bounds(n=request.GET.get('n'),
-                                c=request.GET.get('c'))
+        per_page, page, cursor = bounds(n=request.GET.get('n'),
+                                        c=request.GET.get('c'))
         entries = get_es_entries(
             content_id, request.user,
             exclude=request.GET.getlist('xt'),
             include=request.GET.getlist('it'),
             limit=request.GET.get('ot'),
             offset=request.GET.get('nt'),
-        ).aggregate(
-            '__query__'
-        ).order_by(ordering.replace('date', 'timestamp')).fetch(
-            page=page, per_page=per_page, annotate=request.user)
+        ).aggregate('__query__').order_by(*ordering)
+        if cursor is not None:
+            entries = entries.after(cursor)
+        entries = entries.fetch(page=page, per_page=per_page,
+                                annotate=request.user)
 
         continuation = continuation_(
             entries['aggregations']['entries']['query']['doc_count'],
             per_page,
             page,
+            entries['cursor'],
         )
         entries = entries['hits']
-        start = max(0, (page - 1) * per_page)
 
         qs = {}
-        if start > 0:
+        if page > 1 or cursor is not None:
             qs['c'] = request.GET['c']
 
         if 'output' in request.GET:
@@ -1028,8 +1021,8 @@ class StreamItemsIds(ReaderView):
             "includeAllDirectStreamIds") == 'true'
 
         data = {}
-        per_page, page = bounds(n=request.GET.get('n'),
-                                c=request.GET.get('c'))
+        per_page, page, cursor = bounds(n=request.GET.get('n'),
+                                        c=request.GET.get('c'))
         annotate = None
         if include_stream_ids:
             annotate = request.user
@@ -1039,13 +1032,16 @@ class StreamItemsIds(ReaderView):
             include=request.GET.getlist('it'),
             limit=request.GET.get('ot'),
             offset=request.GET.get('nt'),
-        ).aggregate('__query__').only(
-            'timestamp', 'feed').fetch(page=page, per_page=per_page,
-                                       annotate=annotate)
+        ).aggregate('__query__').only('timestamp', 'feed')
+        if cursor is not None:
+            entries = entries.after(cursor)
+        entries = entries.fetch(page=page, per_page=per_page,
+                                annotate=annotate)
         continuation = continuation_(
             entries['aggregations']['entries']['query']['doc_count'],
             per_page,
             page,
+            entries['cursor'],
         )
         if continuation:
             data['continuation'] = continuation
@@ -1195,18 +1191,15 @@ class EditTag(ReaderView):
                 raise exceptions.ParseError(
                     "Unrecognized tag: {0}".format(tag))
 
-        ops = []
-        for pk in entry_ids:
-            ops.append({
-                '_op_type': 'update',
-                '_type': 'entries',
-                '_id': pk,
-                'doc': query,
-            })
-        index = es.user_alias(request.user.pk)
+        deltas = {}
+        if 'read' in query:
+            deltas = es.read_deltas(request.user.pk, entry_ids, query['read'])
+
+        ops = es.update_ops(request.user.pk, entry_ids, query)
         with es.ignore_bulk_error(404, 409):
-            es.bulk(ops, index=index, raise_on_error=True,
-                    params={'refresh': True})
+            es.bulk(ops, raise_on_error=True, params=es.write_params())
+        es.add_pending(request.user.pk, entry_ids, query)
+        request.user.incr_unread(deltas)
         return Response("OK")
 edit_tag = EditTag.as_view()
 
@@ -1218,8 +1211,9 @@ class MarkAllAsRead(ReaderView):
     def post(self, request, *args, **kwargs):
         if 's' not in request.DATA:
             raise exceptions.ParseError("Missing 's' parameter")
-        entries = request.user.entries
-        es_entries = es.manager.user(request.user).filter(read=False)
+        # Entries stored from now on weren't seen by the client
+        es_entries = es.manager.user(request.user).filter(
+            read=False, id__lte=es.last_id())
         limit = None
         if 'ts' in request.DATA:
             try:
@@ -1258,22 +1252,20 @@ class MarkAllAsRead(ReaderView):
             logger.info(u"Unknown stream: {0}".format(stream))
             return Response("OK")
 
-        entries = es_entries.aggregate('id').fetch(per_page=0)
-        pks = [bucket['key'] for bucket in entries[
-            'aggregations']['entries']['query']['id']['buckets']]
-
-        if pks:
-            ops = [{
-                '_op_type': 'update',
-                '_type': 'entries',
-                '_id': pk,
-                'doc': {'read': True},
-            } for pk in pks]
-            index = es.user_alias(request.user.pk)
-            with es.ignore_bulk_error(404, 409):
-                es.bulk(ops, index=index, raise_on_error=True,
-                        params={'refresh': True})
-        return Response("OK")
+        # Entries are updated asynchronously. Unread counts are updated
+        # right away, clients expect them to drop as soon as we reply. The
+        # job corrects them with the entries it actually marks as read.
+        feeds = es_entries.aggregate('feed').fetch(per_page=0)[
+            'aggregations']['entries']['query']['feed']['buckets']
+        if not feeds:
+            return Response("OK")
+        deltas = {bucket['key']: -bucket['doc_count'] for bucket in feeds}
+        job = enqueue(mark_as_read, args=[request.user.pk, es_entries, deltas],
+                      queue='high')
+        request.user.incr_unread(deltas)
+        response = Response("OK")
+        response['X-FeedHQ-Job'] = job.id
+        return response
 mark_all_as_read = MarkAllAsRead.as_view()
 
 
@@ -31,6 +31,55 @@ ES_ALIAS_TEMPLATE = os.environ.get('ES_ALIAS_TEMPLATE', 'feedhq-{0}')
 ES_SHARDS = int(os.environ.get('ES_SHARDS', 5))
 # Replicas can be changed at any time.
 ES_REPLICAS = int(os.environ.get('ES_REPLICAS', 1))
+# Cluster health and mappings are checked at most every ES_CHECK_TTL seconds
+# by each process.
+ES_CHECK_TTL = int(os.environ.get('ES_CHECK_TTL', 300))
+# Changes made by users are visible in searches after an index refresh.
+# Instead of forcing one on every write, keep changes in redis for
+# ES_WRITE_OVERLAY seconds and merge them into search results. 0 forces
+# refreshes.
+ES_WRITE_OVERLAY = int(os.environ.get('ES_WRITE_OVERLAY', 30))
+# Store entries in monthly indices. Expired entries are then mostly deleted
+# by dropping whole indices.
+ES_PARTITIONS = bool(os.environ.get('ES_PARTITIONS', False))
+# Store the content of entries once in ES_BODIES_INDEX instead of once per
+# subscriber. Searches then don't match content.
+ES_SHARED_BODIES = bool(os.environ.get('ES_SHARED_BODIES', False))
+ES_BODIES_INDEX = os.environ.get('ES_BODIES_INDEX',
+                                 '{0}-bodies'.format(ES_INDEX))
+
+# Number of concurrent HTTP requests made by batched feed updates.
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', 20))
+# Keep-alive connection pools for fetching: number of hosts to keep pools
+# for and number of connections to keep per host.
+FETCH_POOL_HOSTS = int(os.environ.get('FETCH_POOL_HOSTS', 100))
+FETCH_POOL_SIZE = int(os.environ.get('FETCH_POOL_SIZE', 10))
+# Per-host politeness: sustained requests per second and burst size allowed
+# for a single host across all workers. Disabled by default (rate of 0). The
+# rate must stay above the number of feeds of the busiest host divided by
+# the update period (3600s), or feeds of that host fall behind for good.
+FETCH_HOST_RATE = float(os.environ.get('FETCH_HOST_RATE', 0))
+FETCH_HOST_BURST = int(os.environ.get('FETCH_HOST_BURST', 10))
+# Responses larger than FETCH_MAX_SIZE bytes or that take more than
+# FETCH_READ_DEADLINE seconds to read are abandoned.
+FETCH_MAX_SIZE = int(os.environ.get('FETCH_MAX_SIZE', 10 * 1024 * 1024))
+FETCH_READ_DEADLINE = int(os.environ.get('FETCH_READ_DEADLINE', 60))
+# Number of processes used for parsing feeds fetched in batches. 0 parses
+# feeds in the fetching process. Parsers are killed after PARSE_TIMEOUT
+# seconds or when they use more than PARSE_MEMORY_LIMIT megabytes.
+PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', 0))
+PARSE_TIMEOUT = int(os.environ.get('PARSE_TIMEOUT', 30))
+PARSE_MEMORY_LIMIT = int(os.environ.get('PARSE_MEMORY_LIMIT', 256))
+
+# Number of days the guids of a feed's entries are remembered in redis to
+# avoid querying elasticsearch for existing entries, and maximum number of
+# entries remembered per feed.
+SEEN_GUIDS_TTL = int(os.environ.get('SEEN_GUIDS_TTL', 30))
+SEEN_GUIDS_MAX = int(os.environ.get('SEEN_GUIDS_MAX', 1000))
+# Store workers running with --batch-store perform up to STORE_BATCH_SIZE
+# jobs at once and index at most STORE_BULK_SIZE entries per bulk request.
+STORE_BATCH_SIZE = int(os.environ.get('STORE_BATCH_SIZE', 50))
+STORE_BULK_SIZE = int(os.environ.get('STORE_BULK_SIZE', 1000))
 
 TIME_ZONE = 'UTC'
 
@@ -11,7 +11,9 @@ from django.http import (HttpResponse, HttpResponsePermanentRedirect,
 from django.utils.crypto import constant_time_compare
 from rq import Worker
 
+from .feeds import fetcher
 from .feeds.models import Feed, UniqueFeed
+from .feeds.tasks import sweep_stats
 from .profiles.models import User
 from .utils import get_redis_connection
 
@@ -71,6 +73,8 @@ def health(request):
             'total': Feed.objects.all().count(),
             'unique': UniqueFeed.objects.all().count(),
         },
+        'fetcher': fetcher.global_pool_stats(),
+        'delete_old': sweep_stats(),
     }
     response = HttpResponse(json.dumps(data))
     response['Content-Type'] = 'application/json'
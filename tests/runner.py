@@ -14,3 +14,4 @@ class ESTestSuiteRunner(DiscoverRunner):
     def teardown_test_environment(self):
         super(ESTestSuiteRunner, self).teardown_test_environment()
         es.client.indices.delete(settings.ES_INDEX)
+        es.client.indices.delete(settings.ES_BODIES_INDEX)
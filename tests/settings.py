@@ -14,6 +14,9 @@ PASSWORD_HASHERS = [
 
 RQ_EAGER = True
 
+# Tests fetch the same hosts many times in a row.
+FETCH_HOST_RATE = 0
+
 STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
 
 EMAIL_HOST = 'dummy'
@@ -36,8 +39,10 @@ if '-v2' not in sys.argv:
 MEDIA_ROOT = os.path.join(BASE_DIR, 'test_media')
 
 ES_INDEX = 'test-feedhq'
+ES_BODIES_INDEX = 'test-feedhq-bodies'
 ES_ALIAS_TEMPLATE = 'test-feedhq-{0}'
 ES_SHARDS = 1
 ES_REPLICAS = 0
+ES_WRITE_OVERLAY = 0
 
 TEST_RUNNER = 'tests.runner.ESTestSuiteRunner'
@@ -0,0 +1,104 @@
+"""
+Benchmarks for hot paths. Not part of the regular test run, use:
+
+    BENCHMARKS=1 python manage.py test tests.test_benchmarks
+"""
+import os
+import time
+
+from collections import defaultdict
+from unittest import skipUnless
+
+import feedparser
+
+from feedhq import es
+from feedhq.feeds.models import Entry, UniqueFeed
+from feedhq.feeds.tasks import entry_ops
+
+from .factories import UserFactory
+from . import TestCase, data_file
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def report(name, **timings):
+    print(u"\n{0}: {1}".format(name, u", ".join(
+        u"{0} {1:.3f}s".format(key, value)
+        for key, value in sorted(timings.items()))))
+
+
+@skipUnless(os.environ.get('BENCHMARKS'), "BENCHMARKS not set")
+class BenchmarkTests(TestCase):
+    def test_entry_fan_out(self):
+        """Storing one 50-item feed for 1000 subscribers"""
+        parsed = feedparser.parse(data_file('sw-all.xml'))
+        entries = list(filter(None, [
+            UniqueFeed.objects.entry_data(entry, parsed)
+            for entry in parsed.entries
+        ]))
+        entries = (entries * 2)[:50]
+        for index, entry in enumerate(entries):
+            entry.pop('date_generated')
+            entry['guid'] = u'{0}-{1}'.format(entry['guid'], index)
+
+        feeds = [{'pk': pk, 'user_id': pk, 'category_id': pk,
+                  'user__ttl': None} for pk in range(1, 1001)]
+
+        def per_subscriber():
+            ops = []
+            for feed in feeds:
+                for entry in entries:
+                    data = Entry(**entry).serialize()
+                    data['category'] = feed['category_id']
+                    data['feed'] = feed['pk']
+                    data['user'] = feed['user_id']
+                    ops.append(data)
+            return ops
+
+        before, expected = timed(per_subscriber)
+        after, (ops, updates) = timed(entry_ops, feeds, entries,
+                                      defaultdict(set), defaultdict(set))
+        report('entry fan-out', per_subscriber=before, serialize_once=after)
+        self.assertEqual(len(ops), len(expected))
+        self.assertEqual(len(updates), 1000)
+
+    def test_dashboard_counts(self):
+        """Unread counts for users with 10, 100 and 1000 feeds"""
+        def per_feed(user, feed_ids):
+            aggs = {}
+            for pk in feed_ids:
+                aggs[pk] = {'global': {}, 'aggs': {pk: {'filter': {'and': [
+                    {'term': {'read': False}},
+                    {'term': {'feed': pk}},
+                ]}}}}
+            results = es.client.search(
+                index=es.user_alias(user.pk), doc_type='entries',
+                body={'aggs': aggs}, params={'size': 0})['aggregations']
+            return {int(pk): agg[pk]['doc_count']
+                    for pk, agg in results.items()}
+
+        for count in [10, 100, 1000]:
+            user = UserFactory.create()
+            # Distinct feed pks per user
+            feed_ids = list(range(count * 10, count * 11))
+            ops = []
+            for pk in feed_ids:
+                for index in range(pk % 5):
+                    ops.append({'_index': es.user_alias(user.pk),
+                                '_type': 'entries', 'feed': pk,
+                                'user': user.pk, 'read': index == 3,
+                                'starred': False})
+            for data, pk in zip(ops, es.next_ids(len(ops))):
+                data['_id'] = data['id'] = pk
+            es.bulk(ops, raise_on_error=True)
+            es.client.indices.refresh(es.user_alias(user.pk))
+
+            before, expected = timed(per_feed, user, feed_ids)
+            after, counts = timed(es.counts, user, feed_ids)
+            report('dashboard counts, {0} feeds'.format(count),
+                   per_feed=before, terms=after)
+            self.assertEqual(counts, expected)
@@ -7,7 +7,7 @@ from . import responses, TestCase
 
 
 class FaviconTests(TestCase):
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_existing_favicon_new_feed(self, get):
         get.return_value = responses(304)
         FeedFactory.create(url='http://example.com/feed')
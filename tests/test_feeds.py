@@ -24,7 +24,7 @@ from . import data_file, responses, patch_job, WebTest
 
 
 class WebBaseTests(WebTest):
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_welcome_page(self, get):
         get.return_value = responses(304)
 
@@ -70,7 +70,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertContains(response, 'Cat yo')
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_only_unread(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -146,7 +146,7 @@ class WebBaseTests(WebTest):
         response = form.submit().follow()
         self.assertEqual(Category.objects.count(), 0)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_feed(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -174,7 +174,7 @@ class WebBaseTests(WebTest):
         self.assertContains(response,
                             'New Name has been successfully updated')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_add_feed(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -266,7 +266,7 @@ class WebBaseTests(WebTest):
             response = form.submit()
             self.assertFormError(response, 'form', 'url', "Enter a valid URL.")
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_feed_auth(self, get):
         get.return_value = responses(200, 'brutasse.atom')
         user = UserFactory.create()
@@ -289,7 +289,7 @@ class WebBaseTests(WebTest):
                  auth=(u'user', u'password')),
         ])
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_edit_feed(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -314,7 +314,7 @@ class WebBaseTests(WebTest):
         self.assertContains(response, 'New Name has been successfully updated')
         self.assertEqual(Feed.objects.get().category_id, cat.pk)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_delete_feed(self, get):
         get.return_value = responses(304)
 
@@ -331,7 +331,7 @@ class WebBaseTests(WebTest):
         self.assertEqual(Feed.objects.count(), 0)
         # Redirects to home so useless to test
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_invalid_page(self, get):
         get.return_value = responses(304)
         # We need more than 25 entries
@@ -353,7 +353,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertContains(response, "jacobian's django-deployment-workshop")
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_entry(self, get):
         user = UserFactory.create(ttl=99999)
         get.return_value = responses(200, 'sw-all.xml')
@@ -384,7 +384,7 @@ class WebBaseTests(WebTest):
         feed.save()
         self._test_entry(url, user)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_custom_ordering(self, get):
         user = UserFactory.create()
         get.return_value = responses(200, 'sw-all.xml')
@@ -405,7 +405,7 @@ class WebBaseTests(WebTest):
         self.assertEqual(object_list[0].title, last_title)
         self.assertEqual(object_list[-1].title, first_title)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_last_entry(self, get):
         user = UserFactory.create()
         get.return_value = responses(200, 'sw-all.xml')
@@ -420,6 +420,58 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertNotContains(response, 'Next →')
 
+    @patch('feedhq.feeds.fetcher.get')
+    def test_item_neighbors(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        feed = FeedFactory.create(category__user=user, user=user)
+        date = timezone.now() - timedelta(days=1)
+        old = EntryFactory.create(feed=feed, user=user,
+                                  date=date - timedelta(days=1))
+        # Same date, ties are broken by ID
+        first, second = [EntryFactory.create(feed=feed, user=user, date=date)
+                         for i in range(2)]
+
+        url = reverse('feeds:item', args=[first.pk])
+
+        # Windows that don't reach the end of the list are extended
+        with patch('feedhq.feeds.views.NEIGHBORS_WINDOW', 1):
+            response = self.app.get(url, user=user)
+            self.assertEqual(response.context['next'],
+                             reverse('feeds:item', args=[old.pk]))
+            response = self.app.get(reverse('feeds:item', args=[old.pk]),
+                                    user=user)
+            self.assertEqual(response.context['previous'],
+                             reverse('feeds:item', args=[first.pk]))
+            self.assertEqual(response.context['next'], None)
+
+        response = self.app.get(url, user=user)
+        self.assertEqual(response.context['previous'],
+                         reverse('feeds:item', args=[second.pk]))
+        self.assertEqual(response.context['next'],
+                         reverse('feeds:item', args=[old.pk]))
+
+        # Neighbors are cached for the list being read, reading the next
+        # entries doesn't hit elasticsearch.
+        with patch('feedhq.es.client.msearch') as msearch:
+            response = self.app.get(url, user=user)
+            self.assertEqual(response.context['next'],
+                             reverse('feeds:item', args=[old.pk]))
+            response = self.app.get(reverse('feeds:item', args=[old.pk]),
+                                    user=user)
+            self.assertEqual(response.context['previous'],
+                             reverse('feeds:item', args=[first.pk]))
+            self.assertEqual(response.context['next'], None)
+        self.assertEqual(msearch.call_count, 0)
+
+        user.oldest_first = True
+        user.save()
+        response = self.app.get(reverse('feeds:item', args=[second.pk]),
+                                user=user)
+        self.assertEqual(response.context['previous'],
+                         reverse('feeds:item', args=[first.pk]))
+        self.assertEqual(response.context['next'], None)
+
     def test_not_mocked(self):
         with self.assertRaises(ValueError):
             FeedFactory.create()
@@ -429,7 +481,7 @@ class WebBaseTests(WebTest):
         url = reverse('feeds:item', args=[99999])
         self.app.get(url, user=user, status=404)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_img(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -474,7 +526,7 @@ class WebBaseTests(WebTest):
         self.assertContains(response,
                             '<img src="http://exmpl.com/favicon.png">')
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_actions(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -512,7 +564,7 @@ class WebBaseTests(WebTest):
         [entry] = es.manager.user(user).fetch()['hits']
         self.assertFalse(entry.read)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_opml_import(self, get):
         user = UserFactory.create()
         url = reverse('feeds:import_feeds')
@@ -547,7 +599,7 @@ class WebBaseTests(WebTest):
             "The submitted file is empty."
         ])
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_greader_opml_import(self, get):
         user = UserFactory.create()
         url = reverse('feeds:import_feeds')
@@ -564,7 +616,7 @@ class WebBaseTests(WebTest):
         self.assertContains(response, '1 feed has been imported')
         self.assertEqual(Category.objects.count(), 0)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_categories_in_opml(self, get):
         user = UserFactory.create()
         url = reverse('feeds:import_feeds')
@@ -592,7 +644,7 @@ class WebBaseTests(WebTest):
         for c in Category.objects.all():
             c.get_absolute_url()
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_dashboard(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -603,7 +655,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertContains(response, 'Dashboard')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_unread_dashboard(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -614,7 +666,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertContains(response, 'Dashboard')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_unread_count(self, get):
         """Unread feed count everywhere"""
         user = UserFactory.create(ttl=99999)
@@ -634,7 +686,7 @@ class WebBaseTests(WebTest):
             'title="Unread entries" href="/unread/">30</a>'
         )
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_mark_as_read(self, get):
         get.return_value = responses(304)
         user = UserFactory.create(ttl=99999)
@@ -661,6 +713,7 @@ class WebBaseTests(WebTest):
         read = counts['read']
         self.assertEqual(unread, 0)
         self.assertEqual(read, 30)
+        self.assertEqual(user.unread_counts(), {})
 
         form = response.forms['undo']
         response = form.submit()
@@ -684,7 +737,7 @@ class WebBaseTests(WebTest):
         response = response.follow()
         self.assertContains(response, "5 entries have been marked as read")
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_promote_html_content_type(self, get):
         get.return_value = responses(200, 'content-description.xml')
         user = UserFactory.create(ttl=99999)
@@ -693,9 +746,10 @@ class WebBaseTests(WebTest):
             per_page=1, annotate=user)['hits'][0].content
         self.assertEqual(len(content.split('F&#233;vrier 1953')), 2)
 
+    @patch('feedhq.feeds.fetcher.get')
     @patch('requests.get')
     @patch('requests.post')
-    def test_add_to_readability(self, post, get):  # noqa
+    def test_add_to_readability(self, post, get, fetch):  # noqa
         post.return_value = responses(202, headers={
             'location': 'https://www.readability.com/api/rest/v1/bookmarks/19',
         })
@@ -708,15 +762,14 @@ class WebBaseTests(WebTest):
             }),
         )
 
-        get.return_value = responses(200, 'sw-all.xml')
+        fetch.return_value = responses(200, 'sw-all.xml')
         feed = FeedFactory.create(category__user=user, user=user)
-        get.assert_called_once_with(
+        fetch.assert_called_once_with(
             feed.url,
             headers={'User-Agent': USER_AGENT % '1 subscriber',
                      'Accept': feedparser.ACCEPT_HEADER},
             timeout=10, auth=None)
 
-        get.reset_mock()
         get.return_value = responses(200, data=json.dumps(
             {'article': {'id': 'foo'}}))
 
@@ -743,7 +796,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertNotContains(response, "Add to Instapaper")
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     @patch('requests.post')
     def test_add_to_instapaper(self, post, get):  # noqa
         post.return_value = responses(200, data=json.dumps([{
@@ -791,7 +844,7 @@ class WebBaseTests(WebTest):
         response = self.app.get(url, user=user)
         self.assertNotContains(response, "Add to Instapaper")
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     @patch('requests.post')
     def test_add_to_readitlaterlist(self, post, get):
         user = UserFactory.create(
@@ -827,7 +880,7 @@ class WebBaseTests(WebTest):
                             u'expression matching')},
         )
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_pubsubhubbub_handling(self, get):
         user = UserFactory.create(ttl=99999)
         url = 'http://bruno.im/atom/tag/django-community/'
@@ -870,14 +923,14 @@ class WebBaseTests(WebTest):
         self.assertEqual(eleven, 3)
         self.assertEqual(twelve, 2)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_missing_links(self, get):
         path = data_file('no-rel.atom')
         with open(path, 'r') as f:
             data = f.read()
         updated.send(sender=None, notification=data, request=None, links=None)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_link_headers(self, get):
         user = UserFactory.create(ttl=99999)
         url = 'http://foo'
@@ -892,7 +945,7 @@ class WebBaseTests(WebTest):
         self.assertEqual(es.client.count(es.user_alias(user.pk),
                                          doc_type='entries')['count'], 1)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_subscribe_url(self, get):
         get.return_value = responses(304)
 
@@ -948,7 +1001,7 @@ class WebBaseTests(WebTest):
             response, ('it looks like there are no feeds available on '
                        '<a href="http://isitbeeroclock.com/">'))
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_relative_links(self, get):
         get.return_value = responses(200, path='brutasse.atom')
 
@@ -970,7 +1023,7 @@ class WebBaseTests(WebTest):
         self.assertTrue(('src="http://standblog.org/dotclear2/themes/'
                          'default/smilies/smile.png"') in e.content)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_empty_subtitle(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -990,7 +1043,7 @@ class WebBaseTests(WebTest):
         now = now - timedelta(days=366)
         self.assertEqual(len(smart_date(now)), 12)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_manage_feed(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -1026,6 +1079,8 @@ class WebBaseTests(WebTest):
         self.assertEqual(response.status_code, 200)
         expected = {
             'feeds': {'total': 0, 'unique': 0},
+            'fetcher': {'hits': 0, 'misses': 0},
+            'delete_old': {},
             'queues': {},
             'users': {'active': 0, 'total': 0},
         }
@@ -1041,7 +1096,7 @@ class WebBaseTests(WebTest):
             self.assertEqual(json.loads(response.content.decode('utf-8')),
                              expected)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_search(self, get):
         get.return_value = responses(200, path='brutasse.atom')
 
@@ -1,5 +1,7 @@
 import feedparser
 import socket
+import threading
+import time
 
 from django.core.management import call_command
 from django.utils import timezone
@@ -13,6 +15,7 @@ from rq.timeouts import JobTimeoutException
 from six.moves.http_client import IncompleteRead
 
 from feedhq import es
+from feedhq.feeds import fetcher
 from feedhq.feeds.models import Favicon, UniqueFeed, Feed
 from feedhq.feeds.tasks import update_feed
 from feedhq.feeds.utils import FAVICON_FETCHER, USER_AGENT, epoch_to_utc
@@ -24,7 +27,7 @@ from . import TestCase, patch_job
 
 
 class UpdateTests(TestCase):
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_parse_error(self, get):
         get.side_effect = LocationParseError("Failed to parse url")
         FeedFactory.create()
@@ -32,7 +35,7 @@ class UpdateTests(TestCase):
         self.assertTrue(unique.muted)
         self.assertEqual(unique.error, UniqueFeed.PARSE_ERROR)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_decode_error(self, get):
         get.side_effect = DecodeError("Received response with content-encoding"
                                       ": gzip, but failed to decode it.")
@@ -42,7 +45,7 @@ class UpdateTests(TestCase):
         self.assertEqual(data['backoff_factor'], 2)
         self.assertEqual(data['error'], UniqueFeed.DECODE_ERROR)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_incomplete_read(self, get):
         get.side_effect = IncompleteRead("0 bytes read")
         FeedFactory.create()
@@ -51,7 +54,62 @@ class UpdateTests(TestCase):
         data = job_details(f.url, connection=get_redis_connection())
         self.assertEqual(data['error'], f.CONNECTION_ERROR)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
+    def test_too_large(self, get):
+        get.side_effect = fetcher.ResponseTooLarge("Body larger than 10")
+        FeedFactory.create()
+        f = UniqueFeed.objects.get()
+        self.assertFalse(f.muted)
+        data = job_details(f.url, connection=get_redis_connection())
+        self.assertEqual(data['error'], f.TOO_LARGE)
+        self.assertEqual(data['backoff_factor'], 2)
+
+    def test_read_limits(self):
+        response = fetcher.read(responses(200, 'sw-all.xml'))
+        self.assertTrue(response.content.startswith(b'<?xml'))
+
+        with self.assertRaises(fetcher.ResponseTooLarge):
+            fetcher.read(responses(200, 'sw-all.xml'), max_size=1024)
+
+        with self.assertRaises(fetcher.ResponseTooLarge):
+            fetcher.read(responses(200, 'sw-all.xml', headers={
+                'content-length': '20000000'}))
+
+        with self.assertRaises(RequestException):
+            fetcher.read(responses(200, 'sw-all.xml'), deadline=-1)
+
+    def test_read_deadline(self):
+        class SlowBody(object):
+            """Sends a byte every 100ms, for ever."""
+            def __init__(self):
+                self.closed = threading.Event()
+
+            def read(self, amt=None):
+                data = b''
+                while len(data) < amt and not self.closed.wait(0.1):
+                    data += b'x'
+                return data
+
+            def close(self):
+                self.closed.set()
+
+        response = responses(200)
+        response.raw = SlowBody()
+        start = time.time()
+        with self.assertRaises(RequestException):
+            fetcher.read(response, deadline=0.5)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(response.raw.closed.is_set())
+
+    def test_cookies(self):
+        session = fetcher.session()
+        session.cookies.set('token', 'secret', domain='example.com')
+        with patch.object(session, 'get') as get:
+            get.return_value = responses(200, 'sw-all.xml')
+            fetcher.get('http://example.com/feed')
+        self.assertEqual(len(fetcher.session().cookies), 0)
+
+    @patch('feedhq.feeds.fetcher.get')
     def test_socket_timeout(self, get):
         m = get.return_value
         type(m).content = PropertyMock(side_effect=socket.timeout)
@@ -61,7 +119,7 @@ class UpdateTests(TestCase):
         data = job_details(f.url, connection=get_redis_connection())
         self.assertEqual(data['error'], f.TIMEOUT)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_ctype(self, get):
         # Updatefeed doesn't fail if content-type is missing
         get.return_value = responses(200, 'sw-all.xml', headers={})
@@ -82,7 +140,7 @@ class UpdateTests(TestCase):
                      'Accept': feedparser.ACCEPT_HEADER},
             timeout=10, auth=None)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_permanent_redirects(self, get):
         """Updating the feed if there's a permanent redirect"""
         get.return_value = responses(
@@ -92,7 +150,7 @@ class UpdateTests(TestCase):
         feed = Feed.objects.get(pk=feed.id)
         self.assertEqual(feed.url, 'permanent-atom10.xml')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_temporary_redirect(self, get):
         """Don't update the feed if the redirect is not 301"""
         get.return_value = responses(
@@ -107,7 +165,7 @@ class UpdateTests(TestCase):
         feed = Feed.objects.get(pk=feed.id)
         self.assertNotEqual(feed.url, 'atom10.xml')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_content_handling(self, get):
         """The content section overrides the subtitle section"""
         get.return_value = responses(200, 'atom10.xml')
@@ -119,7 +177,7 @@ class UpdateTests(TestCase):
 
         self.assertEqual(entry.author, 'Mark Pilgrim (mark@example.org)')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_gone(self, get):
         """Muting the feed if the status code is 410"""
         get.return_value = responses(410)
@@ -127,7 +185,7 @@ class UpdateTests(TestCase):
         feed = UniqueFeed.objects.get(url='http://gone.xml')
         self.assertTrue(feed.muted)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_errors(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -152,7 +210,7 @@ class UpdateTests(TestCase):
             # Restore status for next iteration
             schedule_job(feed.url, backoff_factor=1, error=None, schedule_in=0)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_too_many_requests(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -167,7 +225,7 @@ class UpdateTests(TestCase):
             60
         )
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_too_many_requests_retry(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -188,7 +246,58 @@ class UpdateTests(TestCase):
         update_feed(feed.url, backoff_factor=1)
         get.assert_not_called()
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
+    def test_unchanged_content(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+
+        get.return_value = responses(200, 'sw-all.xml')
+        update_feed(feed.url)
+        data = job_details(feed.url, connection=get_redis_connection())
+        digest = data['digest']
+        self.assertEqual(len(digest), 40)
+
+        # Same content: not parsed again
+        get.return_value = responses(200, 'sw-all.xml')
+        with patch('feedparser.parse') as parse:
+            update_feed(feed.url, digest=digest)
+            parse.assert_not_called()
+        data = job_details(feed.url, connection=get_redis_connection())
+        self.assertEqual(data['digest'], digest)
+
+        get.return_value = responses(200, 'brutasse.atom')
+        update_feed(feed.url, digest=digest)
+        data = job_details(feed.url, connection=get_redis_connection())
+        self.assertNotEqual(data['digest'], digest)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_host_throttling(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(url='http://example.com/feed')
+        other = FeedFactory.create(url='http://example.com/other')
+        elsewhere = FeedFactory.create(url='http://example.org/feed')
+
+        with self.settings(FETCH_HOST_RATE=0.01, FETCH_HOST_BURST=2):
+            get.reset_mock()
+            update_feed(feed.url)
+            update_feed(other.url)
+            self.assertEqual(get.call_count, 2)
+
+            # Bucket is empty, job is deferred
+            update_feed(feed.url)
+            self.assertEqual(get.call_count, 2)
+            data = job_details(feed.url, connection=get_redis_connection())
+            self.assertTrue(
+                90 <
+                (epoch_to_utc(data['schedule_at']) - timezone.now()).seconds <
+                131
+            )
+
+            # Other hosts have their own bucket
+            update_feed(elsewhere.url)
+            self.assertEqual(get.call_count, 3)
+
+    @patch('feedhq.feeds.fetcher.get')
     def test_backoff(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -221,7 +330,7 @@ class UpdateTests(TestCase):
             self.assertEqual(data['error'], 'timeout')
             self.assertEqual(data['backoff_factor'], min(i + 2, 10))
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_etag_modified(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -235,7 +344,7 @@ class UpdateTests(TestCase):
                 'If-Modified-Since': b'1234',
             }, timeout=10, auth=None)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_restore_backoff(self, get):
         get.return_value = responses(304)
         FeedFactory.create()
@@ -250,7 +359,7 @@ class UpdateTests(TestCase):
         self.assertEqual(data['backoff_factor'], 1)
         self.assertTrue('error' not in data)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_no_date_and_304(self, get):
         """If the feed does not have a date, we'll have to find one.
         Also, since we update it twice, the 2nd time it's a 304 response."""
@@ -268,7 +377,7 @@ class UpdateTests(TestCase):
 
         self.assertEqual(count1, count2)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_uniquefeed_deletion(self, get):
         get.return_value = responses(304)
         f = UniqueFeed.objects.create(url='http://example.com')
@@ -277,7 +386,7 @@ class UpdateTests(TestCase):
         UniqueFeed.objects.update_feed(f.url)
         self.assertEqual(UniqueFeed.objects.count(), 0)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_no_link(self, get):
         get.return_value = responses(200, 'rss20.xml')
         user = UserFactory.create(ttl=99999)
@@ -295,7 +404,7 @@ class UpdateTests(TestCase):
         count = self.counts(user, all={})['all']
         self.assertEqual(count, 1)
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_task_timeout_handling(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create()
@@ -330,9 +439,32 @@ class UpdateTests(TestCase):
         call_command('sync_pubsubhubbub')
         post.assert_not_called()
 
+    @patch('feedhq.feeds.fetcher._flushed', {'hits': 0, 'misses': 0})
+    @patch('feedhq.feeds.fetcher.pool_stats')
+    def test_flush_pool_stats(self, pool_stats):
+        self.assertEqual(fetcher.global_pool_stats(),
+                         {'hits': 0, 'misses': 0})
+
+        pool_stats.return_value = {'hits': 3, 'misses': 1}
+        fetcher.flush_pool_stats()
+        self.assertEqual(fetcher.global_pool_stats(),
+                         {'hits': 3, 'misses': 1})
+
+        # Only the deltas are added
+        pool_stats.return_value = {'hits': 5, 'misses': 1}
+        fetcher.flush_pool_stats()
+        self.assertEqual(fetcher.global_pool_stats(),
+                         {'hits': 5, 'misses': 1})
+
+        # Counters were reset by a new session
+        pool_stats.return_value = {'hits': 1, 'misses': 1}
+        fetcher.flush_pool_stats()
+        self.assertEqual(fetcher.global_pool_stats(),
+                         {'hits': 6, 'misses': 2})
+
 
 class FaviconTests(TestCase):
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_declared_favicon(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create(url='http://example.com/feed')
@@ -354,7 +486,7 @@ class FaviconTests(TestCase):
             timeout=10,
         )
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_favicon_empty_document(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create(url='http://example.com/feed')
@@ -367,7 +499,7 @@ class FaviconTests(TestCase):
         get.return_value = Response()
         Favicon.objects.update_favicon(feed.url)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_favicon_parse_error(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create(url='http://example.com/feed')
@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
 from datetime import timedelta
+from django.conf import settings
+from django.core.management import call_command
 from django.utils import timezone
 from mock import patch
 from rache import job_details, schedule_job
 
 from feedhq import es
-from feedhq.feeds.models import (Category, Feed, UniqueFeed, Entry, Favicon,
-                                 UniqueFeedManager)
-from feedhq.feeds.tasks import update_feed
+from feedhq.feeds.models import (BaseEntry, Category, Feed, UniqueFeed, Entry,
+                                 Favicon, UniqueFeedManager)
+from feedhq.feeds.tasks import mark_as_read, store_entries, update_feed
+from feedhq.profiles.models import User
 from feedhq.utils import get_redis_connection
 
-from .factories import CategoryFactory, FeedFactory
+from .factories import CategoryFactory, FeedFactory, EntryFactory
 from . import responses, TestCase
 
 
@@ -27,7 +30,7 @@ class ModelTests(TestCase):
         # get_absolute_url()
         self.assertEqual('/category/new-cat/', cat_from_db.get_absolute_url())
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_feed_model(self, get):
         """Behaviour of the ``Feed`` model"""
         get.return_value = responses(200, 'rss20.xml')
@@ -60,7 +63,7 @@ class ModelTests(TestCase):
         self.assertEqual(feed.favicon_img(),
                          '<img src="/media/fav.png" width="16" height="16" />')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_entry_model(self, get):
         get.return_value = responses(200, 'sw-all.xml')
         feed = FeedFactory.create()
@@ -79,7 +82,7 @@ class ModelTests(TestCase):
         self.assertEqual(entry.tweet(),
                          u'Foo — http://example.com/foo')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_uniquefeed_model(self, get):
         get.return_value = responses(304)
         FeedFactory.create(url='http://example.com/' + 'foo/' * 200)
@@ -134,7 +137,7 @@ class ModelTests(TestCase):
         fav.favicon = 'foo.png'
         self.assertEqual(fav.favicon_img(), '<img src="/media/foo.png">')
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_entry_model_behaviour(self, get):
         """Behaviour of the `Entry` model"""
         get.return_value = responses(304)
@@ -148,7 +151,7 @@ class ModelTests(TestCase):
         # get_absolute_url()
         self.assertEqual('/entries/%s/' % entry.id, entry.get_absolute_url())
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_handle_etag(self, get):
         get.return_value = responses(200, 'sw-all.xml',
                                      headers={'etag': 'foo',
@@ -159,7 +162,7 @@ class ModelTests(TestCase):
         self.assertEqual(data['etag'], 'foo')
         self.assertEqual(data['modified'], 'bar')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_invalid_content(self, get):
         """Behaviour of the ``Feed`` model"""
         get.return_value = responses(304)
@@ -171,6 +174,191 @@ class ModelTests(TestCase):
             entry.content,
             '<a href="http://mozillaopennews.org%5D/">OpenNews</a>')
 
+    @patch('feedhq.feeds.fetcher.get')
+    def test_sanitized_at_ingest(self, get):
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create()
+        update_feed(feed.url)
+        [entry] = es.manager.user(feed.user).fetch()['hits']
+        self.assertEqual(entry.sanitizer, BaseEntry.SANITIZER_VERSION)
+        self.assertIn('href="http', entry.safe_content)
+
+        with patch('bleach.clean') as clean:
+            self.assertEqual(entry.sanitized_content(), entry.safe_content)
+            self.assertEqual(entry.sanitized_nomedia_content(),
+                             entry.safe_nomedia_content)
+        self.assertEqual(clean.call_count, 0)
+
+        with patch.object(BaseEntry, 'SANITIZER_VERSION', 2):
+            entry.feed = feed
+            self.assertEqual(entry.sanitized_content(), entry.safe_content)
+
+            call_command('resanitize')
+            es.client.indices.refresh(es.user_alias(feed.user.pk))
+            [entry] = es.manager.user(feed.user).fetch()['hits']
+            self.assertEqual(entry.sanitizer, 2)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_shared_bodies(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(url='http://example.com/shared')
+        other = FeedFactory.create(url='http://example.com/shared')
+        get.return_value = responses(200, 'sw-all.xml')
+        with self.settings(ES_SHARED_BODIES=True):
+            update_feed(feed.url)
+        self.assertEqual(es.client.count(
+            settings.ES_BODIES_INDEX, doc_type='bodies')['count'], 1)
+
+        [entry] = es.manager.user(feed.user).fetch()['hits']
+        raw = es.client.get(es.user_alias(feed.user.pk), entry.pk)
+        self.assertNotIn('content', raw['_source'])
+        self.assertIn('RE2', entry.subtitle)
+        self.assertEqual(entry.sanitizer, BaseEntry.SANITIZER_VERSION)
+        self.assertEqual(es.entry(feed.user, entry.pk).subtitle,
+                         entry.subtitle)
+        [other_entry] = es.mget(other.user, [
+            es.manager.user(other.user).fetch()['hits'][0].pk])
+        self.assertEqual(other_entry.subtitle, entry.subtitle)
+
+        later = timezone.now() + timedelta(days=2)
+        with patch('django.utils.timezone.now', return_value=later):
+            self.assertEqual(es.delete_orphan_bodies(), 0)
+            feed.user.delete_feed_entries(feed.pk)
+            other.user.delete_feed_entries(other.pk)
+            es.client.indices.refresh(settings.ES_INDEX)
+            self.assertEqual(es.delete_orphan_bodies(), 1)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_shared_bodies_same_guids(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        entries = [{
+            'title': u'Entry {0}'.format(index),
+            'link': u'http://example.com/{0}'.format(index),
+            'date': timezone.now() - timedelta(hours=index),
+            'author': u'',
+            'guid': u'http://example.com/',
+            'date_generated': False,
+            'subtitle': u'Content {0}'.format(index),
+        } for index in range(2)]
+        with self.settings(ES_SHARED_BODIES=True):
+            store_entries(feed.url, entries)
+        self.assertEqual(es.client.count(
+            settings.ES_BODIES_INDEX, doc_type='bodies')['count'], 2)
+        hits = es.manager.user(feed.user).fetch()['hits']
+        self.assertEqual(
+            sorted((entry.title, entry.subtitle) for entry in hits),
+            [(u'Entry 0', u'Content 0'), (u'Entry 1', u'Content 1')])
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_stored_index(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(url='http://example.com/unpartitioned')
+        other = FeedFactory.create(url='http://example.com/partitioned')
+        get.return_value = responses(200, 'sw-all.xml')
+
+        update_feed(feed.url)
+        [entry] = es.manager.user(feed.user).fetch()['hits']
+        self.assertEqual(entry._index, settings.ES_INDEX)
+
+        with self.settings(ES_PARTITIONS=True):
+            name = es.rollover(User.objects.values_list('pk', flat=True))
+            self.addCleanup(es.client.indices.delete,
+                            es.archive_name() + ',' + name)
+            update_feed(other.url)
+            [entry] = es.manager.user(other.user).fetch()['hits']
+            self.assertEqual(entry._index, name)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_partitions(self, get):
+        get.return_value = responses(304)
+        with self.settings(ES_PARTITIONS=True):
+            first = es.rollover(User.objects.values_list('pk', flat=True))
+            self.addCleanup(es.client.indices.delete,
+                            es.archive_name() + ',' + first)
+            self.assertEqual(es.write_index(), first)
+
+            feed = FeedFactory.create()
+            user = feed.user
+            starred = EntryFactory.create(feed=feed, user=user)
+            self.assertEqual(starred._index, first)
+            starred.update(starred=True, refresh=True)
+            EntryFactory.create(feed=feed, user=user)
+            self.assertEqual(len(es.manager.user(user).fetch()['hits']), 2)
+
+            later = timezone.now() + timedelta(days=62)
+            with patch('django.utils.timezone.now', return_value=later):
+                second = es.rollover(
+                    User.objects.values_list('pk', flat=True))
+                self.addCleanup(es.client.indices.delete, second)
+                self.assertEqual(es.drop_partitions(0), [first])
+            es.client.indices.refresh(es.archive_name())
+
+            [entry] = es.manager.user(user).fetch()['hits']
+            self.assertEqual(entry.pk, starred.pk)
+            self.assertEqual(entry._index, es.archive_name())
+            entry = es.entry(user, entry.pk)
+            entry.update(read=True, refresh=True)
+            self.assertEqual(es.mget(user, [entry.pk])[0].read, True)
+
     def test_not_scheduled_last_update(self):
         u = UniqueFeed('ĥttp://example.com')
         self.assertIsNone(u.last_update)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_iter_ids(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        pks = set(EntryFactory.create(feed=feed, user=feed.user).pk
+                  for i in range(5))
+        EntryFactory.create(feed=feed, user=feed.user, read=True)
+
+        entries = es.manager.user(feed.user).filter(read=False)
+        chunks = list(entries.iter_ids(chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(set(pk for chunk in chunks for pk in chunk), pks)
+
+        self.assertEqual(list(entries.filter(feed=0).iter_ids()), [])
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_mark_as_read_deltas(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        user = feed.user
+        for i in range(3):
+            EntryFactory.create(feed=feed, user=user)
+        self.assertEqual(user.unread_counts(), {feed.pk: 3})
+
+        # Stale counts when the job was enqueued
+        deltas = {feed.pk: -1, feed.pk + 1: -2}
+        user.incr_unread(deltas)
+        mark_as_read(user.pk, es.manager.user(user).filter(read=False),
+                     deltas)
+        self.assertEqual(es.counts(user, [feed.pk])[feed.pk], 0)
+        redis = get_redis_connection()
+        self.assertEqual(int(redis.hget(user.unread_key, feed.pk)), 0)
+        self.assertEqual(int(redis.hget(user.unread_key, feed.pk + 1)), 0)
+
+        # Entries stored once the job is enqueued are left alone
+        EntryFactory.create(feed=feed, user=user)
+        es_entries = es.manager.user(user).filter(read=False,
+                                                  id__lte=es.last_id())
+        EntryFactory.create(feed=feed, user=user)
+        mark_as_read(user.pk, es_entries)
+        self.assertEqual(es.counts(user, [feed.pk])[feed.pk], 1)
+
+    def test_entry_query_sharing(self):
+        base = es.manager.user(1).filter(read=False)
+        starred = base.filter(starred=True).aggregate('__query__')
+        self.assertNotIn('starred', base.filters)
+        self.assertIs(starred.filters['read'], base.filters['read'])
+
+        body = starred.body()
+        self.assertIs(starred.body(), body)
+        self.assertIn('aggs', body)
+        self.assertNotIn('aggs', base.body())
+
+        either = base.filter(or_=True, feed=1)
+        self.assertEqual(len(either.filter(
+            or_=True, category=2).filters['or']['or']), 2)
+        self.assertEqual(len(either.filters['or']['or']), 1)
@@ -232,7 +232,7 @@ class ProfilesTest(WebTest):
         self.assertEqual(user.read_later, '')
         self.assertEqual(user.read_later_credentials, '')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_delete_account(self, get):
         get.return_value = responses(304)
         user = User.objects.get()
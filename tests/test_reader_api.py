@@ -175,7 +175,7 @@ class SerializerTest(ApiTest):
             serializer.render(12.5)
 
 
-@patch('requests.get')
+@patch('feedhq.feeds.fetcher.get')
 class ReaderApiTest(ApiTest):
     def test_user_info(self, get):
         url = reverse('reader:user_info')
@@ -461,6 +461,103 @@ class ReaderApiTest(ApiTest):
             else:
                 self.assertEqual(count['count'], 5)
 
+    def test_unread_counters(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        post_token = self.client.post(
+            reverse('reader:token'), **clientlogin(token)).content.decode(
+                'utf-8')
+        redis = get_redis_connection()
+
+        feed = FeedFactory.create(category__user=user, user=user)
+        entries = [EntryFactory.create(feed=feed, read=False, user=user)
+                   for i in range(3)]
+        feed2 = FeedFactory.create(category=None, user=user)
+        EntryFactory.create(feed=feed2, read=False, user=user)
+
+        # Built from ES on first access
+        redis.delete(user.unread_key)
+        self.assertEqual(user.unread_counts(), {feed.pk: 3, feed2.pk: 1})
+
+        EntryFactory.create(feed=feed2, read=False, user=user)
+        self.assertEqual(user.unread_counts(), {feed.pk: 3, feed2.pk: 2})
+
+        url = reverse('reader:edit_tag')
+        data = {'T': post_token,
+                'i': [entries[0].pk, entries[1].pk],
+                'a': 'user/-/state/com.google/read'}
+        self.client.post(url, data, **clientlogin(token))
+        # Already read, no change
+        data['i'] = entries[0].pk
+        self.client.post(url, data, **clientlogin(token))
+        self.assertEqual(user.unread_counts(), {feed.pk: 1, feed2.pk: 2})
+
+        data = {'T': post_token, 'i': entries[1].pk,
+                'r': 'user/-/state/com.google/read'}
+        self.client.post(url, data, **clientlogin(token))
+        self.assertEqual(user.unread_counts(), {feed.pk: 2, feed2.pk: 2})
+
+        url = reverse('reader:mark_all_as_read')
+        data = {'T': post_token, 's': u'feed/{0}'.format(feed2.url)}
+        self.client.post(url, data, **clientlogin(token))
+        self.assertEqual(user.unread_counts(), {feed.pk: 2})
+
+        response = self.client.get(reverse('reader:unread_count'),
+                                   **clientlogin(token))
+        counts = dict((count['id'], count['count'])
+                      for count in response.json['unreadcounts'])
+        self.assertEqual(counts[u'feed/{0}'.format(feed.url)], 2)
+        self.assertNotIn(u'feed/{0}'.format(feed2.url), counts)
+
+        # Drift is fixed by the reconciler
+        redis.hset(user.unread_key, feed2.pk, 12)
+        redis.hset(user.unread_key, feed.pk, -1)
+        self.assertEqual(user.unread_counts(), {feed2.pk: 12})
+        call_command('sync_unread')
+        self.assertEqual(user.unread_counts(), {feed.pk: 2})
+
+    def test_write_overlay(self, get):
+        get.return_value = responses(304)
+        user = UserFactory.create()
+        token = self.auth_token(user)
+        post_token = self.client.post(
+            reverse('reader:token'), **clientlogin(token)).content.decode(
+                'utf-8')
+        feed = FeedFactory.create(category__user=user, user=user)
+        entry = EntryFactory.create(feed=feed, read=False, user=user)
+        other = EntryFactory.create(feed=feed, read=False, user=user)
+        url = reverse('reader:stream_contents',
+                      args=['user/-/state/com.google/reading-list'])
+
+        with self.settings(ES_WRITE_OVERLAY=30):
+            self.client.post(reverse('reader:edit_tag'), {
+                'T': post_token, 'i': entry.pk,
+                'a': ['user/-/state/com.google/read',
+                      'user/-/state/com.google/starred']},
+                **clientlogin(token))
+            self.assertEqual(es.pending(user.pk),
+                             {entry.pk: {'read': True, 'starred': True}})
+            self.assertTrue(0 < get_redis_connection().ttl(
+                es.PENDING_KEY.format(user.pk)) <= 30)
+
+            # Pending changes are visible before the index is refreshed
+            response = self.client.get(
+                url, {'xt': 'user/-/state/com.google/read'},
+                **clientlogin(token))
+            self.assertEqual([item['id'] for item in response.json['items']],
+                             ['tag:google.com,2005:reader/item/{0}'.format(
+                                 other.hex_pk)])
+
+            response = self.client.get(url, **clientlogin(token))
+            [item] = [item for item in response.json['items']
+                      if item['id'].endswith(entry.hex_pk)]
+            self.assertIn(
+                'user/{0}/state/com.google/starred'.format(user.pk),
+                item['categories'])
+
+        self.assertEqual(es.pending(user.pk), {})
+
     def test_stream_content(self, get):
         get.return_value = responses(304)
         user = UserFactory.create()
@@ -520,7 +617,8 @@ class ReaderApiTest(ApiTest):
         # Warm up the uniques map cache
         with self.assertNumQueries(2):
             response = self.client.get(url, **clientlogin(token))
-        self.assertEqual(response.json['continuation'], 'page2')
+        continuation = response.json['continuation']
+        self.assertFalse(continuation.startswith('page'))
         self.assertEqual(len(response.json['items']), 20)
 
         # ?xt= excludes stuff
@@ -592,6 +690,18 @@ class ReaderApiTest(ApiTest):
         self.assertFalse('continuation' in response.json)
         self.assertTrue(response.json['self'][0]['href'].endswith(
             'reading-list?c=page2'))
+        page2 = [item['id'] for item in response.json['items']]
+
+        # Cursors fetch the same entries as pages
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'c': continuation},
+                                       **clientlogin(token))
+        self.assertEqual([item['id'] for item in response.json['items']],
+                         page2)
+        self.assertFalse('continuation' in response.json)
+
+        response = self.client.get(url, {'c': 'W10'}, **clientlogin(token))
+        self.assertEqual(response.status_code, 400)
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {'n': 40}, **clientlogin(token))
@@ -743,7 +853,8 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        continuation = response.json['continuation']
+        self.assertFalse(continuation.startswith('page'))
 
         with self.assertNumQueries(1):
             response = self.client.post('{0}?{1}'.format(url, urlencode({
@@ -752,7 +863,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'})),
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertEqual(response.json['continuation'], continuation)
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -760,7 +871,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertEqual(response.json['continuation'], continuation)
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -770,7 +881,7 @@ class ReaderApiTest(ApiTest):
                 'includeAllDirectStreamIds': 'true'},
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
-        self.assertEqual(response.json['continuation'], 'page2')
+        self.assertEqual(response.json['continuation'], continuation)
 
         with self.assertNumQueries(1):
             response = self.client.get(url, {
@@ -779,6 +890,15 @@ class ReaderApiTest(ApiTest):
                 **clientlogin(token))
         self.assertEqual(len(response.json['itemRefs']), 5)
         self.assertFalse('continuation' in response.json)
+        page2 = response.json['itemRefs']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {
+                'n': 5, 's': 'splice/user/-/state/com.google/reading-list',
+                'c': continuation, 'includeAllDirectStreamIds': 'true'},
+                **clientlogin(token))
+        self.assertEqual(response.json['itemRefs'], page2)
+        self.assertFalse('continuation' in response.json)
 
         with self.assertNumQueries(0):
             response = self.client.get(url, {
@@ -936,6 +1056,8 @@ class ReaderApiTest(ApiTest):
         data['s'] = u'feed/{0}'.format(feed2.url)
         response = self.client.post(url, data, **clientlogin(token))
         self.assertContains(response, 'OK')
+        # Entries are updated by a job
+        self.assertTrue(response['X-FeedHQ-Job'])
         read = self.counts(user, read={'read': True})['read']
 
         self.assertEqual(read, 4)
@@ -1,3 +1,6 @@
+import multiprocessing
+import os
+import threading
 import time
 
 from datetime import timedelta
@@ -5,21 +8,29 @@ from mock import patch
 
 import feedparser
 
+from django.conf import settings
 from django.core.cache import cache
 from django.core.management import call_command
 from django.utils import timezone
+from django.utils.encoding import force_bytes
 from django_push.subscriber.models import Subscription
 from rache import pending_jobs, delete_job
+from rq import Queue
+from rq.job import Status
 from rq.utils import utcformat, utcnow
 
 from feedhq import es
+from feedhq.feeds.management.commands.rqworker import (
+    NonForkingStoreBatchWorker)
 from feedhq.feeds.models import UniqueFeed, timedelta_to_seconds
-from feedhq.feeds.tasks import store_entries
+from feedhq.feeds.tasks import (delete_old, remember_entries, store_entries,
+                                sweep_stats, SEEN_KEY, SWEEP_JOBS_KEY,
+                                SWEEP_SHARDS_KEY)
 from feedhq.feeds.utils import USER_AGENT
 from feedhq.profiles.models import User
 from feedhq.utils import get_redis_connection
 
-from .factories import FeedFactory, UserFactory
+from .factories import EntryFactory, FeedFactory, UserFactory
 from . import responses, TestCase, data_file, patch_job
 
 
@@ -121,7 +132,7 @@ class UpdateTests(TestCase):
         self.assertEqual(jobs[0]['id'], 'http://example.com/bar')
         self.assertEqual(jobs[1]['id'], 'http://example.com/foo')
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_update_call(self, get):
         u = User.objects.create_user('foo', 'foo@example.com', 'pass')
         c = u.categories.create(name='foo', slug='foo')
@@ -138,7 +149,7 @@ class UpdateTests(TestCase):
         call_command('delete_unsubscribed')
         self.assertEqual(UniqueFeed.objects.count(), 1)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_add_missing(self, get):
         get.return_value = responses(304)
 
@@ -154,7 +165,7 @@ class UpdateTests(TestCase):
         with self.assertNumQueries(1):
             call_command('add_missing')
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_updatefeeds_queuing(self, get):
         get.return_value = responses(304)
 
@@ -177,7 +188,124 @@ class UpdateTests(TestCase):
             # count()
             call_command('updatefeeds')
 
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
+    def test_updatefeeds_batch(self, get):
+        get.return_value = responses(304)
+
+        for i in range(5):
+            f = FeedFactory.create()
+            patch_job(f.url, last_update=(
+                timezone.now() - timedelta(hours=10)).strftime('%s'))
+            UniqueFeed.objects.get(url=f.url).schedule()
+
+        get.reset_mock()
+        call_command('updatefeeds', batch_size=2)
+        self.assertEqual(get.call_count, 5)
+        for unique in UniqueFeed.objects.all():
+            self.assertTrue(
+                timezone.now() - unique.last_update < timedelta(minutes=1))
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_update_feeds_errors(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create() for i in range(3)]
+
+        get.return_value = responses(502)
+        UniqueFeed.objects.update_feeds([
+            {'id': feed.url, 'backoff_factor': 1} for feed in feeds
+        ])
+        for feed in feeds:
+            data = UniqueFeed.objects.get(url=feed.url).job_details
+            self.assertEqual(data['error'], 502)
+            self.assertEqual(data['backoff_factor'], 2)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_update_feeds_parse_processes(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create(user__ttl=99999) for i in range(2)]
+        feeds.append(FeedFactory.create())
+
+        get.side_effect = [responses(200, 'sw-all.xml'),
+                           responses(200, 'sw-all.xml'),
+                           responses(200, data='not a feed')]
+        threads = []
+        pool_class = multiprocessing.Pool
+
+        def pool(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return pool_class(*args, **kwargs)
+
+        with patch('multiprocessing.Pool', side_effect=pool):
+            UniqueFeed.objects.update_feeds([
+                {'id': feed.url, 'backoff_factor': 1} for feed in feeds
+            ], parse_processes=2)
+        # Forked before fetching threads are started
+        self.assertEqual(threads, [threading.current_thread()])
+        for feed in feeds[:2]:
+            self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                             {'feed': 30})
+            data = UniqueFeed.objects.get(url=feed.url).job_details
+            self.assertEqual(data['title'], "Simon Willison's Weblog")
+
+        data = UniqueFeed.objects.get(url=feeds[2].url).job_details
+        self.assertEqual(data['error'], UniqueFeed.NOT_A_FEED)
+
+    @patch('feedparser.parse')
+    @patch('feedhq.feeds.fetcher.get')
+    def test_update_feeds_parse_timeout(self, get, parse):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+
+        get.return_value = responses(200, 'sw-all.xml')
+        parse.side_effect = lambda content: time.sleep(10)
+        with self.settings(PARSE_TIMEOUT=1):
+            UniqueFeed.objects.update_feeds([
+                {'id': feed.url, 'backoff_factor': 1}
+            ], parse_processes=1)
+        data = UniqueFeed.objects.get(url=feed.url).job_details
+        self.assertEqual(data['error'], UniqueFeed.UNPARSEABLE)
+        self.assertEqual(data['backoff_factor'], 2)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_update_feeds_parse_no_fork_in_batch(self, get):
+        get.return_value = responses(304)
+        stuck = FeedFactory.create()
+        other = FeedFactory.create(user__ttl=99999)
+
+        get.side_effect = [responses(200, 'sw-all.xml'),
+                           responses(200, 'aldaily-06-27.xml')]
+        feedparser_parse = feedparser.parse
+
+        def parse(content):
+            if b'simonwillison' in force_bytes(content):
+                time.sleep(10)
+            return feedparser_parse(content)
+
+        threads = threading.active_count()
+        forks = []
+        os_fork = os.fork
+
+        def fork():
+            forks.append(threading.active_count())
+            return os_fork()
+
+        with patch('feedparser.parse', side_effect=parse), \
+                patch('os.fork', side_effect=fork), \
+                self.settings(PARSE_TIMEOUT=1):
+            UniqueFeed.objects.update_feeds([
+                {'id': feed.url, 'backoff_factor': 1}
+                for feed in [stuck, other]
+            ], concurrency=1, parse_processes=1)
+        # Forked once, before fetch and pool handler threads were started
+        self.assertEqual(forks, [threads])
+
+        data = UniqueFeed.objects.get(url=stuck.url).job_details
+        self.assertEqual(data['error'], UniqueFeed.UNPARSEABLE)
+        # Parsed inline once the pool was killed
+        self.assertEqual(
+            self.counts(other.user, feed={'feed': other.pk}), {'feed': 4})
+
+    @patch('feedhq.feeds.fetcher.get')
     def test_suspending_user(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create(user__is_suspended=True)
@@ -207,19 +335,200 @@ class UpdateTests(TestCase):
             [UniqueFeed.objects.entry_data(
                 entry, parsed) for entry in parsed.entries]
         ))
-        with self.assertNumQueries(30 + 1):  # insert
+        with self.assertNumQueries(2):  # insert
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk])[str(feed.pk)][str(feed.pk)]['doc_count']
-        count2 = es.counts(
-            feed2.user, [feed2.pk])[str(feed2.pk)][str(feed2.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk])[feed.pk]
+        count2 = es.counts(feed2.user, [feed2.pk])[feed2.pk]
         self.assertEqual(count, 0)
         self.assertEqual(count2, 30)
         last_updates = feed2.user.last_updates()
         self.assertEqual(list(last_updates.keys()), [feed2.url])
 
-    @patch('requests.get')
+    def test_cached_es_checks(self):
+        es.invalidate_checks()
+        with patch.object(
+            es.client.cluster, 'health', wraps=es.client.cluster.health,
+        ) as health, patch.object(
+            es.client.indices, 'get_field_mapping',
+            wraps=es.client.indices.get_field_mapping,
+        ) as get_field_mapping:
+            for i in range(2):
+                es.ensure_yellow()
+                es.check_mappings([settings.ES_INDEX])
+            self.assertEqual(health.call_count, 1)
+            self.assertEqual(get_field_mapping.call_count, 1)
+
+            # create_index invalidates checks in all processes
+            get_redis_connection().incr(es.CHECKS_VERSION_KEY)
+            es.ensure_yellow()
+            es.check_mappings([settings.ES_INDEX])
+            self.assertEqual(health.call_count, 2)
+            self.assertEqual(get_field_mapping.call_count, 2)
+
+    def test_next_ids(self):
+        with self.assertNumQueries(1):
+            ids = es.next_ids(3)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertTrue(es.next_id() > max(ids))
+        with self.assertNumQueries(0):
+            self.assertEqual(es.next_ids(0), [])
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_seen_guids(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+
+        parsed = feedparser.parse(data_file('sw-all.xml'))
+
+        def entries():
+            return list(filter(None, [
+                UniqueFeed.objects.entry_data(entry, parsed)
+                for entry in parsed.entries
+            ]))
+
+        store_entries(feed.url, entries())
+        self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                         {'feed': 30})
+
+        # Existing entries are found without querying elasticsearch
+        with patch.object(es.client, 'msearch') as search:
+            store_entries(feed.url, entries())
+            search.assert_not_called()
+        self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                         {'feed': 30})
+
+        # New subscribers need a check
+        feed2 = FeedFactory.create(url=feed.url, user__ttl=99999)
+        with patch.object(es.client, 'msearch',
+                          wraps=es.client.msearch) as search:
+            store_entries(feed.url, entries())
+            self.assertEqual(search.call_count, 1)
+        self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                         {'feed': 30})
+        self.assertEqual(self.counts(feed2.user, feed={'feed': feed2.pk}),
+                         {'feed': 30})
+
+        with patch.object(es.client, 'msearch') as search:
+            store_entries(feed.url, entries())
+            search.assert_not_called()
+        self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                         {'feed': 30})
+
+        # Batches are merged into the seen entries
+        feeds = [{'pk': feed.pk}, {'pk': feed2.pk}]
+        remember_entries(feed.url, feeds, entries()[:1], reset=True)
+        with patch.object(es.client, 'msearch') as search:
+            store_entries(feed.url, entries())
+            search.assert_not_called()
+
+        # Entries trimmed from the set need a check
+        with self.settings(SEEN_GUIDS_MAX=10):
+            remember_entries(feed.url, feeds, entries()[:10])
+            self.assertEqual(
+                get_redis_connection().zcard(SEEN_KEY.format(feed.url)), 20)
+            with patch.object(es.client, 'msearch',
+                              wraps=es.client.msearch) as search:
+                store_entries(feed.url, entries())
+                self.assertEqual(search.call_count, 1)
+        self.assertEqual(self.counts(feed.user, feed={'feed': feed.pk}),
+                         {'feed': 30})
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_last_update_scores(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create(user__ttl=99999)
+        other = FeedFactory.create(user=feed.user, category=feed.category)
+        redis = get_redis_connection()
+        redis.zadd(feed.user.last_update_key, feed.url, 10 ** 10)
+        redis.zadd(feed.user.last_update_key, other.url, 1)
+
+        parsed = feedparser.parse(data_file('sw-all.xml'))
+
+        def entries():
+            return list(filter(None, [
+                UniqueFeed.objects.entry_data(entry, parsed)
+                for entry in parsed.entries
+            ]))
+        data = entries()
+        store_entries(feed.url, data)
+        store_entries(other.url, entries())
+
+        last_updates = feed.user.last_updates()
+        # Not lowered
+        self.assertEqual(last_updates[feed.url], 10 ** 10)
+        # Raised to the latest entry
+        self.assertEqual(last_updates[other.url],
+                         int(max(e['date'] for e in data).strftime('%s')))
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_store_batch_worker(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create(user__ttl=99999),
+                 FeedFactory.create(user__ttl=99999)]
+
+        queue = Queue('store', connection=get_redis_connection())
+        for feed, name in zip(feeds, ['sw-all.xml', 'aldaily-06-27.xml']):
+            parsed = feedparser.parse(data_file(name))
+            data = list(filter(None, [
+                UniqueFeed.objects.entry_data(entry, parsed)
+                for entry in parsed.entries
+            ]))
+            queue.enqueue_call(func=store_entries, args=(feed.url, data))
+
+        worker = NonForkingStoreBatchWorker([queue],
+                                            connection=queue.connection)
+        with patch('feedhq.es.bulk', wraps=es.bulk) as bulk, \
+                patch.object(es.client, 'msearch',
+                             wraps=es.client.msearch) as msearch, \
+                patch.object(es.client, 'search') as search:
+            with self.assertNumQueries(2):
+                worker.work(burst=True)
+            self.assertEqual(bulk.call_count, 1)
+            # Existing entries of both feeds looked up at once
+            self.assertEqual(msearch.call_count, 1)
+            search.assert_not_called()
+        self.assertEqual(queue.count, 0)
+        self.assertEqual(
+            self.counts(feeds[0].user, feed={'feed': feeds[0].pk}),
+            {'feed': 30})
+        self.assertEqual(
+            self.counts(feeds[1].user, feed={'feed': feeds[1].pk}),
+            {'feed': 4})
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_store_batch_worker_retry(self, get):
+        get.return_value = responses(304)
+        feeds = [FeedFactory.create(user__ttl=99999),
+                 FeedFactory.create(user__ttl=99999)]
+
+        queue = Queue('store', connection=get_redis_connection())
+        jobs = []
+        for feed, name in zip(feeds, ['sw-all.xml', 'aldaily-06-27.xml']):
+            parsed = feedparser.parse(data_file(name))
+            data = list(filter(None, [
+                UniqueFeed.objects.entry_data(entry, parsed)
+                for entry in parsed.entries
+            ]))
+            jobs.append(queue.enqueue_call(func=store_entries,
+                                           args=(feed.url, data)))
+        dependent = queue.enqueue_call(func=sweep_stats, depends_on=jobs[1])
+
+        worker = NonForkingStoreBatchWorker([queue],
+                                            connection=queue.connection)
+        with patch('feedhq.feeds.management.commands.rqworker.'
+                   'store_entries_batch', side_effect=ValueError):
+            worker.work(burst=True)
+        self.assertEqual(queue.count, 0)
+        self.assertEqual(dependent.get_status(), Status.FINISHED)
+        self.assertEqual(
+            self.counts(feeds[0].user, feed={'feed': feeds[0].pk}),
+            {'feed': 30})
+        self.assertEqual(
+            self.counts(feeds[1].user, feed={'feed': feeds[1].pk}),
+            {'feed': 4})
+
+    @patch('feedhq.feeds.fetcher.get')
     def test_same_guids(self, get):
         get.return_value = responses(304)
         feed = FeedFactory.create(user__ttl=99999)
@@ -231,12 +540,10 @@ class UpdateTests(TestCase):
                 entry, parsed) for entry in parsed.entries]
         ))
 
-        with self.assertNumQueries(1 + len(data)):
+        with self.assertNumQueries(2):
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 4)
 
         data = list(filter(
@@ -246,9 +553,7 @@ class UpdateTests(TestCase):
         ))
         with self.assertNumQueries(1):
             store_entries(feed.url, data)
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 4)
 
         parsed = feedparser.parse(data_file('aldaily-06-30.xml'))
@@ -258,15 +563,13 @@ class UpdateTests(TestCase):
                 entry, parsed) for entry in parsed.entries]
         ))
 
-        with self.assertNumQueries(7):
+        with self.assertNumQueries(2):
             store_entries(feed.url, data)
 
-        count = es.counts(
-            feed.user, [feed.pk],
-            unread=False)[str(feed.pk)][str(feed.pk)]['doc_count']
+        count = es.counts(feed.user, [feed.pk], unread=False)[feed.pk]
         self.assertEqual(count, 10)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_empty_guid(self, get):
         get.return_value = responses(304)
 
@@ -297,7 +600,7 @@ class UpdateTests(TestCase):
         [entry] = es.manager.user(feed.user).fetch()['hits']
         self.assertTrue(entry.guid)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_ttl(self, get):
         get.return_value = responses(304)
         user = UserFactory.create(ttl=3)
@@ -313,7 +616,7 @@ class UpdateTests(TestCase):
             store_entries(feed.url, data)
         self.assertEqual(feed.entries.count(), 0)
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_no_content(self, get):
         get.return_value = responses(304)
         parsed = feedparser.parse(data_file('no-content.xml'))
@@ -324,7 +627,7 @@ class UpdateTests(TestCase):
         )
         self.assertEqual(list(data), [])
 
-    @patch("requests.get")
+    @patch('feedhq.feeds.fetcher.get')
     def test_schedule_in(self, get):
         get.return_value = responses(304)
 
@@ -336,6 +639,65 @@ class UpdateTests(TestCase):
         secs = timedelta_to_seconds(UniqueFeed.objects.get().schedule_in)
         self.assertTrue(secs > 10000)
 
+        # Feeds that rarely publish are checked less often
+        patch_job(f.url, backoff_factor=1, cadence=3600 * 24 * 7)
+        secs = timedelta_to_seconds(UniqueFeed.objects.get().schedule_in)
+        self.assertTrue(3600 * 12 - 2 <= secs < 3600 * 12)
+
+        patch_job(f.url, cadence=3 * 3600)
+        secs = timedelta_to_seconds(UniqueFeed.objects.get().schedule_in)
+        self.assertTrue(5398 <= secs < 5400)
+
+        # Not more often than usual for active feeds
+        patch_job(f.url, cadence=600)
+        secs = timedelta_to_seconds(UniqueFeed.objects.get().schedule_in)
+        self.assertTrue(3598 <= secs < 3600)
+
+    def test_publish_cadence(self):
+        now = timezone.now()
+        entries = [{'date': now - timedelta(hours=6 * i),
+                    'date_generated': False} for i in range(5)]
+        self.assertEqual(UniqueFeed.objects.publish_cadence(entries),
+                         6 * 3600)
+
+        # Generated dates are ignored
+        entries.append({'date': now, 'date_generated': True})
+        self.assertEqual(UniqueFeed.objects.publish_cadence(entries),
+                         6 * 3600)
+        self.assertIsNone(UniqueFeed.objects.publish_cadence(entries[-2:]))
+
+        # Time since the last entry counts if the feed went quiet
+        for entry in entries:
+            entry['date'] -= timedelta(days=10)
+        self.assertTrue(
+            UniqueFeed.objects.publish_cadence(entries) >= 10 * 24 * 3600)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_cadence_job_data(self, get):
+        get.return_value = responses(200, 'sw-all.xml')
+        feed = FeedFactory.create()
+        data = UniqueFeed.objects.get(url=feed.url).job_details
+        # Last entry is from 2010
+        self.assertTrue(data['cadence'] > 3600 * 24 * 365)
+        self.assertTrue(
+            UniqueFeed.objects.get().schedule_in > timedelta(hours=11))
+        self.assertTrue(data['last_entry'] < time.time() - 3600 * 24 * 365)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_aged_cadence(self, get):
+        get.return_value = responses(304)
+        feed = FeedFactory.create()
+        last_entry = int(time.time()) - 2 * 24 * 3600
+
+        # Unchanged feeds drift towards the max update period
+        UniqueFeed.objects.update_feed(feed.url, cadence=3600,
+                                       last_entry=last_entry)
+        data = UniqueFeed.objects.get(url=feed.url).job_details
+        self.assertTrue(data['cadence'] >= 2 * 24 * 3600)
+        self.assertEqual(data['last_entry'], last_entry)
+        self.assertTrue(
+            UniqueFeed.objects.get().schedule_in > timedelta(hours=11))
+
     def test_clean_rq(self):
         r = get_redis_connection()
         self.assertEqual(len(r.keys('rq:job:*')), 0)
@@ -348,7 +710,7 @@ class UpdateTests(TestCase):
         self.assertEqual(len(r.keys('rq:job:*')), 2)
 
     @patch('requests.post')
-    @patch('requests.get')
+    @patch('feedhq.feeds.fetcher.get')
     def test_ensure_subscribed(self, get, post):
         get.return_value = responses(200, 'hub.atom')
         post.return_value = responses(202)
@@ -412,3 +774,47 @@ class UpdateTests(TestCase):
         cache.delete(u'pshb:{0}'.format(feed.url))
         feed = FeedFactory.create(url=feed.url)
         self.assertFalse(post.called)
+
+    @patch('feedhq.feeds.fetcher.get')
+    def test_delete_old(self, get):
+        get.return_value = responses(304)
+        old = timezone.now() - timedelta(days=10)
+        feeds = []
+        for suspended in [False, False, True]:
+            user = UserFactory.create(ttl=5, is_suspended=suspended)
+            feeds.append(FeedFactory.create(user=user, category__user=user))
+        for feed in feeds:
+            EntryFactory.create(feed=feed, user=feed.user)
+        EntryFactory.create(feed=feeds[0], user=feeds[0].user, date=old)
+        EntryFactory.create(feed=feeds[2], user=feeds[2].user, date=old)
+
+        # Interrupted before running any job
+        with patch('feedhq.feeds.management.commands.delete_old.enqueue'):
+            call_command('delete_old', shard_size=1)
+        redis = get_redis_connection()
+        self.assertEqual(redis.hlen(SWEEP_SHARDS_KEY), 2)
+        self.assertEqual(sweep_stats(), {})
+
+        # Queued shards are skipped, failed ones are enqueued again
+        redis.hmset(SWEEP_JOBS_KEY, {'0': 'failed', '1': 'queued'})
+        redis.hset('rq:job:failed', 'status', Status.FAILED)
+        redis.hset('rq:job:queued', 'status', Status.QUEUED)
+        with patch('feedhq.feeds.management.commands.delete_old.'
+                   'enqueue') as enqueue:
+            enqueue.return_value.id = 'new'
+            call_command('delete_old')
+            enqueue.assert_called_once_with(delete_old, args=['0'],
+                                            timeout=60 * 60)
+        self.assertEqual(redis.hget(SWEEP_JOBS_KEY, '0'), b'new')
+
+        # Jobs lost with a killed worker
+        redis.delete('rq:job:queued')
+        call_command('delete_old')
+        self.assertEqual(redis.hlen(SWEEP_SHARDS_KEY), 0)
+        stats = sweep_stats()
+        self.assertIn('duration', stats)
+        stats.pop('duration')
+        self.assertEqual(stats, {'users': 2, 'skipped': 1, 'deleted': 1})
+        es.client.indices.refresh(settings.ES_INDEX)
+        self.assertEqual([es.client.count(es.user_alias(feed.user.pk))['count']
+                          for feed in feeds], [1, 1, 2])